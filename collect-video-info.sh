@@ -2,37 +2,21 @@
 
 set -e
 set -o pipefail
-set -u 
+set -u
 
 # see http://stackoverflow.com/questions/592620/check-if-a-program-exists-from-a-bash-script
 command -v ffprobe >/dev/null 2>&1 || { echo >&2 "ffprobe not found"; exit 1; }
+command -v python3 >/dev/null 2>&1 || { echo >&2 "python3 not found"; exit 1; }
 
-find -wholename "*.MTS" -or -wholename "*.MOV" -or -wholename "*.MP4" -or -wholename "*.mp4" -or -wholename "*.avi" | while read infile
-do
-    
-    
-    echo
-    echo "Probe input file: \"$infile\""
-    echo
-    
-    if [ ! -e "${infile}.info.json" ]
-    then
-        echo "    Launch ffprobe on file - json output"
-        
-        ffprobe -of json -v quiet -show_format -show_streams -show_programs -show_chapters  -i "$infile" < /dev/null > "${infile}.info.json" 
-    else
-        echo "    Output file already exists."
-    fi
+# ffprobe details of all videos go to the media catalog (media-catalog.sqlite) instead of
+# .info.json / .info.txt files next to each video; only new or changed videos are probed, in parallel.
+#
+# Print the former file contents with
+#
+#   media-catalog.py --json <VIDEO>                             (.info.json)
+#   media-catalog.py --flat <VIDEO> --sections format,streams   (.info.txt)
 
-    if [ ! -e "${infile}.info.txt" ]
-    then
-        echo "    Launch ffprobe on file - flat text output"
-
-        ffprobe -of flat=s=_ -v quiet -show_format -show_streams -show_programs -show_chapters  -i "$infile" < /dev/null > "${infile}.info.txt" 
-    else
-        echo "    Output file already exists."
-    fi
-done    
+"$(dirname "$0")/media-catalog.py" --kind video "$@"
 
 echo
 echo "----------------------------------------------------------------------"
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import mediacatalog
+
+'''
+Exposure fusion of bracketed series (e.g. bracketed timelapses) with enfuse
+
+Source images in expo-series/ are grouped into brackets by EXIF capture time and exposure bias
+(from the media catalog, see mediacatalog.py), in capture time order:
+ - a frame starts a new bracket if it was taken more than --max-gap seconds after the previous one,
+   or its exposure bias (exposure time if no bias is recorded) is already in the current bracket or
+   does not come later in the usual exposure order of the series than the bias of the previous frame
+ - the usual order starts at the exposure shot after the longer time gaps between brackets (at the
+   exposure of the first frame if all gaps are alike) and follows the most common exposure successions
+ - dropped frames give a shorter bracket instead of shifting all later ones; brackets shorter than
+   the usual size are reported, single frames are not fused
+ - --count N groups N files by sorted name instead, like the former fuse-expo-series.sh
+
+Brackets are fused to fused/fusedNNNNN.jpg by concurrent enfuse runs within a core budget (-j) and a
+memory budget (-m). The memory of a run is estimated from the bracket size and pixel count, then
+from the peak memory measured on finished runs.
+
+A bracket whose output exists and was written from the same files with the same options (recorded
+in fused/fuse-expo-series.json) is not fused again: a stopped run resumes with the remaining
+brackets. Outputs are written under a temporary name first, so a stopped enfuse leaves no partial
+file. enfuse output goes to fused/fuse-expo-series.log, per bracket wall time, CPU time and peak
+memory are appended to fused/fuse-expo-series-timings.json.
+
+Launch with -h to print CLI help
+'''
+
+manifest_name = 'fuse-expo-series.json'
+timings_name = 'fuse-expo-series-timings.json'
+log_name = 'fuse-expo-series.log'
+
+# enfuse memory heuristic per pixel: every input image with its weight mask is held as float
+# (3 + 1 channels, 4 bytes), plus Laplacian pyramids (4/3 of the area) of the output, one input and
+# the mask
+image_bytes_per_px = 4 * 4
+pyramid_bytes_per_px = (2 * 3 * 4 + 4) * 4 / 3
+
+# the exposure shot after the longest median capture time gap starts the brackets if that gap is this
+# much longer than the one before any other exposure
+start_gap_ratio = 1.5
+
+def mb(n):
+  return n / (1024 * 1024)
+
+def available_memory():
+  '''
+  MemAvailable of /proc/meminfo in bytes, total physical memory elsewhere
+  '''
+  try:
+    with open('/proc/meminfo', 'r') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def parse_time(taken):
+  try:
+    return datetime.datetime.fromisoformat(taken) if taken else None
+  except ValueError:
+    return None
+
+def source_frames(catalog, source, jobs):
+  '''
+  Catalog rows of the images under the source directory; the catalog is updated first
+  '''
+  catalog.scan(('image',), jobs, lambda line: print(f'  {line}'))
+  prefix = catalog.relpath(source)
+  frames = []
+  for r in catalog.files('image', prefix):
+    path = os.path.relpath(os.path.join(catalog.root, r['path']))
+    if r['error']:
+      print(f'  {path}: skipped, {r["error"]}')
+      continue
+    frames.append({
+      'path' : path,
+      'time' : parse_time(r['taken']),
+      'exposure' : r['exposure_bias'] if r['exposure_bias'] is not None else r['exposure_time'],
+      'pixels' : r['width'] * r['height']
+    })
+  return frames
+
+def exposure_key(f):
+  return None if f['exposure'] is None else round(f['exposure'], 2)
+
+def split_brackets(frames, max_gap, order = None):
+  '''
+  Split time ordered frames into brackets: on a capture time gap, on a repeated exposure and, with the
+  usual exposure order of the series, on an exposure which does not come later in that order than the
+  previous frame (a bracket restarts)
+  '''
+  position = { e : k for k, e in enumerate(order or ()) }
+  brackets = []
+  for f in frames:
+    if brackets:
+      last = brackets[-1]
+      gap = (f['time'] - last[-1]['time']).total_seconds() if f['time'] and last[-1]['time'] else 0
+      e = exposure_key(f)
+      repeated = e is not None and any(exposure_key(g) == e for g in last)
+      restarted = e in position and exposure_key(last[-1]) in position and position[e] <= position[exposure_key(last[-1])]
+      if gap <= max_gap and not repeated and not restarted:
+        last.append(f)
+        continue
+    brackets.append([f])
+  return brackets
+
+def bracket_order(frames):
+  '''
+  Usual exposure order of the brackets in time ordered frames, None if some frame has no exposure.
+
+  Brackets start at the exposure shot after the longer capture time gaps (between brackets), or at
+  the exposure of the first frame if the gaps are all alike. The order follows the most common
+  successor of each exposure from there. Neither depends on where dropped frames are.
+  '''
+  exposures = [exposure_key(f) for f in frames]
+  if not exposures or None in exposures:
+    return None
+
+  gaps = {}
+  for a, b in zip(frames, frames[1:]):
+    if a['time'] and b['time']:
+      gaps.setdefault(exposure_key(b), []).append((b['time'] - a['time']).total_seconds())
+  medians = sorted(((statistics.median(g), e) for e, g in gaps.items()), reverse = True)
+  start = exposures[0]
+  if len(medians) > 1 and medians[0][0] > start_gap_ratio * medians[1][0]:
+    start = medians[0][1]
+
+  follows = collections.Counter(zip(exposures, exposures[1:]))
+  order = [start]
+  while True:
+    successors = [(n, b) for (a, b), n in follows.items() if a == order[-1] and b not in order]
+    if not successors:
+      return order
+    order.append(max(successors)[1])
+
+def group_brackets(frames, max_gap, count = None):
+  '''
+  List of brackets (lists of frames), see module doc
+  '''
+  if count:
+    frames = sorted(frames, key = lambda f: f['path'])
+    return [frames[i:i + count] for i in range(0, len(frames), count)]
+
+  if any(f['time'] is None and f['exposure'] is None for f in frames):
+    raise Exception('Frames without EXIF capture time and exposure; group by name with --count')
+
+  frames = sorted(frames, key = lambda f: (f['time'] or datetime.datetime.min, f['path']))
+  return split_brackets(frames, max_gap, bracket_order(frames))
+
+def usual_size(brackets):
+  sizes = [len(b) for b in brackets]
+  return max(set(sizes), key = lambda s: (sizes.count(s), s)) if sizes else 0
+
+def file_stamp(path):
+  st = os.stat(path)
+  return [path, st.st_size, st.st_mtime_ns]
+
+class Scheduler:
+  '''
+  Runs enfuse per bracket within the core and memory budgets; manifest, log and timings
+  '''
+
+  def __init__(self, out_dir, enfuse_args, cores, threads, memory, job_memory = None):
+    self.out_dir = out_dir
+    self.enfuse_args = enfuse_args
+    self.cores = cores
+    self.threads = threads
+    self.memory = memory
+    self.job_memory = job_memory
+    self.lock = threading.Lock()
+    self.start = time.perf_counter()
+    self.records = []
+    # largest measured peak memory per input pixel of finished runs
+    self.measured_bytes_per_px = None
+
+    # left by a stopped run
+    for path in glob.glob(os.path.join(out_dir, 'fused*.part.jpg')):
+      os.remove(path)
+
+    self.manifest_path = os.path.join(out_dir, manifest_name)
+    self.manifest = { 'brackets' : {} }
+    if os.path.exists(self.manifest_path):
+      with open(self.manifest_path, 'r') as f:
+        self.manifest = json.load(f)
+
+  def output(self, i):
+    return os.path.join(self.out_dir, f'fused{i + 1:05d}.jpg')
+
+  def entry(self, bracket):
+    return { 'inputs' : [file_stamp(f['path']) for f in bracket], 'enfuse_args' : self.enfuse_args }
+
+  def up_to_date(self, output, bracket):
+    recorded = self.manifest['brackets'].get(output)
+    if not recorded or not os.path.exists(output):
+      return False
+    st = os.stat(output)
+    return recorded['output'] == [st.st_size, st.st_mtime_ns] and { k : recorded[k] for k in ('inputs', 'enfuse_args') } == self.entry(bracket)
+
+  def estimate(self, bracket):
+    '''
+    Estimated peak memory of fusing a bracket in bytes
+    '''
+    if self.job_memory:
+      return self.job_memory
+    pixels = sum(f['pixels'] for f in bracket)
+    if self.measured_bytes_per_px:
+      return int(pixels * self.measured_bytes_per_px)
+    largest = max(f['pixels'] for f in bracket)
+    return int(pixels * image_bytes_per_px + largest * pyramid_bytes_per_px)
+
+  def save_manifest(self):
+    tmp = self.manifest_path + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(self.manifest, f, indent = 2)
+    os.replace(tmp, self.manifest_path)
+
+  def log(self, lines):
+    with self.lock:
+      with open(os.path.join(self.out_dir, log_name), 'a') as f:
+        f.writelines(line + '\n' for line in lines)
+
+  def fuse(self, i, bracket, estimate):
+    '''
+    Run enfuse on one bracket; returns its timing record
+    '''
+    output = self.output(i)
+    # enfuse picks the output format by extension
+    part = output[:-len('.jpg')] + '.part.jpg'
+    command = ['enfuse', '-v', '-o', part] + self.enfuse_args + [f['path'] for f in bracket]
+    t = time.perf_counter()
+    record = { 'output' : output, 'frames' : len(bracket), 'megapixels' : sum(f['pixels'] for f in bracket) / 1e6,
+      'estimate_mb' : mb(estimate), 'start_s' : t - self.start }
+
+    env = dict(os.environ, OMP_NUM_THREADS = str(self.threads))
+    p = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True, errors = 'replace', env = env)
+    out = p.stdout.read()
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+
+    ts = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    self.log([f'+--[ {ts} ]' + '-' * 86, f'| {output}: {" ".join(command)}', '+' + '-' * 120]
+      + ['    ' + line for line in out.splitlines()] + [''])
+
+    record.update({
+      'wall_s' : time.perf_counter() - t,
+      'cpu_s' : usage.ru_utime + usage.ru_stime,
+      'max_rss_mb' : usage.ru_maxrss / 1024,
+      'exit_code' : p.returncode
+    })
+    if p.returncode != 0 or not os.path.exists(part):
+      if os.path.exists(part):
+        os.remove(part)
+      raise Exception(f'enfuse exited with code {p.returncode}, see {os.path.join(self.out_dir, log_name)}')
+    os.replace(part, output)
+
+    st = os.stat(output)
+    with self.lock:
+      bytes_per_px = usage.ru_maxrss * 1024 / (record['megapixels'] * 1e6)
+      self.measured_bytes_per_px = max(self.measured_bytes_per_px or 0, bytes_per_px)
+      self.manifest['brackets'][output] = dict(self.entry(bracket), output = [st.st_size, st.st_mtime_ns],
+        time = datetime.datetime.now().isoformat(timespec = 'seconds'))
+      self.save_manifest()
+    record['status'] = 'fused'
+    return record
+
+  def run(self, brackets, min_frames):
+    '''
+    Fuse all brackets which are not up to date, in order; returns True if all succeeded
+    '''
+    pending = []
+    for i, bracket in enumerate(brackets):
+      output = self.output(i)
+      if len(bracket) < min_frames:
+        self.records.append({ 'output' : output, 'frames' : len(bracket), 'status' : 'skipped' })
+        print(f'  {output}: skipped, {len(bracket)} frame(s): {" ".join(f["path"] for f in bracket)}')
+      elif self.up_to_date(output, bracket):
+        self.records.append({ 'output' : output, 'frames' : len(bracket), 'status' : 'up to date' })
+      else:
+        pending.append(i)
+    print(f'{len(brackets)} brackets, {len(pending)} to fuse, {len(brackets) - len(pending)} up to date or skipped')
+
+    running = {}
+    used_cores = 0
+    used_memory = 0
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, self.cores // self.threads)) as executor:
+      while pending or running:
+        # start brackets in order while they fit; a bracket larger than the budget runs alone
+        while pending:
+          estimate = self.estimate(brackets[pending[0]])
+          if running and (used_cores + self.threads > self.cores or used_memory + estimate > self.memory):
+            break
+          i = pending.pop(0)
+          used_cores = used_cores + self.threads
+          used_memory = used_memory + estimate
+          running[executor.submit(self.fuse, i, brackets[i], estimate)] = (i, estimate)
+
+        done, _ = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          i, estimate = running.pop(future)
+          used_cores = used_cores - self.threads
+          used_memory = used_memory - estimate
+          try:
+            r = future.result()
+          except Exception as e:
+            failed = failed + 1
+            r = { 'output' : self.output(i), 'frames' : len(brackets[i]), 'status' : 'failed', 'error' : str(e) }
+            print(f'  {r["output"]}: FAILED: {e}')
+          else:
+            print(f'  {r["output"]}: {r["frames"]} frames, {r["megapixels"]:.1f} MP, {r["wall_s"]:8.3f} s, '
+              f'CPU {r["cpu_s"]:8.3f} s, {r["max_rss_mb"]:8.1f} MB (estimated {r["estimate_mb"]:.0f} MB)')
+          self.records.append(r)
+    return failed == 0
+
+  def write_timings(self, path):
+    run = {
+      'time' : datetime.datetime.now().isoformat(timespec = 'seconds'),
+      'host' : platform.node(),
+      'cores' : self.cores,
+      'threads' : self.threads,
+      'memory_mb' : mb(self.memory),
+      'wall_s' : time.perf_counter() - self.start,
+      'brackets' : sorted(self.records, key = lambda r: r['output'])
+    }
+    history = []
+    if os.path.exists(path):
+      with open(path, 'r') as f:
+        history = json.load(f)
+    history.append(run)
+    with open(path, 'w') as f:
+      json.dump(history, f, indent = 2)
+    return run
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Fuse bracketed exposure series in expo-series/ to fused/ with concurrent enfuse runs."
+  )
+
+  parser.add_argument('-s', '--source', type=str, default='expo-series', help='Source image directory (default: expo-series)')
+  parser.add_argument('-o', '--output-dir', type=str, default='fused', help='Output directory (default: fused)')
+  parser.add_argument('-j', '--cores', type=int, default=os.cpu_count(), help='Core budget (default: number of CPUs)')
+  parser.add_argument('-t', '--threads', type=int, default=1, help='Cores (OpenMP threads) per enfuse run (default: 1)')
+  parser.add_argument('-m', '--memory', type=float, help='Memory budget in MB (default: available memory)')
+  parser.add_argument('--job-memory', type=float, help='Memory of one enfuse run in MB (default: estimated)')
+  parser.add_argument('--max-gap', type=float, default=2.0, help='Largest capture time gap within a bracket in seconds (default: 2.0)')
+  parser.add_argument('--count', type=int, help='Group this many files by sorted name instead of by EXIF')
+  parser.add_argument('--min-frames', type=int, default=2, help='Smaller brackets are not fused (default: 2)')
+  parser.add_argument('--enfuse-args', type=str, default='--compression 0', help='enfuse options (default: "--compression 0")')
+  parser.add_argument('-c', '--catalog', type=str, default=mediacatalog.default_path, help=f'Media catalog file (default: {mediacatalog.default_path})')
+  parser.add_argument('--dry-run', action='store_true', help='Only print the brackets')
+
+  args = parser.parse_args()
+
+  if not os.path.isdir(args.source):
+    raise Exception(f'Source directory "{args.source}" not found')
+  if not args.dry_run and shutil.which('enfuse') is None:
+    raise Exception('enfuse not found')
+
+  print(f'Read {args.source}/')
+  with mediacatalog.MediaCatalog(args.catalog) as catalog:
+    frames = source_frames(catalog, args.source, args.cores)
+  brackets = group_brackets(frames, args.max_gap, args.count)
+  usual = usual_size(brackets)
+  print(f'{len(frames)} frames in {len(brackets)} brackets, usually {usual} frames')
+  for i, b in enumerate(brackets):
+    if args.dry_run or len(b) != usual:
+      t = b[0]['time'].isoformat(sep = ' ') if b[0]['time'] else '-'
+      exposures = ' '.join(f'{f["exposure"]:g}' if f['exposure'] is not None else '?' for f in b)
+      print(f'  bracket {i + 1:5d}: {len(b)} frames, {t}, exposures {exposures}' + ('' if len(b) == usual else '  (incomplete)'))
+  if args.dry_run:
+    return
+
+  os.makedirs(args.output_dir, exist_ok = True)
+  memory = args.memory * 1024 * 1024 if args.memory else available_memory()
+  scheduler = Scheduler(args.output_dir, args.enfuse_args.split(), max(1, args.cores), max(1, args.threads), memory,
+    args.job_memory * 1024 * 1024 if args.job_memory else None)
+  print(f'Fuse with {max(1, args.cores)} cores, {max(1, args.threads)} per enfuse run, memory budget {mb(memory):.0f} MB')
+
+  ok = False
+  try:
+    ok = scheduler.run(brackets, args.min_frames)
+  finally:
+    # also after Ctrl-C: the timings of the finished brackets are kept
+    timings = os.path.join(args.output_dir, timings_name)
+    run = scheduler.write_timings(timings)
+    fused = sum(r['status'] == 'fused' for r in run['brackets'])
+    print(f'{"All done" if ok else "NOT COMPLETE"}: {fused} brackets fused, {run["wall_s"]:.3f} s; timings appended to {timings}')
+  if not ok:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
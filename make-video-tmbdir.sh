@@ -63,6 +63,9 @@ done
 # see http://stackoverflow.com/questions/592620/check-if-a-program-exists-from-a-bash-script
 command -v ffprobe >/dev/null 2>&1 || { echo >&2 "ffprobe not found"; exit 1; }
 command -v ffmpeg >/dev/null 2>&1 || { echo >&2 "ffmpeg not found"; exit 1; }
+command -v python3 >/dev/null 2>&1 || { echo >&2 "python3 not found"; exit 1; }
+MEDIA_CATALOG="$(dirname "$(readlink -f "$0")")/media-catalog.py"
+[ -f "${MEDIA_CATALOG}" ] || { echo >&2 "${MEDIA_CATALOG} not found"; exit 1; }
 
 
 PWD=$(pwd)
@@ -79,6 +82,9 @@ TDIRCRF28="../"$(basename "${PWD}")"-h264-crf28-a192"
 TDIRCRF30="../"$(basename "${PWD}")"-h264-crf30-a192"
 TDIRCRF32="../"$(basename "${PWD}")"-h264-crf32-a192"
 
+# probe new or changed videos in parallel; the loop below reads the stream details from the catalog
+"${MEDIA_CATALOG}" --kind video
+
 
 find -wholename "*.MTS" -or -wholename "*.mov" -or -wholename "*.MOV" -or -wholename "*.mp4" -or -wholename "*.MP4" -or -wholename "*.avi" | while read infile
 do
@@ -115,9 +121,9 @@ do
 
 
     echo
-    echo "Launch ffprobe on file"
+    echo "Stream details from the media catalog"
     echo
-    probe=`ffprobe -v error -of flat=s=_ -show_entries stream=width,height,r_frame_rate,codec_long_name,duration,sample_rate,codec_name -i "$infile" | dos2unix`
+    probe=`"${MEDIA_CATALOG}" --flat "$infile" --entries width,height,r_frame_rate,codec_long_name,duration,sample_rate,codec_name | dos2unix`
     
     
     echo -e "$probe" | sed "s/^/    /"
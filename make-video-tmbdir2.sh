@@ -73,7 +73,7 @@ function transcode() {
             rm "$4/$5-tmp" 2> /dev/null || true
 
             # see https://superuser.com/questions/650291/how-to-get-video-duration-in-seconds
-            INFILE_DURATION=$(ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "$1")
+            INFILE_DURATION=$("${MEDIA_CATALOG}" --flat "$1" --sections format --entries duration --value | dos2unix)
 
             PERF_START_DATE=$(date)
             local T0=$(date "--date=$PERF_START_DATE" +%s)
@@ -248,6 +248,9 @@ command -v ffprobe >/dev/null 2>&1 || { echo >&2 "ERROR: ffprobe not found"; exi
 command -v ffmpeg >/dev/null 2>&1 || { echo >&2 "ERROR: ffmpeg not found"; exit 1; }
 command -v dos2unix >/dev/null 2>&1 || { echo >&2 "ERROR: dos2unix not found"; exit 1; }
 command -v jq >/dev/null 2>&1 || { echo >&2 "ERROR: jq not found"; exit 1; }
+command -v python3 >/dev/null 2>&1 || { echo >&2 "ERROR: python3 not found"; exit 1; }
+MEDIA_CATALOG="$(dirname "$(readlink -f "$0")")/media-catalog.py"
+[ -f "${MEDIA_CATALOG}" ] || { echo >&2 "ERROR: ${MEDIA_CATALOG} not found"; exit 1; }
 
 
 # Collect machine specific info for performance log
@@ -326,6 +329,9 @@ fi
 
 TDIRPREFIX="../"$(basename "${PWD}")
 
+# probe new or changed videos in parallel; the loop below reads the stream details from the catalog
+"${MEDIA_CATALOG}" --kind video
+
 find -wholename "*.MTS" -or -wholename "*.mov" -or -wholename "*.MOV" -or -wholename "*.mp4" -or -wholename "*.MP4" -or -wholename "*.avi" -or -wholename "*.wmv" -or -wholename "*.mpg"  | while read infile
 do
     dir=$(dirname "$infile")
@@ -368,9 +374,9 @@ do
 
 
     echo
-    echo "Launch ffprobe on file"
+    echo "Stream details from the media catalog"
     echo
-    probe=`ffprobe -v error -of flat=s=_ -show_entries stream=width,height,r_frame_rate,codec_name,codec_long_name,duration,sample_rate,codec_name,sample_aspect_ratio,display_aspect_ratio -i "$infile" | dos2unix`
+    probe=`"${MEDIA_CATALOG}" --flat "$infile" --entries width,height,r_frame_rate,codec_name,codec_long_name,duration,sample_rate,sample_aspect_ratio,display_aspect_ratio | dos2unix`
 
 
     echo -e "$probe" | sed "s/^/    /"
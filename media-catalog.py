@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import shutil
+import sys
+import time
+
+import mediacatalog
+
+'''
+Scan the pictures and videos under the current directory into the SQLite media catalog and query it
+
+ - Default: incremental scan, only new or changed files are probed (in parallel), then a summary
+ - --list prints the catalog rows
+ - --json FILE prints the stored ffprobe JSON of a video (as the former FILE.info.json of
+   collect-video-info.sh) or the EXIF fields of a picture
+ - --flat FILE prints ffprobe -of flat=s=_ style lines for eval in shell scripts, e.g.
+
+     eval "$(media-catalog.py --flat "$infile" --entries width,height,r_frame_rate)"
+
+   with --value only the plain values, e.g.
+
+     media-catalog.py --flat "$infile" --sections format --entries duration --value
+
+--json and --flat do not scan the tree: the file is probed on the spot if the catalog has no
+current row of it.
+
+Launch with -h to print CLI help
+'''
+
+def print_rows(rows):
+  for r in rows:
+    dims = f'{r["width"]}x{r["height"]}' if r['width'] else '-'
+    extra = r['error'] if r['error'] else (f'{r["duration"]:.2f} s' if r['duration'] is not None else '')
+    print(f'{r["kind"]:5s}  {r["size"]:12d}  {dims:>11s}  {r["taken"] or "-":26s}  {r["path"]}' + (f'  {extra}' if extra else ''))
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Incremental SQLite catalog of the pictures and videos under the current directory."
+  )
+
+  parser.add_argument('-c', '--catalog', type=str, default=mediacatalog.default_path, help=f'Catalog file, at the root of the cataloged tree (default: {mediacatalog.default_path})')
+  parser.add_argument('-k', '--kind', choices=['all', 'image', 'video'], default='all', help='Files to scan and list (default: all)')
+  parser.add_argument('-j', '--jobs', type=int, default=None, help='Parallel probes (default: number of CPUs)')
+  parser.add_argument('--no-scan', action='store_true', help='Query only, do not scan the tree')
+  parser.add_argument('--list', action='store_true', help='Print the catalog rows')
+  parser.add_argument('--json', type=str, metavar='FILE', help='Print the ffprobe JSON of a video or the EXIF of a picture')
+  parser.add_argument('--flat', type=str, metavar='FILE', help='Print ffprobe flat=s=_ lines of a video')
+  parser.add_argument('--sections', type=str, default='streams', help='Comma separated sections printed by --flat: streams, format (default: streams)')
+  parser.add_argument('--value', action='store_true', help='--flat prints plain values without keys and quotes')
+  parser.add_argument('--entries', type=str, help='Comma separated entries printed by --flat (default: all)')
+
+  args = parser.parse_args()
+
+  with mediacatalog.MediaCatalog(args.catalog) as catalog:
+    if args.json or args.flat:
+      row = catalog.lookup(args.json or args.flat)
+      if row is None:
+        raise Exception(f'Not a picture or video file: {args.json or args.flat}')
+      if row['error']:
+        print(f'Probe failed: {row["error"]}', file = sys.stderr)
+        sys.exit(1)
+      if args.json:
+        if row['kind'] == 'video':
+          print(json.dumps(mediacatalog.row_probe(row), indent = 4))
+        else:
+          print(json.dumps(dict(mediacatalog.row_exif(row)), indent = 4))
+      else:
+        entries = set(args.entries.split(',')) if args.entries else None
+        print('\n'.join(mediacatalog.flat_lines(mediacatalog.row_probe(row), args.sections.split(','), entries, args.value)))
+      return
+
+    kinds = ('image', 'video') if args.kind == 'all' else (args.kind,)
+    scan_kinds = kinds
+    if not args.no_scan and 'video' in kinds and shutil.which('ffprobe') is None:
+      if args.kind == 'video':
+        print('ffprobe not found', file = sys.stderr)
+        sys.exit(1)
+      print('WARNING: ffprobe not found, scan pictures only', file = sys.stderr)
+      scan_kinds = ('image',)
+    if not args.no_scan:
+      t = time.perf_counter()
+      print(f'Scan {catalog.root} into {args.catalog}')
+      counts = catalog.scan(scan_kinds, args.jobs, print)
+      print(f'Catalog up to date: {counts["files"]} files, {counts["probed"]} probed, {counts["removed"]} removed, '
+        f'{counts["errors"]} failed, {time.perf_counter() - t:.3f} s')
+
+    if args.list:
+      print_rows(r for kind in kinds for r in catalog.files(kind))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,386 @@
+'''
+SQLite media catalog of pictures and videos under a directory
+
+One catalog file (default media-catalog.sqlite) at the root of the tree it describes, paths are
+relative to that directory:
+ - files: path, kind (image / video), size, mtime, dimensions, capture time, EXIF exposure values,
+   video duration, the EXIF fields (JSON list of name, value pairs) and the full ffprobe JSON output
+   (same content as the former <video>.info.json files of collect-video-info.sh)
+ - streams: one row per ffprobe stream (codec, dimensions, frame rate, sample rate, duration)
+
+Scans are incremental: the tree is walked with a single stat per file, only new files and files
+whose size or mtime changed are probed; rows of deleted files are dropped. Probes run in a process
+pool (Pillow header and EXIF reads for images, ffprobe for videos). Failed probes are recorded and
+not repeated until the file changes.
+
+Lookups of single files (lookup) check the file against its row and probe it on the spot if it is
+missing or stale, so scripts can query a catalog that was not scanned lately.
+
+The catalog uses WAL journaling: page builder, thumbnail and transcoding scripts can read it while
+another scan runs.
+'''
+
+import concurrent.futures
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+# See https://pillow.readthedocs.io/en/latest/installation/basic-installation.html
+from PIL import ExifTags, Image, TiffImagePlugin
+
+default_path = 'media-catalog.sqlite'
+
+# Panoramas are much larger than the decompression bomb limit
+Image.MAX_IMAGE_PIXELS = None
+
+image_extensions = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+video_extensions = ('.mts', '.mov', '.mp4', '.avi', '.wmv', '.mpg', '.mpeg', '.flv')
+
+# Rows committed at once during a scan; an interrupted scan keeps the committed rows
+commit_batch = 200
+
+SCHEMA = '''
+create table if not exists files (
+  path text primary key,
+  kind text not null,
+  size integer not null,
+  mtime_ns integer not null,
+  width integer,
+  height integer,
+  orientation integer,
+  taken text,
+  exposure_time real,
+  exposure_bias real,
+  duration real,
+  exif text,
+  probe text,
+  error text,
+  scanned text not null
+);
+create index if not exists files_kind on files (kind, path);
+create table if not exists streams (
+  path text not null references files (path) on delete cascade,
+  idx integer not null,
+  codec_type text,
+  codec_name text,
+  width integer,
+  height integer,
+  r_frame_rate text,
+  sample_rate integer,
+  duration real,
+  primary key (path, idx)
+);
+'''
+
+FILE_COLUMNS = ('path', 'kind', 'size', 'mtime_ns', 'width', 'height', 'orientation', 'taken',
+  'exposure_time', 'exposure_bias', 'duration', 'exif', 'probe', 'error', 'scanned')
+
+STREAM_COLUMNS = ('path', 'idx', 'codec_type', 'codec_name', 'width', 'height', 'r_frame_rate',
+  'sample_rate', 'duration')
+
+def media_kind(path):
+  ext = os.path.splitext(path)[1].lower()
+  if ext in image_extensions:
+    return 'image'
+  if ext in video_extensions:
+    return 'video'
+  return None
+
+def walk(root, kinds):
+  '''
+  {relative path: (kind, size, mtime_ns)} of the media files under root
+  '''
+  ret = {}
+  stack = ['']
+  while stack:
+    rel = stack.pop()
+    with os.scandir(os.path.join(root, rel)) as entries:
+      for e in entries:
+        path = os.path.join(rel, e.name)
+        if e.is_dir(follow_symlinks = False):
+          stack.append(path)
+          continue
+        kind = media_kind(e.name)
+        if kind in kinds and e.is_file():
+          st = e.stat()
+          ret[path] = (kind, st.st_size, st.st_mtime_ns)
+  return ret
+
+def exif_value(value):
+  '''
+  EXIF value as printed by ImageMagick: rationals as n/d, sequences comma separated; None for binary data
+  '''
+  if isinstance(value, TiffImagePlugin.IFDRational):
+    return f'{value.numerator}/{value.denominator}'
+  if isinstance(value, tuple):
+    items = [exif_value(v) for v in value]
+    return None if None in items else ', '.join(items)
+  if isinstance(value, bytes):
+    return None
+  if isinstance(value, str):
+    return value.replace('\0', '').strip()
+  return str(value)
+
+def exif_fields(img):
+  '''
+  (name, value) pairs of the EXIF header: IFD0, Exif and GPS IFDs, thumbnail IFD1 entries prefixed by
+  thumbnail-
+  '''
+  exif = img.getexif()
+  sections = [
+    ('', dict(exif), ExifTags.TAGS),
+    ('', exif.get_ifd(ExifTags.IFD.Exif), ExifTags.TAGS),
+    ('', exif.get_ifd(ExifTags.IFD.GPSInfo), ExifTags.GPSTAGS),
+    ('thumbnail-', exif.get_ifd(ExifTags.IFD.IFD1), ExifTags.TAGS)
+  ]
+  ret = []
+  for prefix, tags, names in sections:
+    for tag, value in tags.items():
+      name = names.get(tag)
+      if name is None or tag in (ExifTags.IFD.Exif, ExifTags.IFD.GPSInfo):
+        continue
+      value = exif_value(value)
+      if value is not None:
+        ret.append((prefix + name, ' '.join(value.split())))
+  return ret
+
+def exif_number(fields, name):
+  value = fields.get(name)
+  if not value:
+    return None
+  try:
+    n, _, d = value.partition('/')
+    return float(n) / float(d) if d else float(n)
+  except (ValueError, ZeroDivisionError):
+    return None
+
+def exif_time(fields):
+  '''
+  Capture time as ISO text (with fractional seconds if recorded) from DateTimeOriginal or DateTime
+  '''
+  for name, subsec in (('DateTimeOriginal', 'SubsecTimeOriginal'), ('DateTime', 'SubsecTime')):
+    value = fields.get(name, '')
+    try:
+      t = datetime.datetime.strptime(value, '%Y:%m:%d %H:%M:%S').isoformat(sep = ' ')
+    except ValueError:
+      continue
+    digits = fields.get(subsec, '').strip()
+    return f'{t}.{digits}' if digits.isdigit() else t
+  return None
+
+def probe_image(path):
+  with Image.open(path) as img:
+    exif = exif_fields(img)
+    fields = dict(exif)
+    return {
+      'width' : img.size[0],
+      'height' : img.size[1],
+      'orientation' : int(fields['Orientation']) if fields.get('Orientation', '').isdigit() else 1,
+      'taken' : exif_time(fields),
+      'exposure_time' : exif_number(fields, 'ExposureTime'),
+      'exposure_bias' : exif_number(fields, 'ExposureBiasValue'),
+      'exif' : json.dumps(exif)
+    }, []
+
+def probe_video(path):
+  p = subprocess.run(['ffprobe', '-of', 'json', '-v', 'quiet', '-show_format', '-show_streams', '-show_programs',
+    '-show_chapters', '-i', path], stdin = subprocess.DEVNULL, capture_output = True)
+  if p.returncode != 0:
+    raise Exception(f'ffprobe failed with exit code {p.returncode}')
+  probe = json.loads(p.stdout)
+  fmt = probe.get('format', {})
+  streams = probe.get('streams', [])
+  video = next((s for s in streams if s.get('codec_type') == 'video'), {})
+  number = lambda d, k, t: t(d[k]) if k in d and d[k] not in ('', 'N/A') else None
+  taken = fmt.get('tags', {}).get('creation_time')
+  return {
+    'width' : video.get('width'),
+    'height' : video.get('height'),
+    'taken' : taken.replace('T', ' ').rstrip('Z') if taken else None,
+    'duration' : number(fmt, 'duration', float),
+    'probe' : json.dumps(probe)
+  }, [(s.get('index', i), s.get('codec_type'), s.get('codec_name'), s.get('width'), s.get('height'),
+    s.get('r_frame_rate'), number(s, 'sample_rate', int), number(s, 'duration', float)) for i, s in enumerate(streams)]
+
+def probe_file(root, path, kind, size, mtime_ns):
+  '''
+  files row and streams rows of a file; probe errors are recorded in the row. A missing ffprobe is
+  no error of the file: such a row is flagged 'retry' and not stored.
+  '''
+  row = dict.fromkeys(FILE_COLUMNS)
+  row.update(path = path, kind = kind, size = size, mtime_ns = mtime_ns,
+    scanned = datetime.datetime.now().isoformat(sep = ' ', timespec = 'seconds'))
+  streams = []
+  if kind == 'video' and shutil.which('ffprobe') is None:
+    row.update(error = 'ffprobe not found', retry = True)
+    return row, streams
+  try:
+    values, streams = (probe_image if kind == 'image' else probe_video)(os.path.join(root, path))
+    row.update(values)
+  except Exception as e:
+    row['error'] = str(e) if type(e) is Exception else f'{type(e).__name__}: {e}'
+  return row, [(path,) + s for s in streams]
+
+def probe_batch(root, items):
+  return [probe_file(root, *item) for item in items]
+
+class MediaCatalog:
+  '''
+  Catalog of the media files under the directory of the catalog file
+  '''
+
+  def __init__(self, path = default_path):
+    self.path = path
+    self.root = os.path.dirname(os.path.abspath(path))
+    self.db = sqlite3.connect(path, timeout = 60)
+    self.db.row_factory = sqlite3.Row
+    self.db.execute('pragma journal_mode = wal')
+    self.db.execute('pragma synchronous = normal')
+    self.db.execute('pragma foreign_keys = on')
+    self.db.executescript(SCHEMA)
+
+  def close(self):
+    self.db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def relpath(self, path):
+    '''
+    Catalog key of a path given relative to the current directory
+    '''
+    return os.path.relpath(os.path.abspath(path), self.root)
+
+  def store(self, results):
+    with self.db:
+      for row, streams in results:
+        if row.get('retry'):
+          continue
+        self.db.execute('delete from files where path = ?', (row['path'],))
+        self.db.execute(f'insert into files ({", ".join(FILE_COLUMNS)}) values ({", ".join("?" * len(FILE_COLUMNS))})',
+          [row[c] for c in FILE_COLUMNS])
+        self.db.executemany(f'insert into streams ({", ".join(STREAM_COLUMNS)}) values ({", ".join("?" * len(STREAM_COLUMNS))})', streams)
+
+  def scan(self, kinds = ('image', 'video'), jobs = None, log = None):
+    '''
+    Bring the rows of the given kinds up to date with the tree; returns
+    {'files', 'probed', 'removed', 'errors'} counts. Rows of failed probes are probed again.
+    '''
+    files = walk(self.root, kinds)
+    rows = self.db.execute(f'select path, kind, size, mtime_ns, error from files where kind in ({", ".join("?" * len(kinds))})', kinds).fetchall()
+    known = { r['path'] : (r['kind'], r['size'], r['mtime_ns']) for r in rows if not r['error'] }
+
+    removed = [r['path'] for r in rows if r['path'] not in files]
+    with self.db:
+      self.db.executemany('delete from files where path = ?', [(p,) for p in removed])
+
+    todo = sorted((p,) + v for p, v in files.items() if known.get(p) != v)
+    if log:
+      log(f'{len(files)} files, {len(todo)} new or changed, {len(removed)} removed')
+
+    errors = 0
+    done = 0
+    if todo:
+      batches = [todo[i:i + 16] for i in range(0, len(todo), 16)]
+      pending = []
+      with concurrent.futures.ProcessPoolExecutor(max_workers = max(1, jobs or os.cpu_count())) as executor:
+        for results in executor.map(probe_batch, [self.root] * len(batches), batches):
+          pending.extend(results)
+          done = done + len(results)
+          for row, _ in results:
+            if row['error']:
+              errors = errors + 1
+              if log:
+                log(f'  {row["path"]}: {row["error"]}')
+          if len(pending) >= commit_batch:
+            self.store(pending)
+            pending = []
+            if log:
+              log(f'  {done} / {len(todo)} probed')
+        self.store(pending)
+    return { 'files' : len(files), 'probed' : len(todo), 'removed' : len(removed), 'errors' : errors }
+
+  def lookup(self, path):
+    '''
+    Row of a file (path relative to the current directory), probed now if missing, stale or failed;
+    None if the file does not exist or is no media file
+    '''
+    key = self.relpath(path)
+    kind = media_kind(key)
+    if kind is None or not os.path.isfile(path):
+      return None
+    st = os.stat(path)
+    row = self.db.execute('select * from files where path = ?', (key,)).fetchone()
+    if row is None or row['error'] or (row['size'], row['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+      probed = probe_file(self.root, key, kind, st.st_size, st.st_mtime_ns)
+      if probed[0].get('retry'):
+        return probed[0]
+      self.store([probed])
+      row = self.db.execute('select * from files where path = ?', (key,)).fetchone()
+    return row
+
+  def files(self, kind = None, prefix = None):
+    '''
+    Rows ordered by path, optionally of one kind and / or under a directory (catalog relative)
+    '''
+    sql = 'select * from files where 1'
+    params = []
+    if kind:
+      sql += ' and kind = ?'
+      params.append(kind)
+    if prefix:
+      sql += ' and path like ? escape \'\\\''
+      params.append(prefix.rstrip('/').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%')
+    return self.db.execute(sql + ' order by path', params).fetchall()
+
+  def streams(self, path):
+    return self.db.execute('select * from streams where path = ? order by idx', (path,)).fetchall()
+
+def row_exif(row):
+  '''
+  EXIF (name, value) pairs of a files row
+  '''
+  return [tuple(f) for f in json.loads(row['exif'])] if row['exif'] else []
+
+def row_probe(row):
+  '''
+  ffprobe JSON output of a files row as dict
+  '''
+  return json.loads(row['probe']) if row['probe'] else {}
+
+def flat_escape(value):
+  # ffprobe flat writer escaping, safe for shell eval
+  for c in '\\"`$':
+    value = value.replace(c, '\\' + c)
+  return value.replace('\n', '\\n').replace('\r', '\\r')
+
+def flat_lines(probe, sections = ('streams',), entries = None, nokey = False):
+  '''
+  Lines like ffprobe -of flat=s=_ of the given sections (streams, format) of a probe dict, restricted
+  to the given entries if set; with nokey plain values like ffprobe -of default=noprint_wrappers=1:nokey=1
+  '''
+  ret = []
+  def emit(prefix, d):
+    for k, v in d.items():
+      key = f'{prefix}_{"".join(c if c.isalnum() else "_" for c in k)}'
+      if isinstance(v, dict):
+        emit(key, v)
+      else:
+        if isinstance(v, bool):
+          v = int(v)
+        if nokey:
+          ret.append(str(v))
+        else:
+          ret.append(f'{key}={v}' if isinstance(v, (int, float)) else f'{key}="{flat_escape(str(v))}"')
+  for section in sections:
+    if section == 'streams':
+      for i, s in enumerate(probe.get('streams', [])):
+        emit(f'streams_stream_{i}', { k : v for k, v in s.items() if entries is None or k in entries })
+    elif section in probe:
+      emit(section, { k : v for k, v in probe[section].items() if entries is None or k in entries })
+  return ret
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+import ptofile
+from panogeometry import image_caps, overlapping_caps, overlapping_images
+
+'''
+Overlapping image pairs of a roughly aligned PTO (re-optimization run, prealigned project)
+
+ - Image footprints are projected with the show-pano-layout.py geometry
+ - Bounding caps of the footprints are put into a grid on the sphere (latitude bands split into
+   about equal area cells); only caps sharing a cell are compared, close to O(n log n) instead of
+   all n * (n - 1) / 2 pairs
+ - Candidate pairs are confirmed by sampling the outline and an inner grid of one image in the other
+
+Output is one "i j" line per overlapping pair (image indices of the PTO, i < j), optionally JSON with
+timings. cpfind has no pair list input; the pairs limit matching in two ways:
+ - --match OUTPUT runs cpfind on the listed pairs only: keypoints are detected once per image
+   (cpfind --kall into a keypoint cache), then one cpfind run per pair matches a two image
+   sub-project from the cache (-j runs in parallel). The found control points are added to the
+   input project. This is what cuts matching time compared to cpfind --multirow on all pairs.
+ - --prune drops control points between non overlapping images from an existing cpfind result; it
+   does not save any matching time
+
+pano-smaller.sh runs cpfind on a fresh pto_gen project without positions, so there the pairs are
+not known yet; use --match on re-optimization runs or prealigned projects.
+
+Launch with -h to print CLI help
+'''
+
+def find_pairs(images, margin, cell_deg = None, points = 8, inner = 3):
+  '''
+  Overlapping image index pairs and (cap candidates, timings) details
+  '''
+  t = time.perf_counter()
+  centers, radii = image_caps(images, points, margin)
+  t_caps = time.perf_counter()
+  candidates = overlapping_caps(centers, radii, cell_deg)
+  t_index = time.perf_counter()
+  pairs = overlapping_images(images, candidates, points, inner, margin)
+  t_confirm = time.perf_counter()
+  return pairs, {
+    'candidates' : len(candidates),
+    'seconds' : {
+      'caps' : t_caps - t,
+      'index' : t_index - t_caps,
+      'confirm' : t_confirm - t_index
+    }
+  }
+
+def prune_control_points(pto, pairs):
+  '''
+  Drop control points between images which do not overlap; line control points (t > 0) and points
+  within one image are kept. Returns the number of dropped points.
+  '''
+  cps = pto.control_points
+  n = len(pto.images)
+  i = np.minimum(cps['n'], cps['N']).astype(np.int64)
+  j = np.maximum(cps['n'], cps['N']).astype(np.int64)
+  keep = (cps['t'] > 0) | (i == j) | np.isin(i * n + j, pairs[:, 0] * n + pairs[:, 1])
+  pto.control_points = cps[keep]
+  return int((~keep).sum())
+
+def pair_pto(pto, i, j, base_dir, path):
+  '''
+  Write a two image sub-project of images i and j; image names are made absolute, links resolved
+  '''
+  with open(path, 'w') as f:
+    f.write('p ' + ' '.join(ptofile.format_token(*t) for t in pto.pano_tokens) + '\n')
+    for k in (i, j):
+      row = pto.images[k]
+      values = ' '.join(f'{key}{ptofile.format_number(row[key])}' for key in ptofile.IMAGE_DTYPE.names)
+      f.write(f'i {values} n"{os.path.join(base_dir, pto.names[k])}"\n')
+
+def run_cpfind(args, env = None):
+  p = subprocess.run(['cpfind'] + args, capture_output = True, text = True, env = env)
+  if p.returncode != 0:
+    raise Exception(f'cpfind {" ".join(args)} exited with code {p.returncode}:\n' + (p.stdout + p.stderr)[-2000:])
+
+def match_pairs(pto, input_path, pairs, jobs, cpfind_args):
+  '''
+  Add control points found by cpfind on the listed pairs only; returns (found points, timings)
+  '''
+  base_dir = os.path.dirname(os.path.abspath(input_path))
+  with tempfile.TemporaryDirectory(prefix = 'pano-overlap-pairs-') as tmp:
+    keys = os.path.join(tmp, 'keys')
+    os.makedirs(keys)
+    t = time.perf_counter()
+    run_cpfind(['--kall', '--keypath', keys, '-o', os.path.join(tmp, 'keypoints.pto'), input_path])
+    t_keys = time.perf_counter()
+
+    # pair runs are small; run them side by side with one thread each instead
+    env = dict(os.environ, OMP_NUM_THREADS = '1') if jobs > 1 else None
+    def match(pair):
+      i, j = pair
+      name = os.path.join(tmp, f'pair-{i}-{j}')
+      pair_pto(pto, i, j, base_dir, name + '.pto')
+      run_cpfind(cpfind_args + ['--cache', '--keypath', keys, '-o', name + '-cp.pto', name + '.pto'], env)
+      cps = ptofile.load(name + '-cp.pto').control_points
+      cps = cps[cps['n'] != cps['N']]
+      index = np.array([i, j], dtype = np.int32)
+      cps['n'] = index[cps['n']]
+      cps['N'] = index[cps['N']]
+      return cps
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, jobs)) as executor:
+      found = list(executor.map(match, pairs.tolist()))
+    t_match = time.perf_counter()
+
+  found = np.concatenate(found) if found else np.zeros(0, dtype = ptofile.CONTROL_POINT_DTYPE)
+  if not any(kind == 'c' for kind, value in pto.layout):
+    pto.layout.append(('c', None))
+  pto.control_points = np.concatenate((pto.control_points, found))
+  return len(found), { 'keypoints' : t_keys - t, 'match' : t_match - t_keys }
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="List overlapping image pairs of a roughly aligned PTO project."
+  )
+
+  parser.add_argument('-i', '--input',  type=str, required=True, help='Input PTO file (required).')
+  parser.add_argument('-o', '--output', type=str, help='Output pair list, one "i j" line per pair (default: standard output)')
+  parser.add_argument('--json', type=str, help='Write pairs, counts and timings to a JSON file')
+  parser.add_argument('--margin', type=float, default=0.1, help='Grow image footprints by this fraction of the image size; rough positions may be off (default: 0.1)')
+  parser.add_argument('--cell', type=float, help='Index cell size in degrees (default: median image footprint diameter)')
+  parser.add_argument('--match', type=str, help='Run cpfind on the overlapping pairs only and write the input PTO with the found control points added to this file')
+  parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Parallel cpfind pair runs of --match (default: number of CPUs)')
+  parser.add_argument('--cpfind-args', type=str, default='', help='Extra cpfind arguments of the --match pair runs, e.g. "--fullscale" (default: none)')
+  parser.add_argument('--prune', type=str, help='Write the input PTO without control points between non overlapping images to this file; does not save matching time')
+  parser.add_argument('--brute-force', action='store_true', help='Also test all pairs and report differences (slow, for verification)')
+
+  args = parser.parse_args()
+
+  t0 = time.perf_counter()
+  pto = ptofile.load(args.input)
+  t_load = time.perf_counter() - t0
+  n = len(pto.images)
+
+  pairs, details = find_pairs(pto.images, args.margin, args.cell)
+  details['seconds'] = { 'load' : t_load, **details['seconds'] }
+
+  all_pairs = n * (n - 1) // 2
+  print(f'{n} images, {all_pairs} possible pairs, {details["candidates"]} candidates, {len(pairs)} overlapping pairs; '
+    + ', '.join(f'{k} {v:.3f} s' for k, v in details['seconds'].items()), file = sys.stderr)
+
+  if args.brute_force:
+    t = time.perf_counter()
+    i, j = np.triu_indices(n, 1)
+    expected = overlapping_images(pto.images, np.stack((i, j), axis = -1), margin = args.margin)
+    found = set(map(tuple, pairs.tolist()))
+    expected = set(map(tuple, expected.tolist()))
+    print(f'Brute force: {len(expected)} overlapping pairs in {time.perf_counter() - t:.3f} s; '
+      f'missed: {sorted(expected - found)}, extra: {sorted(found - expected)}', file = sys.stderr)
+
+  lines = ''.join(f'{i} {j}\n' for i, j in pairs.tolist())
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(lines)
+  else:
+    sys.stdout.write(lines)
+
+  if args.match:
+    found, seconds = match_pairs(pto, args.input, pairs, args.jobs, args.cpfind_args.split())
+    details['seconds'].update(seconds)
+    print(f'cpfind on {len(pairs)} pairs: {found} control points; keypoints {seconds["keypoints"]:.3f} s, '
+      f'matching {seconds["match"]:.3f} s, write {args.match}', file = sys.stderr)
+    ptofile.save(pto, args.match)
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump({
+        'pto' : args.input,
+        'images' : n,
+        'all_pairs' : all_pairs,
+        'margin' : args.margin,
+        **details,
+        'pairs' : pairs.tolist()
+      }, f, indent = 2)
+
+  if args.prune:
+    dropped = prune_control_points(pto, pairs)
+    print(f'Dropped {dropped} of {dropped + len(pto.control_points)} control points, write {args.prune}', file = sys.stderr)
+    ptofile.save(pto, args.prune)
+
+if __name__ == '__main__':
+  main()
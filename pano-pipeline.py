@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+'''
+Python runner of the pano-smaller.sh workflow with a content hashed stage cache
+
+Same stages and file names as pano-smaller.sh (sources/pano-NN-*.pto, layout / preview next to the
+final PTO, workfiles/p1-*): pto_gen, canvas, cpfind, celeste, cpclean, anchor, pairwise / geometry
+optimization, final canvas and crop, then the layout chart, the quick preview and nona / enblend /
+JPG conversion.
+
+ - Each stage is keyed by a hash of its command line (tool options and paths) and the digests of
+   its inputs: source image contents, outputs of the stages it depends on, the Python scripts it
+   runs. A stage runs again only if its key differs from the one recorded in pano-pipeline.json or
+   one of its outputs is missing or was changed since. Stages whose tools read pixels (cpfind,
+   celeste, preview, nona) digest the source images directly.
+ - PTO outputs are digested by content: a re-run stage producing the same PTO does not invalidate
+   later stages. Large outputs (TIFFs) are digested by their stage key.
+ - Independent stages run concurrently (-j), e.g. the layout chart and the preview next to nona.
+ - Per stage wall time, CPU time and peak memory of the tool process are appended to
+   pano-pipeline-timings.json; tool output goes to pano.log like with pano-smaller.sh.
+
+Use --adopt once in a directory processed by pano-smaller.sh to record the existing outputs as up to
+date instead of running everything again.
+
+Launch with -h to print CLI help
+'''
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+manifest_path = 'pano-pipeline.json'
+timings_path = 'pano-pipeline-timings.json'
+log_path = 'pano.log'
+
+# Read size of content hashing
+hash_block = 1 << 20
+
+def file_digest(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while True:
+      block = f.read(hash_block)
+      if not block:
+        break
+      h.update(block)
+  return h.hexdigest()
+
+class Stage:
+  '''
+  One step of the workflow
+
+    name:     unique short name (key in the manifest and the timings)
+    title:    human readable description
+    command:  tool command line (list); the first item is the tool
+    deps:     names of the stages whose outputs are inputs
+    outputs:  output files; or a glob pattern with outputs_glob (e.g. nona layers)
+    files:    other input files, digested by content (source images, scripts)
+    digest:   'content' to digest the outputs by content (small files), 'key' to use the stage key
+  '''
+
+  def __init__(self, name, title, command, deps = (), outputs = (), files = (), outputs_glob = None, digest = 'content'):
+    self.name = name
+    self.title = title
+    self.command = command
+    self.deps = list(deps)
+    self.outputs = list(outputs)
+    self.files = list(files)
+    self.outputs_glob = outputs_glob
+    self.digest = digest
+
+  def current_outputs(self):
+    return sorted(glob.glob(self.outputs_glob)) if self.outputs_glob else self.outputs
+
+# PTO stages keyed on the source image contents: pto_gen (names, EXIF) and the tools reading pixels.
+# The PTO of pto_gen does not change if only pixels change, so the content digest of its output can not
+# invalidate cpfind / celeste; they must digest the images themselves.
+pixel_stages = ('initial', 'cpfind', 'celeste')
+
+def source_images():
+  '''
+  Source JPGs; the preview JPG written next to the PTOs is not a source
+  '''
+  return sorted(p for p in glob.glob('sources/*.[jJ][pP][gG]') if not os.path.basename(p).startswith('pano-'))
+
+def build_stages(args, images, convert):
+  '''
+  Stages of pano-smaller.sh in order
+  '''
+  anchor = 0 if args.first_anchor else len(images) // 2
+  center = ['--center']
+  fov = ['--fov=AUTO']
+  crop = ['--crop=AUTO']
+
+  pto_steps = [
+    ('initial', 'pto-gen from source JPGs', lambda pi, po: ['pto_gen', '-o', po] + images),
+    ('initial-c', 'modify canvas size to fov 360 x 180 4k x 2k', lambda pi, po: ['pano_modify', '-o', po, '--fov=360x180', '--canvas=4000x2000', pi]),
+    ('cpfind', 'cpfind', lambda pi, po: ['cpfind', '-o', po, '--multirow', pi]),
+    ('celeste', 'celeste', lambda pi, po: ['celeste_standalone', '-i', pi, '-o', po]),
+    ('cpclean', 'cpclean', lambda pi, po: ['cpclean', '-o', po, pi]),
+    ('anchor', f'set anchor image to {anchor}', lambda pi, po: ['pto_var', '-o', po, f'--anchor={anchor}', f'--color-anchor={anchor}', pi]),
+    ('pwopted', 'do pairwise optimization', lambda pi, po: ['autooptimiser', '-p', '-o', po, pi]),
+    ('pwopted-m', 'modify: straighten, center, fov', lambda pi, po: ['pano_modify', '-o', po, '--straighten'] + center + fov + crop + [pi]),
+    ('geomopt', 'set geometry optimization', lambda pi, po: ['pto_var', '-o', po, '--opt', 'y,p,r,v,a,b,c', pi]),
+    ('geomopted', 'do geometry optimization', lambda pi, po: ['autooptimiser', '-n', '-o', po, pi]),
+    ('geomopted-m', 'modify: straighten, center, fov', lambda pi, po: ['pano_modify', '-o', po, '--straighten'] + center + fov + crop + [pi]),
+    ('final', 'set final canvas size and crop', lambda pi, po: ['pano_modify', '-o', po, '--straighten'] + center + ['--canvas=AUTO'] + fov + crop + [pi])
+  ]
+
+  stages = []
+  pi = None
+  for i, (name, title, command) in enumerate(pto_steps):
+    po = f'sources/pano-{i:02d}-{name}.pto'
+    stages.append(Stage(name, title, command(pi, po), deps = [stages[-1].name] if stages else [], outputs = [po],
+      files = images if name in pixel_stages else []))
+    pi = po
+  final = pi
+
+  # Python modules of the layout / preview scripts
+  modules = [os.path.join(script_dir, m) for m in ('ptofile.py', 'panogeometry.py')]
+
+  if not args.no_layout:
+    show_pano_layout_py = os.path.join(script_dir, 'show-pano-layout.py')
+    png = final[:-len('.pto')] + '-layout.png'
+    profile = png[:-len('.png')] + '-profile.json'
+    stages.append(Stage('layout', 'Create layout visualization', [show_pano_layout_py, '-i', final, '-o', png, '--profile', profile],
+      deps = ['final'], outputs = [png, profile], files = [show_pano_layout_py] + modules))
+
+  if not args.no_preview:
+    preview_pano_py = os.path.join(script_dir, 'preview-pano.py')
+    jpg = final[:-len('.pto')] + '-preview.jpg'
+    # the preview samples the source images
+    stages.append(Stage('preview', 'Create quick preview', [preview_pano_py, '-i', final, '-o', jpg],
+      deps = ['final'], outputs = [jpg], files = [preview_pano_py] + modules + images))
+
+  if not args.no_blend:
+    nonao = 'workfiles/p1-'
+    enblo = 'workfiles/p1-blend.tif'
+    jpg = 'workfiles/p1-blend.jpg'
+    stages.append(Stage('nona', 'Stitch with nona', ['nona', '-o', nonao, '-m', 'TIFF_m', final, '-v', '--ignore-exposure'],
+      deps = ['final'], outputs_glob = nonao + '[0-9][0-9][0-9][0-9].tif', files = images, digest = 'key'))
+    # enblend layers are listed when the stage starts, see run_stage
+    stages.append(Stage('enblend', 'Blend with enblend', ['enblend', '-v', '-o', enblo],
+      deps = ['nona'], outputs = [enblo], digest = 'key'))
+    stages.append(Stage('jpg', 'Create jpg from last stitch', [convert, enblo, '-quality', '100', jpg],
+      deps = ['enblend'], outputs = [jpg], digest = 'key'))
+  return stages
+
+class Pipeline:
+  '''
+  Stage scheduler: keys, cache lookups, concurrent runs, manifest, log and timings
+  '''
+
+  def __init__(self, stages, jobs, force = (), dry_run = False, adopt = False):
+    self.stages = { s.name : s for s in stages }
+    self.order = [s.name for s in stages]
+    self.jobs = jobs
+    self.force = set(force)
+    self.dry_run = dry_run
+    self.adopt = adopt
+    self.lock = threading.Lock()
+    self.start = time.perf_counter()
+    self.records = {}
+
+    self.manifest = { 'stages' : {}, 'files' : {} }
+    if os.path.exists(manifest_path):
+      with open(manifest_path, 'r') as f:
+        self.manifest = json.load(f)
+
+  def input_file_digest(self, path):
+    '''
+    Content digest of an input file; remembered by size and modification time so unchanged source
+    images are not read again
+    '''
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime_ns]
+    with self.lock:
+      known = self.manifest['files'].get(path)
+    if known and known['stamp'] == stamp:
+      return known['sha256']
+    digest = file_digest(path)
+    with self.lock:
+      self.manifest['files'][path] = { 'stamp' : stamp, 'sha256' : digest }
+    return digest
+
+  def command(self, stage):
+    if stage.name == 'enblend':
+      return stage.command + self.stages['nona'].current_outputs()
+    return stage.command
+
+  def key(self, stage):
+    h = hashlib.sha256()
+    h.update(json.dumps({
+      'stage' : stage.name,
+      'command' : stage.command,
+      'deps' : { d : self.manifest['stages'][d]['digest'] for d in stage.deps },
+      'files' : { f : self.input_file_digest(f) for f in stage.files }
+    }, sort_keys = True).encode())
+    return h.hexdigest()
+
+  def outputs_digest(self, stage, key):
+    outputs = stage.current_outputs()
+    if stage.digest == 'key':
+      return key
+    h = hashlib.sha256()
+    for path in outputs:
+      h.update(path.encode())
+      h.update(file_digest(path).encode())
+    return h.hexdigest()
+
+  def up_to_date(self, stage, key):
+    recorded = self.manifest['stages'].get(stage.name)
+    outputs = stage.current_outputs()
+    if not recorded or recorded['key'] != key or not outputs or not all(os.path.exists(o) for o in outputs):
+      return False
+    # changed by hand (or by an interrupted run) since
+    stamps = { o : [os.stat(o).st_size, os.stat(o).st_mtime_ns] for o in outputs }
+    return stamps == recorded['outputs']
+
+  def record(self, stage, key):
+    outputs = stage.current_outputs()
+    entry = {
+      'key' : key,
+      'digest' : self.outputs_digest(stage, key),
+      'outputs' : { o : [os.stat(o).st_size, os.stat(o).st_mtime_ns] for o in outputs },
+      'time' : datetime.datetime.now().isoformat(timespec = 'seconds')
+    }
+    with self.lock:
+      self.manifest['stages'][stage.name] = entry
+      self.save_manifest()
+
+  def save_manifest(self):
+    tmp = manifest_path + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(self.manifest, f, indent = 2)
+    os.replace(tmp, manifest_path)
+
+  def log(self, lines):
+    with self.lock:
+      with open(log_path, 'a') as f:
+        f.writelines(line + '\n' for line in lines)
+
+  def section(self, *lines):
+    ts = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    dt = int(time.perf_counter() - self.start)
+    text = ['', '', f'+--[ {ts}, {dt:5d} s ]' + '-' * 86, '|'] + [f'| {l}' for l in lines] + ['|', '+' + '-' * 120, '', '']
+    with self.lock:
+      print('\n'.join(text))
+    self.log(text)
+
+  def run_stage(self, name):
+    '''
+    Run one stage whose dependencies are done; returns its timing record
+    '''
+    stage = self.stages[name]
+    t = time.perf_counter()
+    record = { 'name' : name, 'start_s' : t - self.start }
+
+    key = self.key(stage)
+    record['key'] = key[:16]
+    if name not in self.force and self.up_to_date(stage, key):
+      record.update({ 'status' : 'cached', 'wall_s' : time.perf_counter() - t })
+      with self.lock:
+        print(f'  {name:<12} up to date ({key[:16]})')
+      return record
+
+    if self.adopt and name not in self.manifest['stages'] and stage.current_outputs() and all(os.path.exists(o) for o in stage.current_outputs()):
+      self.record(stage, key)
+      record.update({ 'status' : 'adopted', 'wall_s' : time.perf_counter() - t })
+      with self.lock:
+        print(f'  {name:<12} adopted existing outputs ({key[:16]})')
+      return record
+
+    command = self.command(stage)
+    if self.dry_run:
+      record.update({ 'status' : 'would run', 'wall_s' : 0 })
+      with self.lock:
+        print(f'  {name:<12} would run: {" ".join(command)}')
+      return record
+
+    if shutil.which(command[0]) is None:
+      raise Exception(f'Command {command[0]} not found')
+
+    self.section(stage.title, f'  pwd: {os.getcwd()}', f'  stage: {name}', f'  key: {key[:16]}', f'  command: {" ".join(command)}')
+    for path in stage.current_outputs():
+      if os.path.exists(path):
+        os.remove(path)
+    for path in stage.outputs:
+      if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+    if stage.outputs_glob:
+      os.makedirs(os.path.dirname(stage.outputs_glob), exist_ok = True)
+
+    # tool output is shown live, prefixed by the stage name; the log gets it in one block
+    lines = []
+    p = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True, errors = 'replace')
+    for line in p.stdout:
+      line = line.rstrip('\n')
+      lines.append('    ' + line)
+      with self.lock:
+        print(f'  {name:<12} | {line}')
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    self.log(lines)
+
+    record.update({
+      'wall_s' : time.perf_counter() - t,
+      'cpu_s' : usage.ru_utime + usage.ru_stime,
+      'max_rss_mb' : usage.ru_maxrss / 1024,
+      'exit_code' : p.returncode
+    })
+    if p.returncode != 0:
+      raise Exception(f'{command[0]} exited with code {p.returncode}')
+    if not stage.current_outputs():
+      raise Exception(f'{command[0]} wrote no output')
+
+    self.record(stage, key)
+    record['status'] = 'ran'
+    return record
+
+  def run(self):
+    '''
+    Run all stages, each as soon as its dependencies are done; stages depending on a failed one are
+    skipped. Returns True if all stages succeeded.
+    '''
+    pending = list(self.order)
+    running = {}
+    failed = set()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, self.jobs)) as executor:
+      while pending or running:
+        for name in list(pending):
+          deps = self.stages[name].deps
+          if any(d in failed for d in deps):
+            pending.remove(name)
+            failed.add(name)
+            self.records[name] = { 'name' : name, 'status' : 'skipped', 'start_s' : time.perf_counter() - self.start, 'wall_s' : 0 }
+            print(f'  {name:<12} skipped, depends on a failed stage')
+          elif all(d in self.records for d in deps) and len(running) < max(1, self.jobs):
+            # a dry run can not know the digests of stages it would run
+            if self.dry_run and any(self.records[d]['status'] == 'would run' for d in deps):
+              pending.remove(name)
+              self.records[name] = { 'name' : name, 'status' : 'would run', 'start_s' : 0, 'wall_s' : 0 }
+              print(f'  {name:<12} would run (inputs change)')
+              continue
+            pending.remove(name)
+            running[executor.submit(self.run_stage, name)] = name
+
+        if not running:
+          continue
+        done, _ = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          name = running.pop(future)
+          try:
+            self.records[name] = future.result()
+          except Exception as e:
+            failed.add(name)
+            self.records[name] = { 'name' : name, 'status' : 'failed', 'error' : f'{type(e).__name__}: {e}',
+              'start_s' : 0, 'wall_s' : 0 }
+            with self.lock:
+              print(f'  {name:<12} FAILED: {type(e).__name__}: {e}')
+            self.log([f'    ERROR in stage {name}: {type(e).__name__}: {e}'])
+          else:
+            self.records[name]['end_s'] = time.perf_counter() - self.start
+
+    with self.lock:
+      self.save_manifest()
+    return not failed
+
+  def write_timings(self, path):
+    run = {
+      'time' : datetime.datetime.now().isoformat(timespec = 'seconds'),
+      'host' : platform.node(),
+      'jobs' : self.jobs,
+      'wall_s' : time.perf_counter() - self.start,
+      'stages' : [self.records[name] for name in self.order if name in self.records]
+    }
+    history = []
+    if os.path.exists(path):
+      with open(path, 'r') as f:
+        history = json.load(f)
+    history.append(run)
+    with open(path, 'w') as f:
+      json.dump(history, f, indent = 2)
+    return run
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Run the pano-smaller.sh panorama workflow, re-running only stages whose inputs changed."
+  )
+
+  parser.add_argument('-j', '--jobs', type=int, default=2, help='Stages run concurrently (default: 2)')
+  parser.add_argument('-nb', '--no-blend', action='store_true', help='Skip stitching and blending final panorama')
+  parser.add_argument('-nl', '--no-layout', action='store_true', help='Skip rendering layout image')
+  parser.add_argument('-np', '--no-preview', action='store_true', help='Skip rendering quick preview image')
+  parser.add_argument('-fa', '--first-anchor', action='store_true', help='Use first image as anchor instead of the middle one')
+  parser.add_argument('--force', type=str, nargs='+', default=[], metavar='STAGE', help='Run these stages even if up to date')
+  parser.add_argument('--dry-run', action='store_true', help='Only print which stages would run')
+  parser.add_argument('--adopt', action='store_true', help='Record existing outputs of stages not in the manifest (e.g. of a pano-smaller.sh run) as up to date')
+
+  args = parser.parse_args()
+
+  convert = 'magick' if shutil.which('magick') else 'convert'
+
+  if not os.path.isdir('sources/'):
+    if args.dry_run:
+      print('No sources/ dir; all stages would run')
+      return
+    print('Create sources/ dir; move sources')
+    os.mkdir('sources/')
+    for path in glob.glob('*.[jJ][pP][gG]'):
+      shutil.move(path, 'sources/')
+
+  images = source_images()
+  if not images:
+    raise Exception('No source JPGs in sources/')
+
+  stages = build_stages(args, images, convert)
+  unknown = set(args.force) - set(s.name for s in stages)
+  if unknown:
+    parser.error(f'Unknown stages: {", ".join(sorted(unknown))}; stages: {", ".join(s.name for s in stages)}')
+
+  missing = sorted(set(s.command[0] for s in stages if shutil.which(s.command[0]) is None))
+  if missing:
+    print(f'WARNING: commands not found: {", ".join(missing)}; stages which are not up to date will fail')
+
+  pipeline = Pipeline(stages, args.jobs, args.force, args.dry_run, args.adopt)
+  pipeline.section('Prepare panorama workflow', f'    pwd: {os.getcwd()}', f'    {len(images)} source images, {len(stages)} stages, {args.jobs} concurrent')
+  ok = pipeline.run()
+  if args.dry_run:
+    return
+
+  run = pipeline.write_timings(timings_path)
+  lines = [f'{r["name"]:<12} {r["status"]:<9} {r["wall_s"]:9.3f} s' + (f', CPU {r["cpu_s"]:9.3f} s, {r["max_rss_mb"]:8.1f} MB' if 'cpu_s' in r else '')
+    for r in run['stages']]
+  pipeline.section('All done.' if ok else 'FAILED', *lines, f'Timings appended to {timings_path}')
+  if not ok:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
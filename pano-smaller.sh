@@ -24,6 +24,14 @@ if [ ! -f "$show_pano_layout_py" ] ; then
   exit 1
 fi
 
+preview_pano_py="$(dirname "$0")/preview-pano.py"
+echo
+echo -n " $preview_pano_py"
+if [ ! -f "$preview_pano_py" ] ; then
+  echo >&2 " | ERROR: script not found, exiting"
+  exit 1
+fi
+
 echo
 echo "  All commands found"
 echo
@@ -40,6 +48,7 @@ echo
 
 DOBLEND=true
 DOSHOWLAYOUT=true
+DOPREVIEW=true
 FIRSTANCHOR=false
 
 function usage {
@@ -49,6 +58,7 @@ function usage {
   echo "  -h   Print this usage and exit"
   echo "  -nb  Skip stitching and blending final panorama"
   echo "  -nl  Skip rendering layout image"
+  echo "  -np  Skip rendering quick preview image"
   echo "  -fa  Use first image as anchor instead of the middle one"
   echo
   echo
@@ -73,6 +83,11 @@ while [[ $# -gt 0 ]]; do
       echo "Will not render layout image"
       shift
       ;;
+    -np)
+      DOPREVIEW=false
+      echo "Will not render quick preview image"
+      shift
+      ;;
     -h)
       usage
       exit
@@ -276,7 +291,8 @@ if [ "$DOSHOWLAYOUT" = true ] ; then
   LAYOUT_PNG="${PO%.pto}-layout.png"
   sect "Create layout visualization" "  pwd: $(pwd)" "  input: ${PO}" "  Output: ${LAYOUT_PNG}"
   if [ -f "${LAYOUT_PNG}" ]; then echo "  Output file ${LAYOUT_PNG} exists; skipping" ; else
-    "$show_pano_layout_py" -i "${PO}" -o "${LAYOUT_PNG}"
+    # timings end up in the log as a machine readable LAYOUT_PROFILE line
+    "$show_pano_layout_py" -i "${PO}" -o "${LAYOUT_PNG}" --profile "${LAYOUT_PNG%.png}-profile.json" 2>&1 | sed -ue "s/^/    /" | tee -a "${LOG}"
   fi
 else
   echo
@@ -286,6 +302,22 @@ else
   echo
 fi
 
+if [ "$DOPREVIEW" = true ] ; then
+  PREVIEW_JPG="${PO%.pto}-preview.jpg"
+  sect "Create quick preview" "  pwd: $(pwd)" "  input: ${PO}" "  Output: ${PREVIEW_JPG}"
+  if [ -f "${PREVIEW_JPG}" ]; then echo "  Output file ${PREVIEW_JPG} exists; skipping" ; else
+    # the preview is a convenience: a failure must not stop the blend below
+    "$preview_pano_py" -i "${PO}" -o "${PREVIEW_JPG}" 2>&1 | sed -ue "s/^/    /" | tee -a "${LOG}" \
+      || echo "  WARNING: quick preview failed (exit code $?); continuing" | tee -a "${LOG}"
+  fi
+else
+  echo
+  echo
+  echo "Skipping quick preview"
+  echo
+  echo
+fi
+
 if [ "$DOBLEND" = true ] ; then
   # Final blend
   blprev "${PO}" p1
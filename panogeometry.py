@@ -0,0 +1,668 @@
+'''
+Panorama geometry shared by the layout chart and preview tools
+
+ - Image outlines to equirectangular (yaw, pitch), vectorized over all images; curvature adaptive
+   sampling with exact splitting at the +-180 degree seam for the layout chart
+ - Equirectangular directions back to image pixel coordinates (preview rendering)
+ - Image footprints on a coarse grid over the crop area (coverage statistics)
+ - Bounding caps of the footprints and a grid index on the sphere (overlapping image pairs)
+ - Control point ends to directions in bulk (control point residuals)
+ - Radial a, b, c lens distortion model
+
+Only rectilinear source lenses are supported; no image center shift (d, e), no shearing (g, t).
+Images are ptofile.IMAGE_DTYPE structured arrays (or rows).
+'''
+
+import functools
+import math
+import numpy as np
+
+def line_segments(n, x1, y1, x2, y2):
+  '''
+  n points along line segments of all images, ends are per image arrays.
+  End 1 will be included, end 2 will be excluded.
+
+  Returns an (images, n, 2) array
+  '''
+  i = np.arange(n)
+  x = x1[:, None] + i * (x2 - x1)[:, None] / n
+  y = y1[:, None] + i * (y2 - y1)[:, None] / n
+  return np.stack((x, y), axis = -1)
+
+
+def gen_rect(points, w, h):
+  '''
+  Clockwise zero centered rectangle perimeters for per image w, h arrays; (images, 4 * points, 2) array
+  '''
+  w = np.asarray(w, dtype = float)
+  h = np.asarray(h, dtype = float)
+  return np.concatenate([
+    line_segments(points, -w / 2, -h / 2,  w / 2, -h / 2),
+    line_segments(points,  w / 2, -h / 2,  w / 2,  h / 2),
+    line_segments(points,  w / 2,  h / 2, -w / 2,  h / 2),
+    line_segments(points, -w / 2,  h / 2, -w / 2, -h / 2)], axis = 1)
+
+def image_xy_to_cartesian(points, v, w):
+  '''
+  Transform image pixel coordinates (images, points, 2) to unit direction vectors (images, points, 3)
+  in the camera coordinate system: x points to the image center, y upward, z to the image x axis.
+
+  Equirectangular yaw / pitch of the unrotated image would be
+    yaw   = atan(x / d)
+    pitch = atan(y / sqrt(d * d + x * x))
+  '''
+
+  d = np.asarray(w) / (2 * np.tan(np.pi * np.asarray(v) / 360))
+  d = np.broadcast_to(d[:, None], points.shape[:-1])
+
+  ret = np.stack((d, points[..., 1], points[..., 0]), axis = -1)
+  return ret / np.linalg.norm(ret, axis = -1, keepdims = True)
+
+def rotation_matrices(yaw, pitch, roll):
+  '''
+  Stacked (images, 3, 3) rotation matrices applying roll, pitch and yaw (in this order) on camera
+  direction vectors.
+    - roll rotates around the camera axis (cartesian "x"), counterclockwise in the image
+    - pitch rotation is done around the "z" axis
+    - yaw rotation is around the vertical cartesian axis (used "y" here)
+  note that spherical coordinates to cartesian transformation is
+    cartesian_x = cos(yaw)   * cos(pitch)
+    cartesian_y = sin(pitch)
+    cartesian_z = sin(yaw)   * cos(pitch)
+  '''
+  y = np.asarray(yaw) * np.pi / 180
+  p = np.asarray(pitch) * np.pi / 180
+  r = np.asarray(roll) * np.pi / 180
+
+  one = np.ones(len(y))
+  zero = np.zeros(len(y))
+
+  r_roll = np.stack([
+    np.stack([one, zero, zero], axis = -1),
+    np.stack([zero, np.cos(r), -np.sin(r)], axis = -1),
+    np.stack([zero, np.sin(r), np.cos(r)], axis = -1)], axis = -2)
+  r_pitch = np.stack([
+    np.stack([np.cos(p), -np.sin(p), zero], axis = -1),
+    np.stack([np.sin(p), np.cos(p), zero], axis = -1),
+    np.stack([zero, zero, one], axis = -1)], axis = -2)
+  r_yaw = np.stack([
+    np.stack([np.cos(y), zero, -np.sin(y)], axis = -1),
+    np.stack([zero, one, zero], axis = -1),
+    np.stack([np.sin(y), zero, np.cos(y)], axis = -1)], axis = -2)
+
+  return r_yaw @ r_pitch @ r_roll
+
+def rotate_cartesian(points, rotations):
+  '''
+  Apply per image (images, 3, 3) rotations on (images, points, 3) vectors
+  '''
+  return np.einsum('nij,nmj->nmi', rotations, points)
+
+def cartesian_to_yaw_pitch(points):
+  '''
+  Equirectangular (yaw, pitch) degrees of unit direction vectors; yaw is 0 at zenith / nadir
+  '''
+  # values outside -1.0 .. 1.0 range (due to floating point ops) will fail arc sin
+  pitch = np.arcsin(np.clip(points[..., 1], -1, 1))
+  yaw = np.arctan2(points[..., 2], points[..., 0])
+  return np.stack((180 * yaw / np.pi, 180 * pitch / np.pi), axis = -1)
+
+class LensModel:
+  '''
+  Radial a, b, c, d lens distortion polynomial with vectorized inverse; see lens_model()
+
+    image_r = corrected_r * (a * corrected_r^3 + b * corrected_r^2 + c * corrected_r + d), d = 1 - (a + b + c)
+
+  Radii are normalized; maxd is the largest normalized image radius to be corrected (image corner).
+  An image radius is mapped to the smallest corrected radius reaching it, which is well defined for
+  non monotonic (extreme) coefficients too. Corrected radii are limited to 3 and to the one reaching
+  1.1 * maxd; larger image radii are clamped.
+  '''
+
+  # Newton iteration limit and convergence tolerance (normalized radius)
+  iterations = 50
+  tolerance = 1e-12
+
+  def __init__(self, a, b, c, maxd):
+    self.a = a
+    self.b = b
+    self.c = c
+    self.d = 1 - (a + b + c)
+    self.maxd = maxd
+
+    # monotonic intervals of the polynomial between its extrema
+    self.set_limit(3.0)
+    if self.reached[-1] > 1.1 * maxd:
+      self.set_limit(float(self.undistort(np.array([1.1 * maxd]))[0]))
+
+  def set_limit(self, max_corrected):
+    roots = np.roots([4 * self.a, 3 * self.b, 2 * self.c, self.d]) if (self.a, self.b, self.c) != (0, 0, 0) else np.array([])
+    roots = roots[(np.abs(roots.imag) < 1e-12) & (roots.real > 0) & (roots.real < max_corrected)].real
+    self.breaks = np.concatenate(([0], np.sort(roots), [max_corrected]))
+
+    # largest image radius reached until the end of each interval
+    self.reached = np.maximum.accumulate(self.distort(self.breaks[1:]))
+
+  def distort(self, r):
+    '''
+    Corrected to image radius
+    '''
+    return r * (self.a * r * r * r  + self.b * r * r + self.c * r + self.d)
+
+  def undistort(self, img_r):
+    '''
+    Image to corrected radius (array); safeguarded Newton iteration in the first increasing interval
+    reaching the image radius, falls back to bisection outside the bracket
+    '''
+    img_r = np.asarray(img_r, dtype = float)
+
+    interval = np.searchsorted(self.reached, img_r)
+    beyond = interval >= len(self.reached)
+    interval = np.minimum(interval, len(self.reached) - 1)
+    lo = self.breaks[interval]
+    hi = self.breaks[interval + 1]
+    r = np.clip(img_r, lo, hi)
+
+    for i in range(self.iterations):
+      g = self.distort(r) - img_r
+      lo = np.where(g <= 0, r, lo)
+      hi = np.where(g > 0, r, hi)
+
+      dg = 4 * self.a * r * r * r + 3 * self.b * r * r + 2 * self.c * r + self.d
+      with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        step = r - g / dg
+      outside = ~np.isfinite(step) | (step < lo) | (step > hi)
+      step = np.where(outside, (lo + hi) / 2, step)
+
+      done = np.abs(step - r) < self.tolerance
+      r = step
+      if np.all(done):
+        break
+
+    # the corrected radius where the largest image radius is first reached
+    r = np.where(beyond, self.breaks[np.argmax(self.reached) + 1], r)
+    return np.where(img_r <= 0, 0, r)
+
+@functools.lru_cache(maxsize = None)
+def lens_model(a, b, c, maxd):
+  '''
+  Shared LensModel per unique lens; images referring the same lens (a=0, b=0, c=0 back references)
+  and size are set up only once
+  '''
+  return LensModel(a, b, c, maxd)
+
+def correct_lens_distortion(points, unitd, maxd, a, b, c):
+  '''
+  See https://hugin.sourceforge.io/docs/manual/Lens_correction_model.html
+  And https://wiki.panotools.org/index.php?title=Lens_distortion&oldid=9434
+
+  points is an (images, points, 2) array, other arguments are per image arrays
+  '''
+
+  img_r = np.sqrt(points[..., 0] * points[..., 0] + points[..., 1] * points[..., 1]) / np.asarray(unitd)[:, None]
+  corr_r = np.empty_like(img_r)
+
+  lenses, lens_of_image = np.unique(np.stack((a, b, c, maxd), axis = -1), axis = 0, return_inverse = True)
+  lens_of_image = lens_of_image.reshape(-1)
+  for i, (la, lb, lc, lmaxd) in enumerate(lenses):
+    images = lens_of_image == i
+    corr_r[images] = lens_model(float(la), float(lb), float(lc), float(lmaxd)).undistort(img_r[images])
+
+  with np.errstate(divide = 'ignore', invalid = 'ignore'):
+    ratio = np.where(img_r > 0, corr_r / img_r, 1)
+
+  return points * ratio[..., None]
+
+
+def project_image_points(images, points):
+  '''
+  Unit direction vectors (images, points, 3) of origo centered image pixel coordinates (images, points, 2)
+  of all images (ptofile.IMAGE_DTYPE array)
+  '''
+  w = images['w'].astype(float)
+  h = images['h'].astype(float)
+
+  # radial pixel distance is normalized for lens correction polinomial using the shortest size
+  # see https://wiki.panotools.org/Lens_correction_model
+  # "... the largest circle that completely fits into an image is said to have radius=1.0 ..."
+  radial_unit_distance = np.minimum(w, h) / 2
+
+  # maximal radial pixel distance after normalizaton
+  # this is the normalized distance of a corner
+  max_normalized_radial_distance = np.sqrt(w * w + h * h) / (2 * radial_unit_distance)
+
+  points = correct_lens_distortion(points, radial_unit_distance, max_normalized_radial_distance,
+    images['a'], images['b'], images['c'])
+  points = image_xy_to_cartesian(points, images['v'], w)
+  rotations = rotation_matrices(images['y'], images['p'], images['r'])
+  return rotate_cartesian(points, rotations)
+
+def control_point_directions(images, control_points):
+  '''
+  Unit direction vectors (points, 2, 3) of both ends of control points (ptofile.CONTROL_POINT_DTYPE
+  array); control point coordinates are pixel positions from the top left corner. Lens and rotation
+  setup is done per image (and unique lens), points are processed in bulk.
+  '''
+  w = images['w'].astype(float)
+  h = images['h'].astype(float)
+  radial_unit_distance = np.minimum(w, h) / 2
+  max_normalized_radial_distance = np.sqrt(w * w + h * h) / (2 * radial_unit_distance)
+  lenses, lens_of_image = np.unique(np.stack((images['a'], images['b'], images['c'], max_normalized_radial_distance), axis = -1),
+    axis = 0, return_inverse = True)
+  lens_of_image = lens_of_image.reshape(-1)
+  rotations = rotation_matrices(images['y'], images['p'], images['r'])
+
+  ret = np.empty((len(control_points), 2, 3))
+  for end, (n, x, y) in enumerate((('n', 'x', 'y'), ('N', 'X', 'Y'))):
+    index = control_points[n]
+    xy = np.stack((control_points[x] - w[index] / 2, h[index] / 2 - control_points[y]), axis = -1)
+    img_r = np.sqrt(xy[:, 0] * xy[:, 0] + xy[:, 1] * xy[:, 1]) / radial_unit_distance[index]
+
+    # points sorted by lens, each lens undistorts one contiguous run
+    lens = lens_of_image[index]
+    order = np.argsort(lens, kind = 'stable')
+    bounds = np.searchsorted(lens[order], np.arange(len(lenses) + 1))
+    corr_r = np.empty_like(img_r)
+    for i, (la, lb, lc, lmaxd) in enumerate(lenses):
+      run = order[bounds[i]:bounds[i + 1]]
+      if len(run):
+        corr_r[run] = lens_model(float(la), float(lb), float(lc), float(lmaxd)).undistort(img_r[run])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+      ratio = np.where(img_r > 0, corr_r / img_r, 1)
+
+    cam = image_xy_to_cartesian(xy[:, None, :] * ratio[:, None, None], images['v'][index], w[index])
+    ret[:, end] = rotate_cartesian(cam, rotations[index])[:, 0]
+  return ret
+
+def project_outlines(images, points):
+  '''
+  Equirectangular (yaw, pitch) outlines of all images (ptofile.IMAGE_DTYPE array) in one pass; (images, 4 * points, 2) array
+  '''
+  # generate image perimeter in pixel space, origo centered
+  imgr = gen_rect(points, images['w'].astype(float), images['h'].astype(float))
+  return cartesian_to_yaw_pitch(project_image_points(images, imgr))
+
+def wrap_angles(a, limit):
+  '''
+  Shift angles into the -limit .. limit range by multiples of 2 * limit
+  '''
+  a = np.where(a > limit, a - 2 * limit * np.ceil((a - limit) / (2 * limit)), a)
+  return np.where(a < -limit, a + 2 * limit * np.ceil((-limit - a) / (2 * limit)), a)
+
+def yaw_pitch_to_cartesian(yaw, pitch):
+  '''
+  Unit direction vectors (..., 3) of equirectangular yaw, pitch degrees; inverse of cartesian_to_yaw_pitch
+  '''
+  # trigonometry before broadcasting; cheap for separable (rows, 1), (1, columns) grids
+  y = np.asarray(yaw) * np.pi / 180
+  p = np.asarray(pitch) * np.pi / 180
+  cos_p = np.cos(p)
+  x, y, z = np.broadcast_arrays(np.cos(y) * cos_p, np.sin(p), np.sin(y) * cos_p)
+  return np.stack((x, y, z), axis = -1)
+
+def directions_to_images_xy(directions, images, pairwise = False):
+  '''
+  Inverse of the outline projection: origo centered pixel coordinates (images, ..., 2) of (..., 3) unit
+  direction vectors in every image, x to the right, y upward, and masks (images, ...) of the directions
+  visible in each image (in front of the camera, inside the image rectangle).
+  With pairwise, directions (images, ..., 3) are mapped into their own image only.
+  '''
+  w = images['w'].astype(float)
+  h = images['h'].astype(float)
+  shape = (len(images),) + (1,) * (directions.ndim - (2 if pairwise else 1))
+
+  # rotation matrices are orthonormal, the transposed matrices apply the inverse rotation;
+  # written out per component, broadcasting (images, ...) is much faster than einsum here
+  rotations = rotation_matrices(images['y'], images['p'], images['r'])
+  cam = [sum(rotations[:, j, i].reshape(shape) * directions[..., j] for j in range(3)) for i in range(3)]
+
+  d = (w / (2 * np.tan(np.pi * images['v'] / 360))).reshape(shape)
+  front = cam[0] > 0
+  with np.errstate(divide = 'ignore', invalid = 'ignore'):
+    x = np.where(front, d * cam[2] / cam[0], 0)
+    y = np.where(front, d * cam[1] / cam[0], 0)
+
+  # corrected (ideal rectilinear) radius to image radius is the forward polynomial
+  radial_unit_distance = np.minimum(w, h) / 2
+  max_normalized_radial_distance = np.sqrt(w * w + h * h) / (2 * radial_unit_distance)
+  lenses, lens_of_image = np.unique(np.stack((images['a'], images['b'], images['c'], max_normalized_radial_distance), axis = -1),
+    axis = 0, return_inverse = True)
+  max_corrected = np.array([
+    float(lens_model(float(a), float(b), float(c), float(maxd)).undistort(np.array([maxd]))[0])
+    for a, b, c, maxd in lenses])[lens_of_image.reshape(-1)]
+
+  a = images['a'].reshape(shape)
+  b = images['b'].reshape(shape)
+  c = images['c'].reshape(shape)
+  corr_r = np.sqrt(x * x + y * y) / radial_unit_distance.reshape(shape)
+  with np.errstate(divide = 'ignore', invalid = 'ignore'):
+    ratio = np.where(corr_r > 0, a * corr_r * corr_r * corr_r + b * corr_r * corr_r + c * corr_r + (1 - (a + b + c)), 1)
+  x = x * ratio
+  y = y * ratio
+
+  visible = (front & (corr_r <= max_corrected.reshape(shape)) & (ratio > 0)
+    & (np.abs(x) <= w.reshape(shape) / 2) & (np.abs(y) <= h.reshape(shape) / 2))
+  return np.stack((x, y), axis = -1), visible
+
+def directions_to_image_xy(directions, image):
+  '''
+  directions_to_images_xy() of a single image (IMAGE_DTYPE row)
+  '''
+  xy, visible = directions_to_images_xy(directions, image[None])
+  return xy[0], visible[0]
+
+def crop_cells(pano, cell_deg):
+  '''
+  Coarse equirectangular grid over the crop (S) area of a p line; returns yaw of the cell column
+  centers, pitch of the cell row centers (top to bottom) and the cell width, height in degrees
+  '''
+  deg_per_px = pano['v'] / pano['w']
+  yaw1 = (pano['crop_x1'] - pano['w'] / 2) * deg_per_px
+  yaw2 = (pano['crop_x2'] - pano['w'] / 2) * deg_per_px
+  pitch1 = (pano['h'] / 2 - pano['crop_y1']) * deg_per_px
+  pitch2 = (pano['h'] / 2 - pano['crop_y2']) * deg_per_px
+
+  cols = max(1, round((yaw2 - yaw1) / cell_deg))
+  rows = max(1, round((pitch1 - pitch2) / cell_deg))
+  cell_w = (yaw2 - yaw1) / cols
+  cell_h = (pitch1 - pitch2) / rows
+  return yaw1 + (np.arange(cols) + 0.5) * cell_w, pitch1 - (np.arange(rows) + 0.5) * cell_h, cell_w, cell_h
+
+def image_footprints(images, yaws, pitches, cells_per_chunk = 1 << 21):
+  '''
+  Boolean (images, rows, columns) masks of the yaws x pitches grid cell centers covered by each image;
+  images are processed in chunks to limit temporary memory
+  '''
+  directions = yaw_pitch_to_cartesian(yaws[None, :], pitches[:, None])
+  ret = np.zeros((len(images), len(pitches), len(yaws)), dtype = bool)
+  chunk = max(1, cells_per_chunk // (len(yaws) * len(pitches)))
+  for i in range(0, len(images), chunk):
+    _, ret[i:i + chunk] = directions_to_images_xy(directions, images[i:i + chunk])
+  return ret
+
+def pano_bounding_boxes(pano, images, points = 50):
+  '''
+  Per image (x1, y1, x2, y2) bounding boxes of the projected outlines in panorama pixels (p line
+  coordinates, not clipped); images crossing the yaw = +-180 seam or containing a pole span the full
+  360 degree width
+  '''
+  px_per_deg = pano['w'] / pano['v']
+  outlines = project_outlines(images, points)
+
+  # yaw extent around the image center, continuous across the seam
+  dyaw = wrap_angles(outlines[..., 0] - images['y'][:, None], 180)
+  center = wrap_angles(images['y'], 180)
+  yaw1 = center + dyaw.min(axis = 1)
+  yaw2 = center + dyaw.max(axis = 1)
+  pitch1 = outlines[..., 1].max(axis = 1)
+  pitch2 = outlines[..., 1].min(axis = 1)
+
+  _, poles = directions_to_images_xy(np.array([[0.0, 1.0, 0.0], [0.0, -1.0, 0.0]]), images)
+  full = poles.any(axis = 1) | (yaw1 < -180) | (yaw2 > 180)
+  yaw1 = np.where(full, -180, yaw1)
+  yaw2 = np.where(full, 180, yaw2)
+  pitch1 = np.where(poles[:, 0], 90, pitch1)
+  pitch2 = np.where(poles[:, 1], -90, pitch2)
+
+  return np.stack((
+    pano['w'] / 2 + yaw1 * px_per_deg,
+    pano['h'] / 2 - pitch1 * px_per_deg,
+    pano['w'] / 2 + yaw2 * px_per_deg,
+    pano['h'] / 2 - pitch2 * px_per_deg), axis = -1)
+
+def image_samples(images, points, inner, margin = 0):
+  '''
+  Unit direction vectors (images, 4 * points + inner * inner, 3) of outline points and an inner grid of
+  all images; margin grows the sampled rectangles by a fraction of the image size
+  '''
+  w = images['w'].astype(float) * (1 + margin)
+  h = images['h'].astype(float) * (1 + margin)
+  fractions = (np.arange(inner) + 0.5) / inner - 0.5
+  gx, gy = np.meshgrid(fractions, fractions)
+  grid = np.stack((gx.reshape(-1)[None, :] * w[:, None], gy.reshape(-1)[None, :] * h[:, None]), axis = -1)
+  return project_image_points(images, np.concatenate((gen_rect(points, w, h), grid), axis = 1))
+
+def image_caps(images, points = 8, margin = 0):
+  '''
+  Bounding caps of the image footprints: image center unit vectors (images, 3) and angular radii in
+  degrees reaching every outline point
+  '''
+  outlines = image_samples(images, points, 0, margin)
+  centers = rotation_matrices(images['y'], images['p'], images['r'])[:, :, 0]
+  cos = np.clip(np.einsum('nmi,ni->nm', outlines, centers), -1, 1)
+
+  # the outline between two samples is within half a segment of them
+  segments = np.clip(np.einsum('nmi,nmi->nm', outlines, np.roll(outlines, 1, axis = 1)), -1, 1)
+  radii = np.degrees(np.arccos(cos.min(axis = 1)) + np.arccos(segments.min(axis = 1)) / 2)
+  return centers, radii
+
+def cap_cells(centers, radii, cell_deg):
+  '''
+  Cells touched by caps in an HEALPix like grid on the sphere: pitch bands of cell_deg height, each
+  split into about square cells (fewer towards the poles). Returns (cap index, cell id) arrays.
+  '''
+  bands = max(1, math.ceil(180 / cell_deg))
+  band_h = 180 / bands
+  edges = -90 + np.arange(bands + 1) * band_h
+  # widest latitude of each band sets its cell count
+  widest = np.where((edges[:-1] < 0) & (edges[1:] > 0), 0, np.minimum(np.abs(edges[:-1]), np.abs(edges[1:])))
+  columns = np.maximum(1, np.ceil(360 * np.cos(np.radians(widest)) / band_h)).astype(int)
+  first_cell = np.concatenate(([0], np.cumsum(columns)[:-1]))
+
+  pitch = np.degrees(np.arcsin(np.clip(centers[:, 1], -1, 1)))
+  yaw = np.degrees(np.arctan2(centers[:, 2], centers[:, 0]))
+
+  caps = []
+  cells = []
+  for i in range(len(centers)):
+    p1 = pitch[i] - radii[i]
+    p2 = pitch[i] + radii[i]
+    b1 = max(0, int((p1 + 90) // band_h))
+    b2 = min(bands - 1, int((p2 + 90) // band_h))
+    if p1 <= -90 or p2 >= 90:
+      # contains a pole: every yaw
+      half_width = 180
+    else:
+      # widest yaw extent of a cap not containing a pole
+      half_width = math.degrees(math.asin(min(1, math.sin(math.radians(radii[i])) / math.cos(math.radians(pitch[i])))))
+
+    for b in range(b1, b2 + 1):
+      n = columns[b]
+      c1 = math.floor((yaw[i] - half_width + 180) / 360 * n)
+      c2 = math.floor((yaw[i] + half_width + 180) / 360 * n)
+      if c2 - c1 + 1 >= n:
+        c = np.arange(n)
+      else:
+        c = np.unique(np.arange(c1, c2 + 1) % n)
+      caps.append(np.full(len(c), i))
+      cells.append(first_cell[b] + c)
+
+  if not caps:
+    return np.zeros(0, dtype = int), np.zeros(0, dtype = int)
+  return np.concatenate(caps), np.concatenate(cells)
+
+def overlapping_caps(centers, radii, cell_deg = None):
+  '''
+  (pairs, 2) array of cap index pairs (i < j) overlapping each other. Only caps sharing a cell of the
+  cap_cells() grid are compared; cells are about the median cap diameter, so for images of similar
+  size the cost is close to O(n log n) instead of all pairs.
+  '''
+  n = len(centers)
+  if cell_deg is None:
+    cell_deg = float(np.clip(2 * np.median(radii), 0.5, 90)) if n else 90
+  caps, cells = cap_cells(centers, radii, cell_deg)
+
+  order = np.lexsort((caps, cells))
+  caps = caps[order]
+  cells = cells[order]
+  starts = np.flatnonzero(np.diff(cells, prepend = -1))
+  counts = np.diff(np.append(starts, len(cells)))
+
+  pairs = [np.zeros((0, 2), dtype = np.int64)]
+  for start, count in zip(starts[counts > 1], counts[counts > 1]):
+    i, j = np.triu_indices(count, 1)
+    members = caps[start:start + count]
+    pairs.append(np.stack((members[i], members[j]), axis = -1))
+  pairs = np.concatenate(pairs)
+
+  # caps spanning several cells meet in each of them
+  pairs = np.unique(pairs[:, 0] * n + pairs[:, 1])
+  pairs = np.stack((pairs // n, pairs % n), axis = -1)
+
+  limit = np.radians(radii[pairs[:, 0]] + radii[pairs[:, 1]])
+  dot = np.einsum('ni,ni->n', centers[pairs[:, 0]], centers[pairs[:, 1]])
+  return pairs[(limit >= np.pi) | (dot > np.cos(np.minimum(limit, np.pi)))]
+
+def overlapping_images(images, pairs, points = 8, inner = 3, margin = 0, pairs_per_chunk = 1 << 14):
+  '''
+  Subset of candidate image pairs (pairs, 2) with overlapping footprints: some outline or inner grid
+  sample of one image is visible in the other one, tested both ways; pairs are processed in chunks
+  to limit temporary memory
+  '''
+  samples = image_samples(images, points, inner, margin)
+  overlap = np.zeros(len(pairs), dtype = bool)
+  for i in range(0, len(pairs), pairs_per_chunk):
+    chunk = pairs[i:i + pairs_per_chunk]
+    for a, b in ((0, 1), (1, 0)):
+      _, visible = directions_to_images_xy(samples[chunk[:, a]], images[chunk[:, b]], pairwise = True)
+      overlap[i:i + pairs_per_chunk] |= visible.any(axis = 1)
+  return pairs[overlap]
+
+def outline_corners(images):
+  '''
+  Origo centered image corners (images, 4, 2) in gen_rect() order
+  '''
+  w = images['w'].astype(float) / 2
+  h = images['h'].astype(float) / 2
+  return np.stack((np.stack((-w, -h), axis = -1), np.stack((w, -h), axis = -1),
+    np.stack((w, h), axis = -1), np.stack((-w, h), axis = -1)), axis = 1)
+
+def project_outline_positions(images, corners, index, s):
+  '''
+  Equirectangular (yaw, pitch) of outline positions s (0 .. 4: edge number + fraction along the edge)
+  of images[index]; flat (points, 2) array
+  '''
+  edge = np.floor(s).astype(int) % 4
+  f = (s - np.floor(s))[:, None]
+  xy = corners[index, edge] * (1 - f) + corners[index, (edge + 1) % 4] * f
+  return cartesian_to_yaw_pitch(project_image_points(images[index], xy[:, None, :])[:, 0])
+
+def adaptive_outlines(images, tolerance = 0.1, initial = 4, max_depth = 10):
+  '''
+  Curvature adaptive outline sampling of all images: edges start with initial points, segments are
+  halved (in image space) while the projected midpoint is more than tolerance degrees off the straight
+  equirectangular segment, at most max_depth times. Small images near the equator keep few points,
+  sampling gets dense only where the projection bends edges (large images, near the poles).
+
+  Returns (image index, outline position, yaw, pitch) flat arrays ordered by image and position;
+  outlines are closed implicitly.
+  '''
+  corners = outline_corners(images)
+  count = 4 * initial
+  index = np.repeat(np.arange(len(images)), count)
+  s = np.tile(np.arange(count) / initial, len(images))
+  yp = project_outline_positions(images, corners, index, s)
+  active = np.ones(len(s), dtype = bool)
+
+  for depth in range(max_depth):
+    # segment from each point to the next one of the same image; the last one closes the outline
+    last = np.append(index[1:] != index[:-1], True)
+    nxt = np.arange(len(s)) + 1
+    nxt[last] = np.flatnonzero(np.append(True, index[1:] != index[:-1]))
+    end = np.where(last, s[nxt] + 4, s[nxt])
+
+    segments = np.flatnonzero(active)
+    mid_s = (s[segments] + end[segments]) / 2
+    mid = project_outline_positions(images, corners, index[segments], mid_s)
+    a = yp[segments]
+    b = yp[nxt[segments]]
+    chord_yaw = a[:, 0] + wrap_angles(b[:, 0] - a[:, 0], 180) / 2
+    deviation = np.hypot(wrap_angles(mid[:, 0] - chord_yaw, 180), mid[:, 1] - (a[:, 1] + b[:, 1]) / 2)
+
+    split = deviation > tolerance
+    active[:] = False
+    if not split.any():
+      break
+    active[segments[split]] = True
+
+    index = np.concatenate((index, index[segments[split]]))
+    s = np.concatenate((s, mid_s[split] % 4))
+    yp = np.concatenate((yp, mid[split]))
+    active = np.concatenate((active, np.ones(split.sum(), dtype = bool)))
+    order = np.lexsort((s, index))
+    index, s, yp, active = index[order], s[order], yp[order], active[order]
+
+  return index, s, yp[:, 0], yp[:, 1]
+
+def outline_seam_polylines(images, tolerance = 0.1, iterations = 40):
+  '''
+  Adaptive outlines split exactly at the yaw = +-180 seam: crossings of outline segments are located
+  by bisection in image space, each piece ends / starts at +-180. An outline around a pole becomes one
+  polyline from seam to seam. Returns per image lists of (points, 2) yaw, pitch arrays (closed
+  outlines not crossing the seam repeat their first point at the end).
+  '''
+  corners = outline_corners(images)
+  index, s, yaw, pitch = adaptive_outlines(images, tolerance)
+  starts = np.flatnonzero(np.append(True, index[1:] != index[:-1]))
+  ends = np.append(starts[1:], len(index))
+
+  # continuous yaw along each closed outline (the first point repeated at the end), seam bin of each point
+  outlines = []
+  for start, end in zip(starts, ends):
+    y = yaw[start:end]
+    unwrapped = y[0] + np.concatenate(([0], np.cumsum(wrap_angles(np.diff(np.append(y, y[0])), 180))))
+    bins = np.floor((unwrapped + 180) / 360).astype(int)
+    outlines.append((unwrapped, bins, np.flatnonzero(bins[1:] != bins[:-1])))
+
+  # bisection of all crossing positions between their segment ends at once
+  crossing_image = np.concatenate([np.full(len(c), index[start]) for start, (_, _, c) in zip(starts, outlines)] + [[]]).astype(int)
+  lo = np.concatenate([s[start + c] for start, (_, _, c) in zip(starts, outlines)] + [[]])
+  hi = np.concatenate([np.where(c + 1 < end - start, s[start + (c + 1) % (end - start)], s[start] + 4)
+    for start, end, (_, _, c) in zip(starts, ends, outlines)] + [[]])
+  base = np.concatenate([u[c] for u, _, c in outlines] + [[]])
+  seam = np.concatenate([360 * np.maximum(b[c], b[c + 1]) - 180 for _, b, c in outlines] + [[]])
+  rising = np.concatenate([b[c + 1] > b[c] for _, b, c in outlines] + [[]]).astype(bool)
+  for _ in range(iterations if len(lo) else 0):
+    mid = (lo + hi) / 2
+    u = base + wrap_angles(project_outline_positions(images, corners, crossing_image, mid)[:, 0] - base, 180)
+    before = (u < seam) == rising
+    lo = np.where(before, mid, lo)
+    hi = np.where(before, hi, mid)
+  seam_pitch = project_outline_positions(images, corners, crossing_image, (lo + hi) / 2)[:, 1] if len(lo) else lo
+
+  ret = [[] for _ in range(len(images))]
+  first_crossing = 0
+  for start, end, (unwrapped, bins, crossings) in zip(starts, ends, outlines):
+    i = index[start]
+    p = pitch[start:end]
+    pp = np.append(p, p[0])
+    if len(crossings) == 0:
+      ret[i].append(np.stack((unwrapped, pp), axis = -1))
+      continue
+    seams = seam[first_crossing:first_crossing + len(crossings)]
+    seam_pitches = seam_pitch[first_crossing:first_crossing + len(crossings)]
+    first_crossing = first_crossing + len(crossings)
+
+    # one piece from each crossing to the next one; pieces running past the first point continue with
+    # the winding of the outline (+-360 degrees around a pole)
+    winding = unwrapped[-1] - unwrapped[0]
+    for k, c in enumerate(crossings):
+      k2 = (k + 1) % len(crossings)
+      c2 = crossings[k2]
+      offset = 360 * bins[c + 1]
+      if c2 > c:
+        piece_yaw = unwrapped[c + 1:c2 + 1]
+        piece_pitch = pp[c + 1:c2 + 1]
+        seam_end = seams[k2]
+      else:
+        piece_yaw = np.concatenate((unwrapped[c + 1:], unwrapped[1:c2 + 1] + winding))
+        piece_pitch = np.concatenate((pp[c + 1:], pp[1:c2 + 1]))
+        seam_end = seams[k2] + winding
+      piece_yaw = np.concatenate(([seams[k]], piece_yaw, [seam_end])) - offset
+      # pieces end exactly on the seam; the winding is only close to +-360 and a yaw a rounding error
+      # beyond +180 would be wrapped to the other chart edge
+      piece_yaw[[0, -1]] = np.round((piece_yaw[[0, -1]] + 180) / 360) * 360 - 180
+      piece_pitch = np.concatenate(([seam_pitches[k]], piece_pitch, [seam_pitches[k2]]))
+      ret[i].append(np.stack((piece_yaw, piece_pitch), axis = -1))
+
+  return ret
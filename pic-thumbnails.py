@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import os
+import time
+from xml.sax.saxutils import escape
+# See https://pillow.readthedocs.io/en/latest/installation/basic-installation.html
+from PIL import Image, ImageOps
+
+import mediacatalog
+
+'''
+Thumbnail engine and index.xml writer of make-pic-page.sh
+
+ - Each original is decoded once: JPEGs with DCT scaling (draft mode) just large enough for the
+   largest thumbnail, other formats reduced by an integer factor right after decoding
+ - EXIF orientation is applied, then the thumbnail sizes are made as a cascade from the largest to
+   the smallest, each from the previous one
+ - Only missing thumbnails are written; originals whose thumbnails all exist are not decoded
+ - Images are processed in a process pool
+ - Original dimensions, EXIF and orientation come from the media catalog (mediacatalog.py), scanned
+   incrementally before; originals are opened only to write missing thumbnails
+ - Same thumbnail file names and index.xml structure as the former identify / convert loop of
+   make-pic-page.sh; thumbnail dimensions come from the processing (or the file headers of existing
+   thumbnails) instead of identify calls
+
+Thumbnails are not upscaled: originals smaller than a thumbnail size are written at their own size.
+
+Launch with -h to print CLI help
+'''
+
+# Thumbnail sizes (bounding box)
+default_sizes = '250 400 800 1280 1920 2500 3840'
+
+# Base name suffixes removed by make-pic-page.sh; kept as is so existing thumbnails are found
+# (e.g. x.TIF and x.tiff keep their extension in the thumbnail name)
+stripped_extensions = ('.jpg', '.JPG', '.jpeg', '.JPEG', '.png', '.PNG', '.tif', '.TIFF')
+
+def image_base(path):
+  f = os.path.basename(path)
+  for ext in stripped_extensions:
+    if f.endswith(ext) and len(f) > len(ext):
+      f = f[:-len(ext)]
+  return f
+
+def walk_order(path):
+  '''
+  Sort key of the former find / os.walk order: files of a directory first, then its subdirectories
+  '''
+  parts = path.split('/')
+  return [(1, p) for p in parts[:-1]] + [(0, parts[-1])]
+
+def in_dir(path, names):
+  return any(f'/{n}/' in f'/{path}' for n in names)
+
+def exif_fragment(fields):
+  lines = ['            <exif>']
+  lines.extend(f'                <{name}>{escape(value)}</{name}>' for name, value in fields)
+  lines.append('            </exif>')
+  return '\n'.join(lines) + '\n'
+
+def fit(w, h, box):
+  scale = min(1, box / max(w, h))
+  return max(1, round(w * scale)), max(1, round(h * scale))
+
+def decode(img, box):
+  '''
+  Oriented RGB image at least box sized (or the original size), decoded at the smallest size possible
+  '''
+  w, h = img.size
+  target = fit(w, h, box)
+  if img.format == 'JPEG':
+    img.draft('RGB', target)
+  factor = min(img.size[0] // target[0], img.size[1] // target[1])
+  if factor >= 2:
+    img = img.reduce(factor)
+  img = ImageOps.exif_transpose(img)
+  return img.convert('RGB') if img.mode not in ('RGB', 'L') else img
+
+def process_image(image, tdir, sizes, quality):
+  '''
+  Thumbnails and index data of one image, given as (path, size, width, height, orientation, EXIF
+  fields) from the media catalog; returns (index.xml <image> fragment, log lines, seconds)
+  '''
+  t = time.perf_counter()
+  log = []
+  path, size, width, height, orientation, exif = image
+  f = image_base(path)
+  d = os.path.dirname(path)
+  subdir = f'{tdir}thumbnail/' + (d + '/' if d else '')
+
+  thumbnails = [(s, f'{subdir}{f}-tmb-{s}.jpg') for s in sizes]
+  missing = [(s, tf) for s, tf in thumbnails if not os.path.exists(tf)]
+  known = {}
+  if missing:
+    os.makedirs(subdir, exist_ok = True)
+    # thumbnail sizes follow the oriented original, not the reduced decode
+    ow, oh = (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+    with Image.open(path) as img:
+      current = decode(img, max(s for s, _ in missing))
+      for s, tf in sorted(missing, reverse = True):
+        dims = fit(ow, oh, s)
+        if current.size != dims:
+          current = current.resize(dims, Image.Resampling.LANCZOS, reducing_gap = 2.0)
+        current.save(tf, quality = quality)
+        known[tf] = dims
+      log.append(f'decoded {img.size[0]}x{img.size[1]} once, wrote {len(missing)} thumbnails')
+  else:
+    log.append('all thumbnails exist')
+
+  lines = [
+    '        <image>',
+    f'            <original>{escape(path)}</original>',
+    f'            <width>{width}</width>',
+    f'            <height>{height}</height>',
+    f'            <size>{size}</size>',
+    f'            <nti>{str(in_dir(path, ("_nti", "_NTI_", "_nsi", "_NSI_"))).lower()}</nti>',
+    f'            <panosource>{str(in_dir(path, ("sources", "SOURCES"))).lower()}</panosource>',
+    f'            <panoworkfile>{str(in_dir(path, ("workfiles", "WORKFILES"))).lower()}</panoworkfile>'
+  ]
+  xml = '\n'.join(lines) + '\n' + (exif_fragment(exif) if exif else '')
+
+  for s, tf in thumbnails:
+    if tf not in known:
+      # header only
+      with Image.open(tf) as tmb:
+        known[tf] = tmb.size
+    xml += (f'            <thumbnail size="{s}">\n'
+      f'                <file>{escape(tf)}</file>\n'
+      f'                <width>{known[tf][0]}</width>\n'
+      f'                <height>{known[tf][1]}</height>\n'
+      f'                <size>{os.path.getsize(tf)}</size>\n'
+      '            </thumbnail>\n')
+  xml += '        </image>\n'
+  return xml, log, time.perf_counter() - t
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Create thumbnails of all pictures under the current directory and write the index.xml of make-pic-page.sh."
+  )
+
+  parser.add_argument('-o', '--output', type=str, default='index.xml', help='Index XML file (default: index.xml)')
+  parser.add_argument('-t', '--target', type=str, help='Thumbnail directory (default: ../<current directory name>-imgindex/)')
+  parser.add_argument('-s', '--sizes', type=str, default=default_sizes, help=f'Thumbnail sizes, bounding box (default: "{default_sizes}")')
+  parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Worker processes (default: number of CPUs)')
+  parser.add_argument('-c', '--catalog', type=str, default=mediacatalog.default_path, help=f'Media catalog file (default: {mediacatalog.default_path})')
+  parser.add_argument('-q', '--quality', type=int, default=85, help='Thumbnail JPG quality (default: 85)')
+
+  args = parser.parse_args()
+
+  t0 = time.perf_counter()
+  tdir = args.target if args.target else f'../{os.path.basename(os.getcwd())}-imgindex/'
+  if not tdir.endswith('/'):
+    tdir = tdir + '/'
+  sizes = [int(s) for s in args.sizes.split()]
+
+  print('Settings:')
+  print(f'  Target directory: "{tdir}"')
+  print(f'  Thumbnail sizes:  {" ".join(str(s) for s in sizes)}')
+  print(f'  Index XML:        "{args.output}"')
+  print(f'  Media catalog:    "{args.catalog}"')
+  print()
+
+  fragments = {}
+  failed = 0
+  images = []
+  with mediacatalog.MediaCatalog(args.catalog) as catalog:
+    print('Update media catalog')
+    catalog.scan(('image',), args.jobs, lambda line: print(f'  {line}'))
+    prefix = catalog.relpath('.')
+    for r in catalog.files('image', None if prefix == '.' else prefix):
+      path = os.path.relpath(os.path.join(catalog.root, r['path']))
+      if r['error']:
+        print(f'  {path}: ERROR {r["error"]}')
+        failed = failed + 1
+        continue
+      images.append((path, r['size'], r['width'], r['height'], r['orientation'], mediacatalog.row_exif(r)))
+  images.sort(key = lambda image: walk_order(image[0]))
+  print(f'Process {len(images)} images with {args.jobs} processes')
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers = max(1, args.jobs)) as executor:
+    futures = { executor.submit(process_image, image, tdir, sizes, args.quality) : image[0] for image in images }
+    for future in concurrent.futures.as_completed(futures):
+      path = futures[future]
+      try:
+        fragments[path], log, dt = future.result()
+      except Exception as e:
+        print(f'  {path}: ERROR {type(e).__name__}: {e}')
+        failed = failed + 1
+        continue
+      print(f'  {path}: {", ".join(log)}, {dt:.3f} s')
+
+  with open(args.output, 'w') as f:
+    f.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
+    f.write('<panopage>\n')
+    f.write('    <!-- Thumbnail sizes (bounding box)  -->\n')
+    f.write('    <sizes>\n')
+    f.writelines(f'        <size>{s}</size>\n' for s in sizes)
+    f.write('    </sizes>\n')
+    f.write('    <images>\n')
+    f.writelines(fragments[image[0]] for image in images if image[0] in fragments)
+    f.write('    </images>\n')
+    f.write('</panopage>\n')
+
+  # like the former make-pic-page.sh loop, images which can not be read are left out of the page
+  # instead of failing the page build
+  print(f'Wrote {args.output}: {len(fragments)} images' + (f', WARNING: {failed} failed and skipped' if failed else '') + f', {time.perf_counter() - t0:.3f} s')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+import numpy as np
+# See https://pillow.readthedocs.io/en/latest/installation/basic-installation.html
+from PIL import Image
+
+import ptofile
+from panogeometry import directions_to_image_xy, project_outlines, wrap_angles, yaw_pitch_to_cartesian
+
+'''
+Quick panorama preview JPG without nona / enblend
+
+ - Sources are decoded at reduced size (JPEG draft mode, Pillow reduce), just large enough for the
+   preview resolution
+ - The equirectangular preview canvas (crop area of the p line) is inverse mapped into every image
+   with the show-pano-layout.py geometry, limited to the image's bounding region on the canvas
+ - Bilinear sampling, images are blended with a simple edge feathering (weighted average)
+ - Images are processed on a thread pool (decoding and NumPy release the GIL)
+
+Same geometry limitations as show-pano-layout.py: equirectangular output, rectilinear lenses,
+a, b, c lens correction only. Exposure, vignetting and masks are ignored.
+
+Launch with -h to print CLI help
+'''
+
+def canvas_angles(pano, width):
+  '''
+  Yaw of preview columns and pitch of preview rows (pixel centers, degrees); the crop area of the
+  p line is scaled to width pixels
+  '''
+  scale = width / (pano['crop_x2'] - pano['crop_x1'])
+  height = max(1, round((pano['crop_y2'] - pano['crop_y1']) * scale))
+
+  # equirectangular: same degrees per pixel horizontally and vertically
+  deg_per_px = pano['v'] / pano['w']
+  x = pano['crop_x1'] + (np.arange(width) + 0.5) / scale
+  y = pano['crop_y1'] + (np.arange(height) + 0.5) / scale
+  return (x - pano['w'] / 2) * deg_per_px, (pano['h'] / 2 - y) * deg_per_px
+
+def canvas_region(image, yaws, pitches, pixel_deg):
+  '''
+  Preview columns and rows (index arrays) possibly covered by an image: outline bounding box
+  around the image center, all columns above / below the image if it contains a pole
+  '''
+  outline = project_outlines(image[None], 20)[0]
+  dyaw = wrap_angles(outline[:, 0] - image['y'], 180)
+  pmin = outline[:, 1].min() - pixel_deg
+  pmax = outline[:, 1].max() + pixel_deg
+  cols = np.flatnonzero(np.abs(wrap_angles(yaws - image['y'], 180) - (dyaw.min() + dyaw.max()) / 2)
+    <= (dyaw.max() - dyaw.min()) / 2 + pixel_deg)
+
+  _, poles = directions_to_image_xy(np.array([[0.0, 1.0, 0.0], [0.0, -1.0, 0.0]]), image)
+  if poles[0]:
+    pmax = 90
+    cols = np.arange(len(yaws))
+  if poles[1]:
+    pmin = -90
+    cols = np.arange(len(yaws))
+
+  rows = np.flatnonzero((pitches >= pmin) & (pitches <= pmax))
+  return cols, rows
+
+def load_source(path, scale):
+  '''
+  Decode an image at about scale times its size; returns float32 (h, w, 4) RGBA array
+  '''
+  img = Image.open(path)
+  w, h = img.size
+  target = (max(1, round(w * scale)), max(1, round(h * scale)))
+
+  # JPEG: decode with DCT scaling, the result is at least target size
+  img.draft('RGB', target)
+  factor = min(img.size[0] // target[0], img.size[1] // target[1])
+  if factor >= 2:
+    img = img.reduce(factor)
+
+  return np.asarray(img.convert('RGBA'), dtype = np.float32), (w, h)
+
+def sample_bilinear(pixels, col, row):
+  '''
+  Bilinear samples of an (h, w, channels) array at continuous pixel coordinates (0 is the first pixel center)
+  '''
+  h, w = pixels.shape[:2]
+  col = np.clip(col, 0, w - 1)
+  row = np.clip(row, 0, h - 1)
+  c0 = np.minimum(col.astype(np.int32), max(w - 2, 0))
+  r0 = np.minimum(row.astype(np.int32), max(h - 2, 0))
+  c1 = np.minimum(c0 + 1, w - 1)
+  r1 = np.minimum(r0 + 1, h - 1)
+  fc = (col - c0)[..., None]
+  fr = (row - r0)[..., None]
+  top = pixels[r0, c0] * (1 - fc) + pixels[r0, c1] * fc
+  bottom = pixels[r1, c0] * (1 - fc) + pixels[r1, c1] * fc
+  return top * (1 - fr) + bottom * fr
+
+def render_image(i, image, path, yaws, pitches, pixel_deg, feather):
+  '''
+  Weighted RGB contribution of one image; returns (columns, rows, weighted RGB, weights, decoded size, seconds)
+  '''
+  t = time.perf_counter()
+  cols, rows = canvas_region(image, yaws, pitches, pixel_deg)
+  if len(cols) == 0 or len(rows) == 0:
+    return cols, rows, None, None, None, time.perf_counter() - t
+
+  # decoded pixels per source pixel; one decoded pixel per preview pixel is enough for bilinear sampling
+  source_deg = float(image['v']) / float(image['w'])
+  pixels, (fw, fh) = load_source(path, min(1, source_deg / pixel_deg))
+  sx = pixels.shape[1] / fw
+  sy = pixels.shape[0] / fh
+
+  directions = yaw_pitch_to_cartesian(yaws[cols][None, :], pitches[rows][:, None])
+  xy, visible = directions_to_image_xy(directions, image)
+
+  # only the visible part of the bounding region is sampled
+  xy = xy[visible]
+  w = float(image['w'])
+  h = float(image['h'])
+
+  # origo centered, y upward image coordinates to decoded pixel positions; PTO size may differ from the
+  # file size (e.g. a rescaled copy), coordinates are scaled to the file
+  col = (xy[:, 0] + w / 2) * (fw / w) * sx - 0.5
+  row = (h / 2 - xy[:, 1]) * (fh / h) * sy - 0.5
+  rgba = sample_bilinear(pixels, col, row)
+
+  # feathering: weight ramps from 0 at the image edges to 1 at feather fraction of the half size
+  edge = np.minimum(1 - np.abs(xy[:, 0]) / (w / 2), 1 - np.abs(xy[:, 1]) / (h / 2))
+  weight = np.clip(edge / feather, 1e-3, 1) if feather > 0 else np.ones_like(edge)
+  weight = (weight * rgba[:, 3] / 255).astype(np.float32)
+
+  region_weight = np.zeros(visible.shape, dtype = np.float32)
+  region_weight[visible] = weight
+  region_rgb = np.zeros(visible.shape + (3,), dtype = np.float32)
+  region_rgb[visible] = rgba[:, :3] * weight[:, None]
+
+  return cols, rows, region_rgb, region_weight, pixels.shape[1::-1], time.perf_counter() - t
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Render a quick equirectangular preview JPG of a PTO project."
+  )
+
+  parser.add_argument('-i', '--input',  type=str, required=True, help='Input PTO file (required).')
+  parser.add_argument('-o', '--output', type=str, help='Output JPG file (default: <input without .pto>-preview.jpg)')
+  parser.add_argument('-w', '--width', type=int, default=2000, help='Preview width in pixels (default: 2000)')
+  parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Worker threads (default: number of CPUs)')
+  parser.add_argument('--feather', type=float, default=0.1, help='Feathering width as a fraction of the image half size, 0 to disable (default: 0.1)')
+  parser.add_argument('--quality', type=int, default=90, help='JPG quality (default: 90)')
+
+  args = parser.parse_args()
+
+  output = args.output if args.output else (args.input[:-len('.pto')] if args.input.endswith('.pto') else args.input) + '-preview.jpg'
+
+  t0 = time.perf_counter()
+  print()
+  print()
+  print(f'Load PTO from {args.input}')
+  pto = ptofile.load(args.input)
+  pano = pto.pano
+  if pano is None:
+    raise Exception(f'No p line in {args.input}')
+  if pano.get('f', 2) != 2:
+    print(f'WARNING: panorama projection f{pano["f"]} is rendered as equirectangular')
+
+  yaws, pitches = canvas_angles(pano, args.width)
+  pixel_deg = abs(yaws[1] - yaws[0]) if len(yaws) > 1 else pano['v']
+  print(f'Preview canvas: {len(yaws)}px x {len(pitches)}px, {len(pto.images)} images, {args.jobs} threads')
+
+  acc = np.zeros((len(pitches), len(yaws), 3), dtype = np.float32)
+  wsum = np.zeros((len(pitches), len(yaws)), dtype = np.float32)
+
+  # image names are relative to the PTO
+  base = os.path.dirname(os.path.abspath(args.input))
+  failed = 0
+  with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, args.jobs)) as executor:
+    futures = { executor.submit(render_image, i, pto.images[i], os.path.join(base, pto.names[i]),
+      yaws, pitches, pixel_deg, args.feather) : i for i in range(len(pto.images)) }
+    for future in concurrent.futures.as_completed(futures):
+      i = futures[future]
+      try:
+        cols, rows, rgb, weight, size, dt = future.result()
+      except Exception as e:
+        print(f'  #{i} {pto.names[i]}: ERROR {type(e).__name__}: {e}')
+        failed = failed + 1
+        continue
+      if rgb is None:
+        print(f'  #{i} {pto.names[i]}: outside of the crop area')
+        continue
+      region = np.ix_(rows, cols)
+      acc[region] += rgb
+      wsum[region] += weight
+      print(f'  #{i} {pto.names[i]}: decoded {size[0]}x{size[1]}, {len(cols)}x{len(rows)} preview px, {dt:.3f} s')
+
+  with np.errstate(divide = 'ignore', invalid = 'ignore'):
+    rgb = np.where(wsum[..., None] > 0, acc / wsum[..., None], 0)
+
+  print(f'Write preview to {output}')
+  Image.fromarray(np.clip(rgb + 0.5, 0, 255).astype(np.uint8)).save(output, quality = args.quality)
+
+  print(f'Done in {time.perf_counter() - t0:.3f} s; coverage: {100 * np.mean(wsum > 0):.1f}%' + (f', {failed} images failed' if failed else ''))
+  print()
+  print()
+  print()
+  if failed:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,282 @@
+'''
+Hugin / panotools PTO project reader and writer
+
+ - Quoted fields (names with spaces) are tokenized properly
+ - Image geometry is loaded into a compact NumPy structured array (one row per image),
+   x=N back references are resolved but remembered for writing
+ - Control points (c), optimizer variables (v) and masks (k) are kept, control points in a
+   structured array
+ - Single streaming pass over the file; per line logging is optional
+ - Parsed projects can be written back; unchanged values keep their original formatting
+
+Other lines (comments, #-hugin image options, m, unknown lines) are preserved in place.
+'''
+
+import re
+import numpy as np
+
+# Image line values kept in the image table; everything else is preserved as raw text
+IMAGE_DTYPE = np.dtype([
+  ('w', np.int32), ('h', np.int32), ('f', np.int16),
+  ('v', np.float64), ('y', np.float64), ('p', np.float64), ('r', np.float64),
+  ('a', np.float64), ('b', np.float64), ('c', np.float64), ('d', np.float64), ('e', np.float64),
+  ('g', np.float64), ('t', np.float64)
+])
+
+CONTROL_POINT_DTYPE = np.dtype([
+  ('n', np.int32), ('N', np.int32),
+  ('x', np.float64), ('y', np.float64), ('X', np.float64), ('Y', np.float64),
+  ('t', np.int16)
+])
+
+OPTIMIZE_DTYPE = np.dtype([('var', 'U4'), ('image', np.int32)])
+
+# key: leading letters; value: quoted string or anything up to the next whitespace
+TOKEN_RE = re.compile(r'([A-Za-z]+)("[^"]*"|\S*)')
+
+def tokenize(line):
+  '''
+  Split a PTO line (without the line type character) into (key, value, quoted) tuples
+  '''
+  # an unquoted value can only start and end with a quote if it is a single quote character
+  return [(k, v[1:-1], True) if len(v) > 1 and v[0] == '"' and v[-1] == '"' else (k, v, False)
+    for k, v in TOKEN_RE.findall(line)]
+
+def format_token(key, value, quoted):
+  return f'{key}"{value}"' if quoted else f'{key}{value}'
+
+def format_number(value):
+  value = float(value)
+  if value.is_integer():
+    return str(int(value))
+  return repr(value)
+
+class Project:
+  '''
+  Parsed PTO project
+
+    pano:           p line values; w, h, v, crop_x1, crop_x2, crop_y1, crop_y2, v_vertical, plus raw tokens
+    images:         IMAGE_DTYPE structured array
+    image_refs:     per image table column, image index referenced by x=N (-1 for own value)
+    names:          image file names
+    image_tokens:   per image raw (key, value, quoted) tuples, used for writing
+    image_lines:    per image original line, written as is while the image is unchanged
+    control_points: CONTROL_POINT_DTYPE structured array
+    optimize:       OPTIMIZE_DTYPE structured array of v line variables
+    masks:          k line token lists
+    layout:         line order for writing; raw lines or markers of the parsed lines
+  '''
+
+  __slots__ = ['pano', 'pano_tokens', 'pano_line', 'images', 'image_refs', 'names', 'image_tokens',
+    'image_lines', 'control_points', 'optimize', 'masks', 'layout']
+
+  def __init__(self):
+    self.pano = None
+    self.pano_tokens = []
+    self.pano_line = None
+    self.images = np.zeros(0, dtype = IMAGE_DTYPE)
+    self.image_refs = { k : np.zeros(0, dtype = np.int32) for k in IMAGE_DTYPE.names }
+    self.names = []
+    self.image_tokens = []
+    self.image_lines = []
+    self.control_points = np.zeros(0, dtype = CONTROL_POINT_DTYPE)
+    self.optimize = np.zeros(0, dtype = OPTIMIZE_DTYPE)
+    self.masks = []
+    self.layout = []
+
+def parse_pano_tokens(tokens, line):
+  ret = {}
+  for key, value, quoted in tokens:
+    if key == 'S':
+      v = value.split(',')
+      if len(v) != 4:
+        raise Exception(f'Expected 4 values, got {len(v)} in S part in p line "{line}"')
+      ret['crop_x1'] = int(v[0])
+      ret['crop_x2'] = int(v[1])
+      ret['crop_y1'] = int(v[2])
+      ret['crop_y2'] = int(v[3])
+    elif key in ('w', 'h'):
+      ret[key] = int(value)
+    elif key == 'v':
+      ret['v'] = float(value)
+    elif key == 'f':
+      ret['f'] = int(value)
+    elif key == 'n':
+      ret['n'] = value
+
+  # maybe incorrect?
+  ret['v_vertical'] = ret['v'] * ret['h'] / ret['w']
+
+  if not 'crop_x1' in ret:
+    ret['crop_x1'] = 0
+    ret['crop_x2'] = ret['w']
+    ret['crop_y1'] = 0
+    ret['crop_y2'] = ret['h']
+
+  return ret
+
+def load(path, log = None, control_points = True):
+  '''
+  Parse a PTO file in one streaming pass; log is an optional print like function called per parsed line.
+  Without control_points, c lines are skipped (faster on large projects); such a project is for reading
+  only, saving it would drop the control points.
+  '''
+  ret = Project()
+
+  rows = []
+  refs = { k : [] for k in IMAGE_DTYPE.names }
+  cps = []
+  optimize = []
+  columns = set(IMAGE_DTYPE.names)
+
+  with open(path, 'r') as f:
+    for line in f:
+      if not control_points and line.startswith('c '):
+        continue
+      line = line.rstrip('\r\n')
+      stripped = line.strip()
+      kind = stripped[:1]
+
+      if kind == 'c' and stripped[1:2] == ' ':
+        # control points are the bulk of large projects; no quoted fields, simple split
+        if not control_points:
+          continue
+        if not cps:
+          ret.layout.append(('c', None))
+        parts = stripped.split()
+        if len(parts) == 8 and parts[1][0] + parts[2][0] + parts[3][0] + parts[4][0] + parts[5][0] + parts[6][0] + parts[7][0] == 'nNxyXYt':
+          cps.append((parts[1][1:], parts[2][1:], parts[3][1:], parts[4][1:], parts[5][1:], parts[6][1:], parts[7][1:]))
+        else:
+          values = dict.fromkeys(CONTROL_POINT_DTYPE.names, '0')
+          for part in parts[1:]:
+            if part[0] in values:
+              values[part[0]] = part[1:]
+          cps.append(tuple(values.values()))
+        continue
+
+      if kind == 'i' and stripped[1:2] == ' ':
+        tokens = tokenize(stripped[2:])
+        row = dict.fromkeys(IMAGE_DTYPE.names, 0)
+        name = ''
+        for key, value, quoted in tokens:
+          if key == 'n' and quoted:
+            name = value
+          elif key in columns:
+            if value.startswith('='):
+              ref = int(value[1:])
+              row[key] = rows[ref][key]
+              refs[key].append(ref)
+              continue
+            row[key] = float(value)
+        for key in IMAGE_DTYPE.names:
+          if len(refs[key]) < len(rows) + 1:
+            refs[key].append(-1)
+
+        ret.layout.append(('i', len(rows)))
+        rows.append(row)
+        ret.names.append(name)
+        ret.image_tokens.append(tokens)
+        ret.image_lines.append(line)
+        if log:
+          log(f'  image line: {name} {row}')
+        continue
+
+      if kind == 'p' and stripped[1:2] == ' ':
+        ret.pano_tokens = tokenize(stripped[2:])
+        ret.pano_line = line
+        ret.pano = parse_pano_tokens(ret.pano_tokens, stripped)
+        ret.layout.append(('p', None))
+        if log:
+          log(f'  pano line:  {ret.pano}')
+        continue
+
+      if kind == 'v' and (stripped[1:2] == ' ' or stripped == 'v'):
+        if not any(l[0] == 'v' for l in ret.layout):
+          ret.layout.append(('v', None))
+        for key, value, quoted in tokenize(stripped[1:]):
+          if value:
+            optimize.append((key, int(value)))
+        continue
+
+      if kind == 'k' and stripped[1:2] == ' ':
+        if not ret.masks:
+          ret.layout.append(('k', None))
+        ret.masks.append(tokenize(stripped[2:]))
+        continue
+
+      ret.layout.append(('raw', line))
+
+  ret.images = np.array([tuple(r[k] for k in IMAGE_DTYPE.names) for r in rows], dtype = IMAGE_DTYPE)
+  ret.image_refs = { k : np.array(v, dtype = np.int32) for k, v in refs.items() }
+  if cps:
+    values = np.array(cps, dtype = np.float64)
+    ret.control_points = np.zeros(len(cps), dtype = CONTROL_POINT_DTYPE)
+    for i, k in enumerate(CONTROL_POINT_DTYPE.names):
+      ret.control_points[k] = values[:, i]
+  ret.optimize = np.array(optimize, dtype = OPTIMIZE_DTYPE)
+
+  if log:
+    log(f'  {len(ret.images)} images, {len(ret.control_points)} control points, {len(ret.optimize)} optimized variables, {len(ret.masks)} masks')
+
+  return ret
+
+def image_line(project, i):
+  '''
+  i line of image i; table values win over the original tokens, back references are kept
+  '''
+  parts = []
+  changed = False
+  row = project.images[i]
+  for key, value, quoted in project.image_tokens[i]:
+    if key == 'n' and quoted:
+      changed = changed or value != project.names[i]
+      value = project.names[i]
+    elif key in IMAGE_DTYPE.names:
+      ref = project.image_refs[key][i]
+      if ref >= 0:
+        changed = changed or value != f'={ref}'
+        value = f'={ref}'
+      else:
+        try:
+          unchanged = float(value) == float(row[key])
+        except ValueError:
+          unchanged = False
+        if not unchanged:
+          changed = True
+          value = format_number(row[key])
+    parts.append(format_token(key, value, quoted))
+
+  if not changed and i < len(project.image_lines):
+    return project.image_lines[i]
+  return 'i ' + ' '.join(parts)
+
+def control_point_line(n, N, x, y, X, Y, t):
+  return f'c n{n} N{N} x{format_number(x)} y{format_number(y)} X{format_number(X)} Y{format_number(Y)} t{t}'
+
+def write(project, f):
+  '''
+  Write a project to an open text file
+  '''
+  for kind, value in project.layout:
+    if kind == 'raw':
+      f.write(value + '\n')
+    elif kind == 'p':
+      line = 'p ' + ' '.join(format_token(*t) for t in project.pano_tokens)
+      if project.pano_line is not None and tokenize(project.pano_line.strip()[2:]) == project.pano_tokens:
+        line = project.pano_line
+      f.write(line + '\n')
+    elif kind == 'i':
+      f.write(image_line(project, value) + '\n')
+    elif kind == 'c':
+      f.writelines(control_point_line(*cp) + '\n' for cp in project.control_points.tolist())
+    elif kind == 'v':
+      for var, image in project.optimize:
+        f.write(f'v {var}{image}\n')
+      f.write('v\n')
+    elif kind == 'k':
+      for tokens in project.masks:
+        f.write('k ' + ' '.join(format_token(*t) for t in tokens) + '\n')
+
+def save(project, path):
+  with open(path, 'w') as f:
+    write(project, f)
@@ -1,10 +1,24 @@
 #!/usr/bin/env python3
 
 import math
+import numpy as np
 # See https://pillow.readthedocs.io/en/latest/installation/basic-installation.html
 from PIL import Image, ImageDraw, ImageFont
 import argparse
+import concurrent.futures
+import contextlib
+import cProfile
+import datetime
+import json
 import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import ptofile
+from panogeometry import cartesian_to_yaw_pitch, control_point_directions, crop_cells, image_footprints, outline_seam_polylines, wrap_angles
 
 '''
 Show pano layout on a rendered PNG image
@@ -14,453 +28,646 @@ Show pano layout on a rendered PNG image
 Only a very limited feature set is supported:
  - Output panorama projection is assumed to be equirectangular
  - Lenses are assumed to be rectilinear
- - Inefficient, partial lens correction implementation
+ - Partial lens correction implementation (a, b, c radial terms only)
  - no image center shift, no shearing correction
 
+Image outlines are sampled adaptively (dense only where the projection bends the edges) and split
+exactly at the +-180 degree seam.
+
+Coverage analysis (--coverage) rasterizes image footprints into a coarse grid over the crop area:
+coverage counts are drawn as a heatmap layer (holes red, multiple overlaps green to purple) and
+coverage, pairwise overlap and hole statistics are written to a JSON report.
+
+Control point analysis (--control-points) projects both ends of every control point in bulk and
+draws a density / residual heatmap layer: cells are more opaque where there are more points and
+colored by their largest residual (the distance of the two ends in panorama pixels, green to red at the
+cpclean like mean + 2 sigma limit). The worst points are marked and listed.
+
+Watch mode (--watch) keeps running while a project is tuned in Hugin: the PNG is re-rendered after
+each save of the PTO, re-projecting only images whose geometry changed over a cached background.
+
+Batch mode (-b) renders <name>-layout.png next to many PTOs (files or directory trees) in a
+process pool, skipping PTOs whose layout PNG is newer, and prints a summary with timings.
+
 Launch with -h to print CLI help
 See test/run-layout-test-renders.sh to exercise on synthetic panoramas
 '''
 
-def parse_image_line(line, prior_images):
-  # approxiate format, consider handling spaces in names
-  parts = line.split()
-
-  ret = {}
-  for part in parts:
-    if part.startswith('w'): 
-      ret['w'] = int(part[1:])
-
-    if part.startswith('h'): 
-      ret['h'] = int(part[1:])
-    
-    if part.startswith('r'): 
-      ret['r'] = float(part[1:])
-    
-    if part.startswith('p'): 
-      ret['p'] = float(part[1:])
-    
-    if part.startswith('y'): 
-      ret['y'] = float(part[1:])
-
-    if part.startswith('v='):
-      ret['v'] = prior_images[int(part[2:])]['v']
-    elif part.startswith('v'):
-      ret['v'] = float(part[1:])
-
-    if part.startswith('a='):
-      ret['a'] = prior_images[int(part[2:])]['a']
-    elif part.startswith('a'):
-      ret['a'] = float(part[1:])
-
-    if part.startswith('b='):
-      ret['b'] = prior_images[int(part[2:])]['b']
-    elif part.startswith('b'):
-      ret['b'] = float(part[1:])
-
-    if part.startswith('c='):
-      ret['c'] = prior_images[int(part[2:])]['c']
-    elif part.startswith('c'):
-      ret['c'] = float(part[1:])
-
-    if part.startswith('n"') and part.endswith('"'):
-      # todo: handle spaces in names 
-      ret['n'] = part[2:-1]
-
-  ret['v_vertical'] = ret['v'] * ret['h'] / ret['w']
-
-  print(f'  image line: {ret}')
-  return ret
-
-def parse_pano_line(line):
-  # n (nona opts?) part is totally mishandled
-  parts = line.split()
-  ret = {}
-  for part in parts:
-    if part.startswith('S'):
-      v = part[1:].split(',')
-      if len(v) != 4:
-        raise Exception(f'Expected 4 valuesm got {len(v)} in S part in p line "{line}"')
-      ret['crop_x1'] = int(v[0])
-      ret['crop_x2'] = int(v[1])
-      ret['crop_y1'] = int(v[2])
-      ret['crop_y2'] = int(v[3])
-
-    if part.startswith('w'): 
-     ret['w'] = int(part[1:])
-
-    if part.startswith('h'): 
-     ret['h'] = int(part[1:])
-
-    if part.startswith('v'): 
-     ret['v'] = float(part[1:])
-
-  # maybe incorrect?
-  ret['v_vertical'] = ret['v'] * ret['h'] / ret['w']
-
-  if not 'crop_x1' in ret:
-    ret['crop_x1'] = 0
-    ret['crop_x2'] = ret['w']
-    ret['crop_y1'] = 0
-    ret['crop_y2'] = ret['h']
-
-  print(f'  pano line:  {ret}')
-  return ret
-
-def load_pto(path):
-  ret = {
-    'images' : []
-  }
-  with open(path, 'r') as f:
-    for line in f:
-      line = line.strip()
-      if not line:
-        continue
-      if line.startswith('#'):
-        continue
-      if line.startswith('i'):
-        ret['images'].append(parse_image_line(line, ret['images']))
-      if line.startswith('p'):
-        ret['pano'] = parse_pano_line(line)
-    
-  return ret
+# Outline sampling tolerance in degrees; the chart has 5 px per degree
+outline_tolerance = 0.1
 
+def max_rss_mb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
-def append_line_segment(points, n, x1, y1, x2, y2):
+class StageProfile:
   '''
-  Append n points along line segment. End 1 will be included, end 2 will be excluded.
+  Instrumentation of a render (--profile): per stage wall / CPU time, process peak RSS after the stage
+  (the stage raising it shows the memory hot spot), counters and per image outline statistics.
+  With trace_memory, per stage peaks of Python / NumPy allocations are traced too (tracemalloc, slows
+  allocation heavy stages down several times). A disabled profile only runs the stages.
   '''
 
-  for i in range(n):
-    points.append((x1 + i * (x2 - x1) / n, y1 + i * (y2 - y1) / n))
+  def __init__(self, enabled, trace_memory = False):
+    self.enabled = enabled
+    self.trace_memory = enabled and trace_memory
+    self.stages = []
+    self.counts = {}
+    self.images = []
+    self.start_wall = time.perf_counter()
+    self.start_cpu = time.process_time()
+    if self.trace_memory:
+      tracemalloc.start()
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    if not self.enabled:
+      yield
+      return
+    if self.trace_memory:
+      tracemalloc.reset_peak()
+      base, _ = tracemalloc.get_traced_memory()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+      yield
+    finally:
+      record = {
+        'name' : name,
+        'wall_s' : time.perf_counter() - wall,
+        'cpu_s' : time.process_time() - cpu,
+        'max_rss_mb' : max_rss_mb()
+      }
+      if self.trace_memory:
+        record['traced_peak_mb'] = (tracemalloc.get_traced_memory()[1] - base) / (1024 * 1024)
+      self.stages.append(record)
+
+  def count(self, name, value):
+    if self.enabled:
+      self.counts[name] = self.counts.get(name, 0) + value
+
+  def record_outlines(self, outlines, names):
+    '''
+    Outline point / segment counts; projection is vectorized over all images, the per image cost is
+    the last project_outlines stage time apportioned by sampled points
+    '''
+    if not self.enabled:
+      return
+    points = [sum(len(polyline) for polyline in polylines) for polylines in outlines]
+    total = max(1, sum(points))
+    seconds = next((s['wall_s'] for s in reversed(self.stages) if s['name'] == 'project_outlines'), 0)
+    self.count('outline_points', sum(points))
+    self.count('outline_segments', sum(len(polyline) - 1 for polylines in outlines for polyline in polylines))
+    self.count('outline_polylines', sum(len(polylines) for polylines in outlines))
+    self.images = [{
+      'index' : i,
+      'name' : names[i],
+      'outline_points' : points[i],
+      'outline_polylines' : len(outlines[i]),
+      'projection_s' : seconds * points[i] / total
+    } for i in range(len(outlines))]
+
+  def report(self, path):
+    '''
+    JSON serializable trace
+    '''
+    return {
+      'pto' : os.path.abspath(path),
+      'time' : datetime.datetime.now().isoformat(timespec = 'seconds'),
+      'python' : platform.python_version(),
+      'stages' : self.stages,
+      'total' : {
+        'wall_s' : time.perf_counter() - self.start_wall,
+        'cpu_s' : time.process_time() - self.start_cpu,
+        'max_rss_mb' : max_rss_mb()
+      },
+      'counts' : self.counts,
+      'images' : self.images
+    }
+
+  def summary_line(self, report):
+    '''
+    Single machine readable line (for logs): LAYOUT_PROFILE followed by compact JSON of stage wall
+    times, totals and counts
+    '''
+    summary = { s['name'] : round(s['wall_s'], 4) for s in report['stages'] }
+    summary['total'] = round(report['total']['wall_s'], 4)
+    summary['max_rss_mb'] = round(report['total']['max_rss_mb'], 1)
+    summary.update(report['counts'])
+    return 'LAYOUT_PROFILE ' + json.dumps(summary, separators = (',', ':'))
+
+# Disabled profile of renders without --profile
+no_profile = StageProfile(False)
 
+def translate(dx, dy, points):
+  return [ (dx + x, dy + y) for (x, y) in points ]
 
-def gen_rect(points, w, h):
+# Heatmap RGBA colors by cell coverage count; the last one is used for all higher counts
+coverage_colors = np.array([
+  (255, 0, 0, 110),
+  (0, 0, 0, 0),
+  (0, 160, 0, 35),
+  (255, 200, 0, 60),
+  (255, 120, 0, 80),
+  (200, 0, 120, 100)
+], dtype = np.uint8)
+
+def label_regions(mask, wrap):
   '''
-  Clockwise zero centered rectangle perimeter
+  4-connected regions of a boolean (rows, columns) grid, columns wrap around if wrap is set;
+  list of (row indices, column indices) array pairs
   '''
+  rows, cols = mask.shape
+  todo = mask.tolist()
   ret = []
-  append_line_segment(ret, points, -w / 2, -h / 2,  w / 2, -h / 2)
-  append_line_segment(ret, points,  w / 2, -h / 2,  w / 2,  h / 2)
-  append_line_segment(ret, points,  w / 2,  h / 2, -w / 2,  h / 2)
-  append_line_segment(ret, points, -w / 2,  h / 2, -w / 2, -h / 2)
+  for r0, c0 in zip(*np.nonzero(mask)):
+    if not todo[r0][c0]:
+      continue
+    todo[r0][c0] = False
+    stack = [(int(r0), int(c0))]
+    cells = []
+    while stack:
+      r, c = stack.pop()
+      cells.append((r, c))
+      for nr, nc in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)):
+        if wrap:
+          nc = nc % cols
+        if 0 <= nr < rows and 0 <= nc < cols and todo[nr][nc]:
+          todo[nr][nc] = False
+          stack.append((nr, nc))
+    cells = np.array(cells)
+    ret.append((cells[:, 0], cells[:, 1]))
   return ret
 
-def image_xy_to_equirectangular_yaw_pitch(points, v, w, h):
+def coverage_stats(pto, path, cell_deg, cache = None):
   '''
-  Transform image pixel coordinates to equirectangular projected coordinates (angles)
+  Coverage counts (rows, columns) of a coarse grid over the crop area and a JSON serializable report:
+  covered / hole areas, coverage count histogram, per image and pairwise overlap areas, holes.
+  Areas are solid angles in square degrees. Footprints of unchanged images are reused from the optional
+  LayoutCache.
   '''
+  yaws, pitches, cell_w, cell_h = crop_cells(pto.pano, cell_deg)
+  if cache:
+    masks = cache.get_footprints(pto.images, yaws, pitches)
+  else:
+    masks = image_footprints(pto.images, yaws, pitches)
+  counts = masks.sum(axis = 0)
+
+  cell_area = np.broadcast_to((cell_w * cell_h * np.cos(pitches * np.pi / 180))[:, None], counts.shape)
+  total = float(cell_area.sum())
+  histogram = np.bincount(counts.ravel(), weights = cell_area.ravel())
+
+  image_area = (masks * cell_area).sum(axis = (1, 2))
+  exclusive_area = ((masks & (counts == 1)) * cell_area).sum(axis = (1, 2))
+
+  # pairwise overlap areas as a matrix product over the cells covered more than once
+  shared = counts >= 2
+  m = masks[:, shared].astype(np.float32)
+  overlap = (m * cell_area[shared].astype(np.float32)) @ m.T
+  pairs = []
+  for a, b in zip(*np.nonzero(np.triu(overlap, 1))):
+    area = float(overlap[a, b])
+    smaller = min(image_area[a], image_area[b])
+    pairs.append({
+      'images' : [int(a), int(b)],
+      'area' : area,
+      'fraction_of_smaller' : area / smaller if smaller > 0 else 0
+    })
+  pairs.sort(key = lambda p: -p['area'])
+
+  wrap = len(yaws) * cell_w >= 360 - 1e-9
+  holes = []
+  for rows, cols in label_regions(counts == 0, wrap):
+    holes.append({
+      'cells' : len(rows),
+      'area' : float(cell_area[rows, cols].sum()),
+      'yaw' : [float(yaws[cols].min() - cell_w / 2), float(yaws[cols].max() + cell_w / 2)],
+      'pitch' : [float(pitches[rows].min() - cell_h / 2), float(pitches[rows].max() + cell_h / 2)]
+    })
+  holes.sort(key = lambda h: -h['area'])
+
+  report = {
+    'pto' : os.path.abspath(path),
+    'grid' : {
+      'columns' : len(yaws),
+      'rows' : len(pitches),
+      'cell_width' : cell_w,
+      'cell_height' : cell_h,
+      'yaw' : [float(yaws[0] - cell_w / 2), float(yaws[-1] + cell_w / 2)],
+      'pitch' : [float(pitches[0] + cell_h / 2), float(pitches[-1] - cell_h / 2)]
+    },
+    'crop_area' : total,
+    'covered_fraction' : 1 - float(histogram[0]) / total if total > 0 else 0,
+    'hole_area' : float(histogram[0]),
+    'max_coverage' : int(counts.max()) if counts.size else 0,
+    'coverage_histogram' : { str(i) : float(a) for i, a in enumerate(histogram) },
+    'images' : [{
+      'index' : i,
+      'name' : pto.names[i],
+      'area' : float(image_area[i]),
+      'exclusive_area' : float(exclusive_area[i]),
+      'overlap_fraction' : 1 - float(exclusive_area[i] / image_area[i]) if image_area[i] > 0 else 0
+    } for i in range(len(pto.images))],
+    'pairs' : pairs,
+    'holes' : holes
+  }
+  return counts, report
 
-  d = w / (2 * math.tan(math.pi * v / 360))
+def coverage_summary(report):
+  return (f'{100 * report["covered_fraction"]:.1f}% of crop covered, {len(report["holes"])} holes, '
+    f'{len(report["pairs"])} overlapping pairs, max {report["max_coverage"]} images per cell')
 
-  ret = []
-  for (x, y) in points:
-    tan_pitch = y / math.sqrt( d * d + x * x)
-    tan_yaw   = x / d
-    ret.append((180 * math.atan(tan_yaw) / math.pi, 180 * math.atan(tan_pitch) / math.pi))
+# Residual heatmap colors from 0 to the residual scale (and above)
+residual_colors = np.array([
+  (0, 170, 0),
+  (240, 200, 0),
+  (230, 0, 0)
+], dtype = float)
 
-  return ret
-
-def add_yaw_pitch(points, yaw, pitch):
+def control_point_stats(pto, cell_deg, worst, scale = None):
   '''
-  Rotate spherical coordinates.
-    - Two (yaw, pitch) rotations are applied to spherical (y, p) coordinates
-      - rotate around the yaw (vertical cartesian, used "y" here) is the first step
-      - yaw rotation rotates the cartesian "x" (and "z") axes
-      - pitch rotation is done around the (yaw rotated)"z" axis
+  Chart positions (points, 2, 2) of both control point ends (yaw, pitch), their residuals in panorama
+  pixels and a JSON serializable report: residual statistics, heatmap cell size and residual scale
+  (mean + 2 sigma unless given) and the worst points. Line control points (t > 0) are left out.
   '''
+  cps = pto.control_points
+  indices = np.flatnonzero(cps['t'] == 0)
+  directions = control_point_directions(pto.images, cps[indices])
+  positions = cartesian_to_yaw_pitch(directions)
+  residuals = np.degrees(2 * np.arcsin(np.clip(np.linalg.norm(directions[:, 0] - directions[:, 1], axis = -1) / 2, 0, 1)))
+  residuals = residuals * pto.pano['w'] / pto.pano['v']
+
+  mean = float(residuals.mean()) if len(residuals) else 0
+  std = float(residuals.std()) if len(residuals) else 0
+  order = np.argsort(-residuals, kind = 'stable')[:worst]
+  report = {
+    'control_points' : len(indices),
+    'line_control_points' : len(cps) - len(indices),
+    'mean' : mean,
+    'std' : std,
+    'median' : float(np.median(residuals)) if len(residuals) else 0,
+    'max' : float(residuals.max()) if len(residuals) else 0,
+    'cell' : cell_deg,
+    'scale' : scale if scale else max(mean + 2 * std, 1e-9),
+    'worst' : [{
+      'index' : int(indices[i]),
+      'images' : [int(cps['n'][indices[i]]), int(cps['N'][indices[i]])],
+      'residual' : float(residuals[i]),
+      'ends' : positions[i].tolist()
+    } for i in order]
+  }
+  return positions, residuals, report
 
-  # yaw, pitch angles of rotation
-  yaw_rad = yaw * math.pi / 180
-  pitch_rad = pitch * math.pi / 180
-
-  sin_yaw = math.sin(yaw_rad)
-  cos_yaw = math.cos(yaw_rad)
-  sin_pitch = math.sin(pitch_rad)
-  cos_pitch = math.cos(pitch_rad)
-
-  ret = []
-
-  for (y1, p1) in points:
-    # [1] current point denoted by (y1,p1) spherical coordinates (which needs further rotation)
-    y1_rad = y1 * math.pi / 180
-    p1_rad = p1 * math.pi / 180
-
-    sin_y1 = math.sin(y1_rad)
-    cos_y1 = math.cos(y1_rad)
-    sin_p1 = math.sin(p1_rad)
-    cos_p1 = math.cos(p1_rad)
-
-    # cartesian coordinates or [1] before yaw/pitch further rotation
-    cx1 = cos_y1 * cos_p1
-    cy1 = sin_p1
-    cz1 = sin_y1 * cos_p1
-
-    # [2] further rotated cartesian coordinates of [1] in the yawed cartesian coordinate system (yx points to y=0; yy points upward, yz is the axis of pitch)
-    cx2 = cx1 * cos_pitch - cy1 * sin_pitch
-    cy2 = cx1 * sin_pitch + cy1 * cos_pitch
-    cz2 = cz1
-
-    # [3] pitch and yaw rotated cartesian coordinates in the original coordinate system
-    cx3 = cx2 * cos_yaw - cz2 * sin_yaw
-    cy3 = cy2
-    cz3 = cx2 * sin_yaw + cz2 * cos_yaw
-
-    # calculate spherical coordinates of rotated point
-    # note that spherical coordinates to cartesian transformation is
-    #   cartesian_x = cos(yaw)   * cos(pitch)
-    #   cartesian_y = sin(pitch)
-    #   cartesian_z = sin(yaw)   * cos(pitch)
-
-    # values outside -1.0 .. 1.0 range (due to floating point ops) will fail arc sin
-    cy3 = max(-1, cy3)
-    cy3 = min(1, cy3)
-
-    p3_rad = math.asin(cy3)
-    cos_p3 = math.cos(p3_rad)
-
-
-    cos_y3 = cx3 / cos_p3
-
-    if cos_p3 == 0:
-      # zenith or nadir
-      y3_rad = 0
-    else:
-      sin_y3 = cz3 / cos_p3
-      sin_y3 = max(-1, sin_y3)
-      sin_y3 = min(1, sin_y3)
-      y3_rad = math.asin(sin_y3)
-
-      # arc sin will be in the -90 deg .. +90 deg range
-      # use the cos value to decide the quadrant
-
-      if cos_y3 < 0:
-        # yaw_3 is outside the -90 deg .. 90 deg range
-        if sin_y3 > 0:
-          y3_rad = math.pi - y3_rad
-        else:
-          y3_rad = - math.pi - y3_rad
-
-    ret.append((180 * y3_rad / math.pi, 180 * p3_rad / math.pi))
+def control_point_summary(report):
+  return (f'{report["control_points"]} points, mean {report["mean"]:.2f} px, max {report["max"]:.2f} px, '
+    f'red from {report["scale"]:.2f} px')
 
-  return ret
-
-def correct_lens_distortion(points, unitd, maxd, a, b, c):
+def control_point_heatmap(positions, residuals, report):
   '''
-  See https://hugin.sourceforge.io/docs/manual/Lens_correction_model.html
-  And https://wiki.panotools.org/index.php?title=Lens_distortion&oldid=9434
+  RGBA heatmap (rows, columns) of both control point ends over the full sphere: opacity by point
+  count (logarithmic), color by the largest residual; a single bad match stands out in a dense cell
+  '''
+  cell = report['cell']
+  cols = math.ceil(360 / cell)
+  rows = math.ceil(180 / cell)
+  c = np.clip(((positions[..., 0] + 180) / cell).astype(np.int64), 0, cols - 1)
+  r = np.clip(((90 - positions[..., 1]) / cell).astype(np.int64), 0, rows - 1)
+  cells = (r * cols + c).ravel()
+  counts = np.bincount(cells, minlength = rows * cols)
+  largest = np.zeros(rows * cols)
+  np.maximum.at(largest, cells, np.repeat(residuals, 2))
+
+  t = largest / report['scale']
+  stops = np.linspace(0, 1, len(residual_colors))
+  rgba = np.zeros((rows * cols, 4), dtype = np.uint8)
+  for channel in range(3):
+    rgba[:, channel] = np.interp(t, stops, residual_colors[:, channel])
+  if counts.max() > 0:
+    rgba[:, 3] = np.where(counts > 0, 70 + 185 * np.log1p(counts) / np.log1p(counts.max()), 0)
+  return rgba.reshape(rows, cols, 4)
+
+class CachedFont(ImageFont.FreeTypeFont):
+  '''
+  FreeType font remembering rendered text masks (by text, anchor, subpixel position, ...), so labels
+  of unchanged images are not rendered again in watch mode
   '''
 
-  d = 1 - (a + b + c)
-
-  img_to_corrected = [0]
-  i = 0
-  img_r = 0
-  corr_r = 0
-  while img_r <= 1.1 * maxd and corr_r < 3:
-    img_r = corr_r * (a * corr_r * corr_r * corr_r  + b * corr_r * corr_r + c * corr_r + d)
-    i_next = round(img_r * 1000)
-    while i < i_next:
-      img_to_corrected.append(corr_r)
-      i = i + 1
-    corr_r = corr_r + 0.001
-
-  ret = []
-
-  for (x, y) in points:
-
-    img_r = math.sqrt(x * x + y * y) / unitd
-    ii = round(img_r * 1000)
-    if ii >= len(img_to_corrected):
-      ii = len(img_to_corrected) - 1
-    corr_r = img_to_corrected[ii]
-    ratio = corr_r / img_r
-
-    ret.append((x * ratio, y * ratio))
-
-  return ret
-
-
-def rotate_image_xy(points, ccw):
-  # since no center shift is supported roll is around the origin
-  # pixel space can be used since radial distance (used by subsequent lens correction) is not changed
-  a = ccw * math.pi / 180
-  xx, xy, yx, yy = math.cos(a), -math.sin(a), math.sin(a), math.cos(a)
-  return [ (xx * x + yx * y, xy * x + yy * y) for (x, y) in points ]
-
-def translate(dx, dy, points):
-  return [ (dx + x, dy + y) for (x, y) in points ]
-
-def main():
-  parser = argparse.ArgumentParser(
-    description="Show (or output as PNG) a panorama layout."
-  )
-
-  parser.add_argument('-i', '--input',  type=str, required=True, help='Input PTO file (required).')
-  parser.add_argument('-o', '--output', type=str, help='Output PNG file instead of display.')
-  parser.add_argument('--image-outline-color', type=str, default='#ccc', help='Image outline color (default: "#ccc")')
-  parser.add_argument('--image-outline-width', type=int, default=1, help='Image outline line width (default: 1)')
-
-  args = parser.parse_args()
-
-  print()
-  print()
-  print(f'Load PTO from {args.input}')
-  pto = load_pto(args.input)
-  print()
-  print()
-  print('Draw chart')
-
-  w, h = 1920, 1080
-
-  img = Image.new('RGB', (w, h), 'white')
-  draw = ImageDraw.Draw(img)
-
-  # Pano chart area width, height in pixels
-  cw, ch = 1800, 900
-
-  # Left / right / middle point
-  cx1 = (w - cw) / 2
-  cx2 = cx1 + cw
-  cx0 = (cx1 + cx2) / 2
-
-  # top / bottom / middle point
-  cy1 = h - ch - cx1
-  cy2 = cy1 + ch
-  cy0 = (cy1 + cy2) / 2
-
-  def y2x(yaw, wrap=True):
-    if wrap:
-      while yaw > 180:
-        yaw = yaw - 360
-      while yaw < -180:
-        yaw = yaw + 360
-    return cx0 + cw * yaw / 360
-
-  def p2y(pitch, wrap=True):
-    if wrap:
-      while pitch > 90:
-        pitch = pitch - 180
-      while pitch < -90:
-        pitch = pitch + 180
-    return cy0 - ch * pitch / 180
-
-  def yp2xy(yaw, pitch, wrap=True):
-    return y2x(yaw, wrap=wrap), p2y(pitch, wrap=wrap)
-
-  def map_yp2xy(points):
-    return [ yp2xy(y, p, wrap=True) for (y,p) in points ]
-
-  grid_color = '#eee'
-
+  max_masks = 100000
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.masks = {}
+
+  def getmask2(self, text, *args, **kwargs):
+    key = (text, args, tuple(sorted(kwargs.items())))
+    try:
+      return self.masks[key]
+    except KeyError:
+      pass
+    except TypeError:
+      # unhashable arguments (e.g. a features list)
+      return super().getmask2(text, *args, **kwargs)
+    if len(self.masks) >= self.max_masks:
+      self.masks.clear()
+    ret = self.masks[key] = super().getmask2(text, *args, **kwargs)
+    return ret
+
+def load_fonts(cached = False):
+  '''
+  Label fonts by role; loaded once per process. Cached fonts remember rendered labels (see CachedFont).
+  '''
   # see https://stackoverflow.com/questions/918154/relative-paths-in-python
   # Font retrieved from https://fonts.google.com/specimen/Roboto+Condensed/license
   # licensed under the SIL OPEN FONT LICENSE Version 1.1 - 26 February 2007 (https://openfontlicense.org/open-font-license-official-text/).
   dirname = os.path.dirname(__file__)
   roboto_condensed_regular_ttf = os.path.join(dirname, 'RobotoCondensed-Regular.ttf')
+  font = CachedFont if cached else ImageFont.truetype
+
+  return {
+    'chart_label1' : font(roboto_condensed_regular_ttf, 35),
+    'chart_label2' : font(roboto_condensed_regular_ttf, 25),
+    'grid_label' : font(roboto_condensed_regular_ttf, 25),
+    'img_label1' : font(roboto_condensed_regular_ttf, 20),
+    'img_label2' : font(roboto_condensed_regular_ttf, 12)
+  }
 
-  chart_label1_font = ImageFont.truetype(roboto_condensed_regular_ttf, 35)
-  chart_label2_font = ImageFont.truetype(roboto_condensed_regular_ttf, 25)
-  chart_label1_font_height = 35
-  chart_label_color = '#bbb'
+# Chart image size and the pano chart area in it, in pixels
+chart_w, chart_h = 1920, 1080
+chart_cw, chart_ch = 1800, 900
+
+# Left / right / middle point of the chart area
+chart_cx1 = (chart_w - chart_cw) / 2
+chart_cx2 = chart_cx1 + chart_cw
+chart_cx0 = (chart_cx1 + chart_cx2) / 2
+
+# top / bottom / middle point
+chart_cy1 = chart_h - chart_ch - chart_cx1
+chart_cy2 = chart_cy1 + chart_ch
+chart_cy0 = (chart_cy1 + chart_cy2) / 2
+
+grid_color = '#eee'
+
+chart_label1_font_height = 35
+chart_label_color = '#bbb'
+grid_label_color = '#bbb'
+img_label_color = '#666'
+worst_cp_color = '#d00'
+
+def y2x(yaw, wrap=True):
+  if wrap:
+    while yaw > 180:
+      yaw = yaw - 360
+    while yaw < -180:
+      yaw = yaw + 360
+  return chart_cx0 + chart_cw * yaw / 360
+
+def p2y(pitch, wrap=True):
+  if wrap:
+    while pitch > 90:
+      pitch = pitch - 180
+    while pitch < -90:
+      pitch = pitch + 180
+  return chart_cy0 - chart_ch * pitch / 180
+
+def yp2xy(yaw, pitch, wrap=True):
+  return y2x(yaw, wrap=wrap), p2y(pitch, wrap=wrap)
+
+def map_yp2xy(points):
+  '''
+  Chart pixel coordinates of a (..., 2) yaw, pitch array
+  '''
+  yaw = wrap_angles(points[..., 0], 180)
+  pitch = wrap_angles(points[..., 1], 90)
+  return np.stack((chart_cx0 + chart_cw * yaw / 360, chart_cy0 - chart_ch * pitch / 180), axis = -1)
 
-  grid_label_font = ImageFont.truetype(roboto_condensed_regular_ttf, 25)
-  grid_label_color = '#bbb'
-  img_label1_font = ImageFont.truetype(roboto_condensed_regular_ttf, 20)
-  img_label2_font = ImageFont.truetype(roboto_condensed_regular_ttf, 12)
-  img_label_color = '#666'
+def pano_texts(pano):
+  '''
+  Cropped size and FOV label texts of a p line
+  '''
+  pano_pixels = (pano['crop_x2'] - pano['crop_x1']) * (pano['crop_y2'] - pano['crop_y1'])
+  cropped_size = f'{pano['w']}px x {pano['h']}px ({round(pano_pixels / 1000000)} Mpx)'
+  pano_fov = f'{round(pano['v'])}° x {round(pano['v_vertical'])}°'
+  return cropped_size, pano_fov
+
+def render_background(pto, path, fonts):
+  '''
+  Chart label and degree grid layer; depends only on the path, the p line and the image count / sizes
+  '''
+  pano = pto.pano
+  img = Image.new('RGB', (chart_w, chart_h), 'white')
+  draw = ImageDraw.Draw(img)
 
   # Chart label
   draw.text((20, 20), 
-    os.path.abspath(args.input), 
-    fill=chart_label_color, font=chart_label1_font, anchor='lt')
-  pano_pixels = (pto['pano']['crop_x2'] - pto['pano']['crop_x1']) * (pto['pano']['crop_y2'] - pto['pano']['crop_y1'])
-  cropped_size = f'{pto['pano']['w']}px x {pto['pano']['h']}px ({round(pano_pixels / 1000000)} Mpx)'
-  images_pixels = sum([i['w'] * i['h'] for i in pto['images']])
-  pano_fov = f'{round(pto['pano']['v'])}° x {round(pto['pano']['v_vertical'])}°'
+    os.path.abspath(path), 
+    fill=chart_label_color, font=fonts['chart_label1'], anchor='lt')
+  cropped_size, pano_fov = pano_texts(pano)
+  images_pixels = int(np.sum(pto.images['w'].astype(np.int64) * pto.images['h']))
   draw.text((20, 20 + chart_label1_font_height), 
-    f'{pano_fov}, {cropped_size}, {len(pto['images'])} images (of {round(images_pixels / 1000000)} Mpx)',
-    fill=chart_label_color, font=chart_label2_font, anchor='lt')
+    f'{pano_fov}, {cropped_size}, {len(pto.images)} images (of {round(images_pixels / 1000000)} Mpx)',
+    fill=chart_label_color, font=fonts['chart_label2'], anchor='lt')
 
   # Degree grid with labels
   # yaw
   for i in range(-180, 181, 10):
     x = y2x(i)
     lw = 3 if i % 180 == 0 else 1
-    draw.line([x, cy1, x, cy2], fill = grid_color, width = lw)
+    draw.line([x, chart_cy1, x, chart_cy2], fill = grid_color, width = lw)
 
     if i % 30 == 0:
       t = str(i)
       # see https://pillow.readthedocs.io/en/stable/handbook/text-anchors.html
-      draw.text((x, cy2 + 15), t, fill=grid_label_color, font=grid_label_font, anchor='mt')
+      draw.text((x, chart_cy2 + 15), t, fill=grid_label_color, font=fonts['grid_label'], anchor='mt')
   
   # pitch
   for i in range(-90, 91, 10):
     y = p2y(i)
     lw = 3 if i % 90 == 0 else 1
-    draw.line([cx1, y, cx2, y], fill = grid_color, width = lw)
+    draw.line([chart_cx1, y, chart_cx2, y], fill = grid_color, width = lw)
 
     if i % 30 == 0:
       t = str(i)
-      draw.text((cx1 - 10, y), t, fill=grid_label_color, font=grid_label_font, anchor='rm')
+      draw.text((chart_cx1 - 10, y), t, fill=grid_label_color, font=fonts['grid_label'], anchor='rm')
+
+  return img
+
+def chart_outlines(images):
+  '''
+  Image outlines as chart pixel polylines; per image lists of (x, y) tuple lists
+  '''
+  # adaptive sampling, split at the +-180 seam; no wrap around segments to drop
+  return [[[tuple(p) for p in map_yp2xy(polyline).tolist()] for polyline in polylines]
+    for polylines in outline_seam_polylines(images, outline_tolerance)]
+
+class LayoutCache:
+  '''
+  Render state kept between renders of a changing project (watch mode)
+
+    background:  background layer and the values it was drawn for
+    outlines:    chart outlines by image geometry (w, h, v, y, p, r, a, b, c values)
+    footprints:  packed coverage footprints by image geometry, for the grid in footprint_grid
+    projected:   number of images projected by the last render (not found in the caches)
+  '''
+
+  geometry = ['w', 'h', 'v', 'y', 'p', 'r', 'a', 'b', 'c']
+
+  def __init__(self):
+    self.background = (None, None)
+    self.outlines = {}
+    self.footprints = {}
+    self.footprint_grid = None
+    self.projected = 0
+
+  def geometry_keys(self, images):
+    return images[self.geometry].tolist()
+
+  def get_background(self, pto, path, fonts):
+    key = (os.path.abspath(path), tuple(pto.pano.items()), len(pto.images),
+      int(np.sum(pto.images['w'].astype(np.int64) * pto.images['h'])))
+    if self.background[0] != key:
+      self.background = (key, render_background(pto, path, fonts))
+    return self.background[1]
+
+  def get_outlines(self, images):
+    keys = self.geometry_keys(images)
+    missing = [i for i, k in enumerate(keys) if k not in self.outlines]
+    if missing:
+      for i, outline in zip(missing, chart_outlines(images[missing])):
+        self.outlines[keys[i]] = outline
+    self.projected = len(missing)
+
+    # forget images no longer in the project
+    if len(self.outlines) > len(keys):
+      self.outlines = { k : self.outlines[k] for k in keys }
+    return [self.outlines[k] for k in keys]
+
+  def get_footprints(self, images, yaws, pitches):
+    grid = (yaws.tobytes(), pitches.tobytes())
+    if self.footprint_grid != grid:
+      self.footprint_grid = grid
+      self.footprints = {}
+
+    keys = self.geometry_keys(images)
+    missing = [i for i, k in enumerate(keys) if k not in self.footprints]
+    if missing:
+      for i, mask in zip(missing, image_footprints(images[missing], yaws, pitches)):
+        self.footprints[keys[i]] = np.packbits(mask)
+    if len(self.footprints) > len(keys):
+      self.footprints = { k : self.footprints[k] for k in keys }
+
+    shape = (len(pitches), len(yaws))
+    ret = np.zeros((len(images),) + shape, dtype = bool)
+    for i, k in enumerate(keys):
+      ret[i] = np.unpackbits(self.footprints[k], count = shape[0] * shape[1]).reshape(shape)
+    return ret
+
+def render_layout(pto, path, fonts, outline_color = '#ccc', outline_width = 1, coverage = None, cache = None, profile = no_profile,
+  control_points = None):
+  '''
+  Layout chart image of a parsed PTO (path is shown in the chart label); coverage is an optional
+  (counts, report) pair of coverage_stats() drawn as a heatmap layer; control_points is an optional
+  (positions, residuals, report) result of control_point_stats() drawn as a heatmap layer with the
+  worst points marked; cache is an optional LayoutCache kept between renders; drawing stages are
+  recorded in the StageProfile
+  '''
+  pano = pto.pano
+  if pano is None:
+    raise Exception(f'No p line in {path}')
+  if cache is None:
+    cache = LayoutCache()
+
+  with profile.stage('background'):
+    img = cache.get_background(pto, path, fonts).copy()
+  draw = ImageDraw.Draw(img)
+  cropped_size, pano_fov = pano_texts(pano)
+
+  # Coverage heatmap over the crop area
+  if coverage:
+    counts, report = coverage
+    grid = report['grid']
+    x1, y1 = round(y2x(grid['yaw'][0], wrap=False)), round(p2y(grid['pitch'][0], wrap=False))
+    x2, y2 = round(y2x(grid['yaw'][1], wrap=False)), round(p2y(grid['pitch'][1], wrap=False))
+    heatmap = Image.fromarray(coverage_colors[np.minimum(counts, len(coverage_colors) - 1)], 'RGBA')
+    heatmap = heatmap.resize((max(1, x2 - x1), max(1, y2 - y1)), Image.Resampling.NEAREST)
+    img.paste(heatmap, (x1, y1), heatmap)
+    draw.text((chart_w - 20, 20 + chart_label1_font_height), f'Coverage: {coverage_summary(report)}',
+      fill=chart_label_color, font=fonts['chart_label2'], anchor='rt')
+
+  # Control point density / residual heatmap over the whole chart area
+  if control_points:
+    with profile.stage('draw_control_points'):
+      positions, residuals, report = control_points
+      heatmap = Image.fromarray(control_point_heatmap(positions, residuals, report), 'RGBA')
+      heatmap = heatmap.resize((chart_cw, chart_ch), Image.Resampling.NEAREST)
+      img.paste(heatmap, (round(chart_cx1), round(chart_cy1)), heatmap)
+      draw.text((chart_w - 20, 20), f'Control points: {control_point_summary(report)}',
+        fill=chart_label_color, font=fonts['chart_label2'], anchor='rt')
 
   # Individual image outlines
-  for i, ii in enumerate(pto['images']):
-    # generate image perimeter in pixel space, origo centered
-    imgr = gen_rect(50, ii['w'], ii['h'])
-
-    # radial pixel distance is normalized for lens correction polinomial using the shortest size
-    # see https://wiki.panotools.org/Lens_correction_model
-    # "... the largest circle that completely fits into an image is said to have radius=1.0 ..."
-    radial_unit_distance = min(ii['w'], ii['h']) / 2
-
-    # maximal radial pixel distance after normalizaton
-    # this is the normalized distance of a corner
-    max_normalized_radial_distance = math.sqrt(ii['w'] * ii['w'] + ii['h'] * ii['h'] ) / (2 * radial_unit_distance)
-
-    imgr = correct_lens_distortion(imgr, radial_unit_distance, max_normalized_radial_distance, ii['a'], ii['b'], ii['c'])
-    imgr = rotate_image_xy(imgr, ii['r'])
-    imgr = image_xy_to_equirectangular_yaw_pitch(imgr, ii['v'], ii['w'], ii['h'])
-    imgr = add_yaw_pitch(imgr, ii['y'], ii['p'])
-    imgr = map_yp2xy(imgr)
-
-    for i1 in range(len(imgr)):
-      p1 = imgr[i1]
-      p2 = imgr[(i1 + 1) % len(imgr)]
-
-      x1, _ = p1
-      x2, _ = p2
-      if abs(x1 - x2) < 500:
-        # dont draw wrap around segments
-        draw.line([p1, p2], fill=args.image_outline_color, width=args.image_outline_width)
+  with profile.stage('project_outlines'):
+    outlines = cache.get_outlines(pto.images)
+  profile.record_outlines(outlines, pto.names)
+  with profile.stage('draw_outlines'):
+    for polylines in outlines:
+      for polyline in polylines:
+        draw.line(polyline, fill=outline_color, width=outline_width)
+
+  if control_points:
+    with profile.stage('draw_worst_control_points'):
+      draw_worst_control_points(draw, control_points[2], fonts)
+
+  with profile.stage('draw_labels'):
+    draw_labels(draw, pto, fonts, cropped_size, pano_fov)
+  profile.count('labels', 2 * len(pto.images) + 2)
+
+  return img
+
+def draw_worst_control_points(draw, report, fonts):
+  '''
+  Mark the worst control points of the report: both ends circled and connected (unless the line would
+  cross the +-180 seam), labeled with the residual
+  '''
+  for cp in report['worst']:
+    (x1, y1), (x2, y2) = map_yp2xy(np.array(cp['ends'])).tolist()
+    if abs(x2 - x1) < chart_cw / 2:
+      draw.line([x1, y1, x2, y2], fill=worst_cp_color, width=2)
+    for x, y in ((x1, y1), (x2, y2)):
+      draw.ellipse([x - 6, y - 6, x + 6, y + 6], fill = None, outline = worst_cp_color, width = 2)
+    draw.text((x1 + 8, y1 - 8), f'{cp["residual"]:.1f}', fill=worst_cp_color, font=fonts['img_label2'], anchor='lb')
+
+def draw_labels(draw, pto, fonts, cropped_size, pano_fov):
+  '''
+  Pano bounds, crop area, image labels and center / rotation markers over the outlines
+  '''
+  pano = pto.pano
 
   # pano bounds
-  view_horizontal_half = cw * pto['pano']['v'] / 720
-  view_vertical_half = ch * pto['pano']['v_vertical'] /360
+  view_horizontal_half = chart_cw * pano['v'] / 720
+  view_vertical_half = chart_ch * pano['v_vertical'] /360
   draw.rectangle(
-    [cx0 - view_horizontal_half, cy0 - view_vertical_half, cx0 + view_horizontal_half, cy0 + view_vertical_half],
+    [chart_cx0 - view_horizontal_half, chart_cy0 - view_vertical_half, chart_cx0 + view_horizontal_half, chart_cy0 + view_vertical_half],
     fill = None, outline = '#888', width = 1)
 
-  crop_x1 = cx0 - view_horizontal_half + 2 * view_horizontal_half * pto['pano']['crop_x1'] / pto['pano']['w']
-  crop_x2 = cx0 - view_horizontal_half + 2 * view_horizontal_half * pto['pano']['crop_x2'] / pto['pano']['w']
-  crop_y1 = cy0 - view_vertical_half + 2 * view_vertical_half * pto['pano']['crop_y1'] / pto['pano']['h']
-  crop_y2 = cy0 - view_vertical_half + 2 * view_vertical_half * pto['pano']['crop_y2'] / pto['pano']['h']
+  crop_x1 = chart_cx0 - view_horizontal_half + 2 * view_horizontal_half * pano['crop_x1'] / pano['w']
+  crop_x2 = chart_cx0 - view_horizontal_half + 2 * view_horizontal_half * pano['crop_x2'] / pano['w']
+  crop_y1 = chart_cy0 - view_vertical_half + 2 * view_vertical_half * pano['crop_y1'] / pano['h']
+  crop_y2 = chart_cy0 - view_vertical_half + 2 * view_vertical_half * pano['crop_y2'] / pano['h']
 
   draw.rectangle(
     [crop_x1, crop_y1, crop_x2, crop_y2],
     fill = None, outline = '#888', width = 3)
-  draw.text((crop_x1 + 10, crop_y1 + 10), f'Crop area - {cropped_size}', fill='#888', font=img_label1_font, anchor='lt')
-  draw.text((cx0 - view_horizontal_half, cy0 - view_vertical_half - 10), f'Uncropped FOV {pano_fov}', fill='#888', font=img_label1_font, anchor='lb')
+  draw.text((crop_x1 + 10, crop_y1 + 10), f'Crop area - {cropped_size}', fill='#888', font=fonts['img_label1'], anchor='lt')
+  draw.text((chart_cx0 - view_horizontal_half, chart_cy0 - view_vertical_half - 10), f'Uncropped FOV {pano_fov}', fill='#888', font=fonts['img_label1'], anchor='lb')
 
   # Image labels, outlines
-  for i, ii in enumerate(pto['images']):
+  for i, ii in enumerate(pto.images):
     x,y = yp2xy(ii['y'], ii['p'])
 
-    draw.text((x, y - 15), f'#{i}', fill=img_label_color, font=img_label1_font, anchor='mb')
-    draw.text((x, y + 15), f'{ii['n']}', fill=img_label_color, font=img_label2_font, anchor='mt')
+    draw.text((x, y - 15), f'#{i}', fill=img_label_color, font=fonts['img_label1'], anchor='mb')
+    draw.text((x, y + 15), f'{pto.names[i]}', fill=img_label_color, font=fonts['img_label2'], anchor='mt')
 
 
   # Image center and rotation angle markers
-  for i, ii in enumerate(pto['images']):
+  for i, ii in enumerate(pto.images):
     x,y = yp2xy(ii['y'], ii['p'])
 
     ax = 40 * math.sin(ii['r'] * math.pi / 180)
@@ -468,18 +675,293 @@ def main():
     draw.rectangle([ x - 5, y - 5, x + 5, y + 5], fill = None, outline = 'black', width = 2)
     draw.line([x, y, x + ax, y + ay], fill='black', width=1)
 
-  if args.output:
-    print(f'Write chart to {args.output}')
-    img.save(args.output)
-  else:
-    print('Show layout')
-    img.show();
+def layout_png_path(pto_path):
+  return pto_path[:-len('.pto')] + '-layout.png' if pto_path.endswith('.pto') else pto_path + '-layout.png'
+
+def find_ptos(paths):
+  '''
+  PTO files of the given files and directory trees, in sorted order
+  '''
+  ret = []
+  for path in paths:
+    if os.path.isdir(path):
+      for root, dirs, files in os.walk(path):
+        dirs.sort()
+        ret.extend(os.path.join(root, f) for f in sorted(files) if f.endswith('.pto'))
+    else:
+      ret.append(path)
+  return ret
+
+# Fonts of a batch worker process, see batch_init
+worker_fonts = None
+
+def batch_init():
+  global worker_fonts
+  worker_fonts = load_fonts()
+
+def coverage_report_path(png_path):
+  return png_path[:-len('.png')] + '-coverage.json' if png_path.endswith('.png') else png_path + '-coverage.json'
+
+def write_coverage_report(report, path):
+  with open(path, 'w') as f:
+    json.dump(report, f, indent = 2)
+
+def batch_render(pto_path, png_path, outline_color, outline_width, coverage_cell, cp_options = None):
+  '''
+  Render one layout in a batch worker (and coverage report if coverage_cell is set, control point
+  layer with (cell, worst, scale) cp_options); returns (pto path, seconds, error message or None)
+  '''
+  t = time.perf_counter()
+  try:
+    pto = ptofile.load(pto_path)
+    coverage = None
+    if coverage_cell:
+      coverage = coverage_stats(pto, pto_path, coverage_cell)
+      write_coverage_report(coverage[1], coverage_report_path(png_path))
+    control_points = control_point_stats(pto, *cp_options) if cp_options else None
+    render_layout(pto, pto_path, worker_fonts, outline_color, outline_width, coverage,
+      control_points = control_points).save(png_path)
+  except Exception as e:
+    return pto_path, time.perf_counter() - t, f'{type(e).__name__}: {e}'
+  return pto_path, time.perf_counter() - t, None
+
+def cp_options(args):
+  '''
+  control_point_stats() options of the command line, None without --control-points
+  '''
+  return (args.cp_cell, args.cp_worst, args.cp_scale) if args.control_points else None
+
+def run_batch(paths, args):
+  '''
+  Render <name>-layout.png next to every PTO, skipping ones with an up to date PNG
+  '''
+  t = time.perf_counter()
+  ptos = find_ptos(paths)
+  todo = []
+  skipped = []
+  for pto_path in ptos:
+    png_path = layout_png_path(pto_path)
+    if not args.force and os.path.exists(png_path) and os.path.getmtime(png_path) >= os.path.getmtime(pto_path):
+      skipped.append(pto_path)
+    else:
+      todo.append((pto_path, png_path))
+
+  jobs = max(1, min(args.jobs, len(todo)))
+  print(f'Batch render {len(todo)} layouts ({len(skipped)} up to date) with {jobs} processes')
+
+  done = []
+  failed = []
+  with concurrent.futures.ProcessPoolExecutor(max_workers = jobs, initializer = batch_init) as executor:
+    futures = [executor.submit(batch_render, pto_path, png_path, args.image_outline_color, args.image_outline_width,
+      args.coverage_cell if args.coverage else None, cp_options(args)) for pto_path, png_path in todo]
+    for future in concurrent.futures.as_completed(futures):
+      pto_path, dt, error = future.result()
+      if error:
+        print(f'  failed   {dt:7.3f} s  {pto_path}: {error}')
+        failed.append((pto_path, dt))
+      else:
+        print(f'  rendered {dt:7.3f} s  {pto_path}')
+        done.append((pto_path, dt))
+
+  wall = time.perf_counter() - t
+  render_s = sum(dt for _, dt in done + failed)
+  print()
+  print(f'Rendered: {len(done)}, skipped (up to date): {len(skipped)}, failed: {len(failed)}')
+  print(f'Wall time: {wall:.3f} s, render time: {render_s:.3f} s'
+    + (f', mean: {render_s / len(done + failed):.3f} s, slowest: {max(done + failed, key = lambda d: d[1])[1]:.3f} s' if done + failed else ''))
+  return not failed
+
+def save_png(img, path, compress_level = 6):
+  '''
+  Write a PNG through a temporary file; viewers never see a partially written image
+  '''
+  tmp = path + '.tmp'
+  img.save(tmp, format = 'PNG', compress_level = compress_level)
+  os.replace(tmp, path)
+
+def watch(args, output, report_path):
+  '''
+  Re-render the layout PNG whenever the PTO changes, until interrupted. The PTO size and modification
+  time are polled; a change is rendered once it has settled for one poll interval. Only images with
+  changed geometry are re-projected, the background layer is reused.
+  '''
+  fonts = load_fonts(cached = True)
+  cache = LayoutCache()
+  previous = []
+  rendered = None
+  pending = None
+
+  print(f'Watch {args.input}, write {output} (Ctrl+C to stop)')
+  try:
+    while True:
+      try:
+        st = os.stat(args.input)
+        stamp = (st.st_mtime_ns, st.st_size)
+      except FileNotFoundError:
+        # some editors replace the file on save
+        stamp = None
+
+      if stamp is not None and stamp != rendered and stamp == pending:
+        rendered = stamp
+        t = time.perf_counter()
+        try:
+          pto = ptofile.load(args.input, control_points = args.control_points)
+          keys = cache.geometry_keys(pto.images)
+          changed = sum(1 for a, b in zip(keys, previous) if a != b) + abs(len(keys) - len(previous))
+          previous = keys
+
+          coverage = None
+          if args.coverage:
+            coverage = coverage_stats(pto, args.input, args.coverage_cell, cache)
+            write_coverage_report(coverage[1], report_path)
+          control_points = control_point_stats(pto, *cp_options(args)) if args.control_points else None
+          img = render_layout(pto, args.input, fonts, args.image_outline_color, args.image_outline_width, coverage, cache,
+            control_points = control_points)
+          save_png(img, output, compress_level = 1)
+          print(f'{time.strftime("%H:%M:%S")}  {len(pto.images)} images, {changed} changed, {cache.projected} projected, '
+            f'{time.perf_counter() - t:.3f} s' + (f'; coverage: {coverage_summary(coverage[1])}' if coverage else '')
+            + (f'; control points: {control_point_summary(control_points[2])}' if control_points else ''))
+        except Exception as e:
+          # e.g. a half written file; rendered again on the next change
+          print(f'{time.strftime("%H:%M:%S")}  ERROR {type(e).__name__}: {e}')
+      pending = stamp
+      time.sleep(args.watch_interval)
+  except KeyboardInterrupt:
+    print()
+    print('Stop watching')
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Show (or output as PNG) a panorama layout."
+  )
+
+  parser.add_argument('-i', '--input',  type=str, help='Input PTO file (required unless --batch is used).')
+  parser.add_argument('-o', '--output', type=str, help='Output PNG file instead of display.')
+  parser.add_argument('-b', '--batch', type=str, nargs='+', metavar='PATH', help='Render <name>-layout.png next to each of these PTO files or PTOs found in these directory trees')
+  parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Batch worker processes (default: number of CPUs)')
+  parser.add_argument('--force', action='store_true', help='Batch: render even if the layout PNG is newer than the PTO')
+  parser.add_argument('--image-outline-color', type=str, default='#ccc', help='Image outline color (default: "#ccc")')
+  parser.add_argument('--image-outline-width', type=int, default=1, help='Image outline line width (default: 1)')
+  parser.add_argument('--coverage', action='store_true', help='Draw coverage heatmap and write coverage JSON report')
+  parser.add_argument('--coverage-cell', type=float, default=1, help='Coverage grid cell size in degrees (default: 1)')
+  parser.add_argument('--coverage-report', type=str, help='Coverage JSON report file (default: <output without .png>-coverage.json, or <input without .pto>-coverage.json without output; batch: next to the layout PNG)')
+  parser.add_argument('--control-points', action='store_true', help='Draw control point density / residual heatmap layer, mark and list the worst points')
+  parser.add_argument('--cp-cell', type=float, default=1, help='Control point heatmap cell size in degrees (default: 1)')
+  parser.add_argument('--cp-worst', type=int, default=20, help='Number of worst control points to mark and list (default: 20)')
+  parser.add_argument('--cp-scale', type=float, help='Residual in panorama pixels drawn red (default: mean + 2 standard deviations, like cpclean)')
+  parser.add_argument('--cp-report', type=str, help='Write control point residual statistics and the worst points to this JSON file')
+  parser.add_argument('--watch', action='store_true', help='Keep running and re-render the layout PNG whenever the input PTO changes (output default: <input without .pto>-layout.png)')
+  parser.add_argument('--watch-interval', type=float, default=0.25, help='Watch: PTO polling interval in seconds (default: 0.25)')
+  parser.add_argument('--profile', type=str, metavar='JSON', help='Write a JSON trace of per stage wall / CPU time, peak memory, outline point counts and per image projection cost; also prints a LAYOUT_PROFILE line')
+  parser.add_argument('--profile-memory', action='store_true', help='Profile: also trace per stage peak Python / NumPy allocations (tracemalloc; makes the run several times slower)')
+  parser.add_argument('--cprofile', type=str, metavar='FILE', help='Write a cProfile dump of the render (see python -m pstats)')
+  parser.add_argument('-v', '--verbose', action='store_true', help='Print parsed PTO lines')
+
+  args = parser.parse_args()
 
+  if args.batch and (args.profile or args.cprofile):
+    parser.error('--profile and --cprofile profile a single render, not --batch')
+
+  if args.batch:
+    if not run_batch(args.batch, args):
+      sys.exit(1)
+    return
+
+  if not args.input:
+    parser.error('-i/--input or -b/--batch is required')
+
+  if args.watch and (args.profile or args.cprofile):
+    parser.error('--profile and --cprofile profile a single render, not --watch')
+
+  if args.watch:
+    output = args.output if args.output else layout_png_path(args.input)
+    watch(args, output, args.coverage_report if args.coverage_report else coverage_report_path(output))
+    return
+
+  profile = StageProfile(bool(args.profile), args.profile_memory)
+  profiler = cProfile.Profile() if args.cprofile else None
+  if profiler:
+    profiler.enable()
+  render_single(args, profile)
+  if profiler:
+    profiler.disable()
+    print(f'Write cProfile dump to {args.cprofile}')
+    profiler.dump_stats(args.cprofile)
+
+  if args.profile:
+    report = profile.report(args.input)
+    print(f'Write profile trace to {args.profile}')
+    with open(args.profile, 'w') as f:
+      json.dump(report, f, indent = 2)
+    print(profile.summary_line(report))
 
   print('Done.')
   print()
   print()
   print()
 
+def render_single(args, profile):
+  '''
+  Load, render and write (or show) one layout, stages recorded in profile
+  '''
+  print()
+  print()
+  print(f'Load PTO from {args.input}')
+  with profile.stage('load_pto'):
+    pto = ptofile.load(args.input, log = print if args.verbose else None)
+  profile.count('images', len(pto.images))
+  profile.count('control_points', len(pto.control_points))
+  print()
+  print()
+
+  coverage = None
+  if args.coverage:
+    print(f'Compute coverage on a {args.coverage_cell}° grid')
+    with profile.stage('coverage'):
+      coverage = coverage_stats(pto, args.input, args.coverage_cell)
+    report_path = args.coverage_report
+    if not report_path:
+      report_path = coverage_report_path(args.output) if args.output else coverage_report_path(layout_png_path(args.input))
+    print(f'  {coverage_summary(coverage[1])}')
+    for hole in coverage[1]['holes'][:10]:
+      print(f'  hole: {hole["area"]:.1f} deg², yaw {hole["yaw"][0]:.0f}..{hole["yaw"][1]:.0f}, pitch {hole["pitch"][1]:.0f}..{hole["pitch"][0]:.0f}')
+    print(f'Write coverage report to {report_path}')
+    write_coverage_report(coverage[1], report_path)
+    print()
+    print()
+
+  control_points = None
+  if args.control_points:
+    print('Project control points')
+    with profile.stage('project_control_points'):
+      control_points = control_point_stats(pto, *cp_options(args))
+    report = control_points[2]
+    print(f'  {control_point_summary(report)}' + (f', {report["line_control_points"]} line control points skipped' if report['line_control_points'] else ''))
+    for cp in report['worst']:
+      print(f'  worst: c line #{cp["index"]}, images {cp["images"][0]} - {cp["images"][1]}: {cp["residual"]:.2f} px '
+        f'at yaw {cp["ends"][0][0]:.1f}, pitch {cp["ends"][0][1]:.1f}')
+    if args.cp_report:
+      print(f'Write control point report to {args.cp_report}')
+      with open(args.cp_report, 'w') as f:
+        json.dump(report, f, indent = 2)
+    print()
+    print()
+
+  print('Draw chart')
+
+  with profile.stage('load_fonts'):
+    fonts = load_fonts()
+  img = render_layout(pto, args.input, fonts, args.image_outline_color, args.image_outline_width, coverage, profile = profile,
+    control_points = control_points)
+
+  if args.output:
+    print(f'Write chart to {args.output}')
+    with profile.stage('encode_png'):
+      img.save(args.output)
+    profile.count('png_bytes', os.path.getsize(args.output))
+  else:
+    print('Show layout')
+    img.show();
+
 if __name__ == '__main__':
   main()
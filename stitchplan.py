@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import numpy as np
+
+import ptofile
+from panogeometry import pano_bounding_boxes
+
+'''
+Stitch cost and memory planner for nona + enblend
+
+Estimates from the parsed PTO (p line size and crop, projected per image bounding boxes):
+ - nona TIFF_m intermediate layer sizes (cropped layers, uncompressed bytes)
+ - enblend peak memory and the output size
+ - whether the output exceeds the JPEG / ImageMagick dimension limit (65500 px)
+
+If a single enblend run does not fit the memory budget, row splits (as blended by
+multi-row-blend-here.sh from row*/ directories) and output tilings are tried, and enblend image
+cache settings are recommended.
+
+The enblend memory model is a heuristic: the output canvas (RGB + alpha, plus a seam mask) is held
+while each layer is blended in; blending allocates Laplacian pyramids (4/3 of the area) of both
+images and the mask over the bounding box of the overlap with the layers blended so far.
+
+Exit code: 0 if a single blend fits, 1 if a split / tiling / cache is needed or there are warnings,
+2 if no plan fits the budget.
+
+Launch with -h to print CLI help
+'''
+
+# ImageMagick refuses larger JPEG dimensions (the JPEG format limit is 65535)
+jpeg_max_px = 65500
+
+# Channels of nona TIFF_m layers and the enblend canvas (RGB + alpha)
+channels = 4
+
+# Pyramid bytes per ROI pixel: 3 channels of 4 byte integers for both images, a float mask pyramid
+pyramid_bytes_per_px = (2 * 3 * 4 + 4) * 4 / 3
+
+# enblend image cache block size in KB (enblend -b default)
+enblend_block_kb = 2048
+
+# Smallest useful enblend image cache in MB (a few -b blocks); below it no cache run is proposed
+enblend_min_cache_mb = 16
+
+def mb(n):
+  return n / (1024 * 1024)
+
+def available_memory():
+  '''
+  MemAvailable of /proc/meminfo in bytes, total physical memory elsewhere
+  '''
+  try:
+    with open('/proc/meminfo', 'r') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def layer_boxes(pto):
+  '''
+  Integer (x1, y1, x2, y2) layer boxes relative to the crop area, clipped to it, and the indices of
+  the images having a non empty layer
+  '''
+  pano = pto.pano
+  boxes = pano_bounding_boxes(pano, pto.images)
+  boxes = np.stack((
+    np.floor(boxes[:, 0]) - pano['crop_x1'],
+    np.floor(boxes[:, 1]) - pano['crop_y1'],
+    np.ceil(boxes[:, 2]) - pano['crop_x1'],
+    np.ceil(boxes[:, 3]) - pano['crop_y1']), axis = -1)
+  w = pano['crop_x2'] - pano['crop_x1']
+  h = pano['crop_y2'] - pano['crop_y1']
+  boxes = np.clip(boxes, 0, [w, h, w, h]).astype(np.int64)
+  used = np.flatnonzero((boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1]))
+  return boxes[used], used
+
+def box_areas(boxes):
+  return np.maximum(boxes[..., 2] - boxes[..., 0], 0) * np.maximum(boxes[..., 3] - boxes[..., 1], 0)
+
+def blend_peak(boxes, width, height, bytes_per_channel):
+  '''
+  Estimated enblend peak bytes of blending layers (in order) into a width x height canvas;
+  returns (peak bytes, canvas bytes, largest pyramid bytes)
+  '''
+  canvas = int(width) * int(height) * (channels * bytes_per_channel + 1)
+  layers = box_areas(boxes) * channels * bytes_per_channel
+
+  peak = canvas + (int(layers[0]) if len(boxes) else 0)
+  largest_pyramid = 0
+  for i in range(1, len(boxes)):
+    # bounding box of the overlaps with the layers blended so far
+    x1 = np.maximum(boxes[:i, 0], boxes[i, 0])
+    y1 = np.maximum(boxes[:i, 1], boxes[i, 1])
+    x2 = np.minimum(boxes[:i, 2], boxes[i, 2])
+    y2 = np.minimum(boxes[:i, 3], boxes[i, 3])
+    overlapping = (x2 > x1) & (y2 > y1)
+    pyramid = 0
+    if overlapping.any():
+      roi = np.array([x1[overlapping].min(), y1[overlapping].min(), x2[overlapping].max(), y2[overlapping].max()])
+      pyramid = int(box_areas(roi) * pyramid_bytes_per_px)
+    largest_pyramid = max(largest_pyramid, pyramid)
+    peak = max(peak, canvas + int(layers[i]) + pyramid)
+  return peak, canvas, largest_pyramid
+
+def union_box(boxes):
+  return np.array([boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max()])
+
+def row_groups(pitches, rows):
+  '''
+  Split images into rows at the rows - 1 largest gaps between sorted image center pitches
+  (top row first); list of index arrays
+  '''
+  order = np.argsort(-pitches, kind = 'stable')
+  gaps = -np.diff(pitches[order])
+  cuts = np.sort(np.argsort(-gaps, kind = 'stable')[:rows - 1]) + 1
+  return np.split(order, cuts)
+
+def plan_rows(boxes, pitches, rows, width, height, bytes_per_channel):
+  '''
+  Peak memory of blending each row separately, then the row blends together; (peak bytes, row boxes)
+  '''
+  peak = 0
+  row_boxes = []
+  for group in row_groups(pitches, rows):
+    # keep the PTO order within a row, like nona / enblend would
+    group = np.sort(group)
+    box = union_box(boxes[group])
+    row_boxes.append(box)
+    peak = max(peak, blend_peak(boxes[group] - [box[0], box[1], box[0], box[1]],
+      box[2] - box[0], box[3] - box[1], bytes_per_channel)[0])
+  row_boxes = np.array(row_boxes)
+  return max(peak, blend_peak(row_boxes, width, height, bytes_per_channel)[0]), row_boxes
+
+def plan_tiles(boxes, nx, ny, width, height, bytes_per_channel, margin):
+  '''
+  Peak memory of blending an nx x ny tiling of the output (tiles extended by margin pixels);
+  (peak bytes, largest tile width, largest tile height)
+  '''
+  peak = 0
+  tile_w = 0
+  tile_h = 0
+  for ty in range(ny):
+    for tx in range(nx):
+      tile = np.array([
+        max(0, tx * width // nx - margin), max(0, ty * height // ny - margin),
+        min(width, (tx + 1) * width // nx + margin), min(height, (ty + 1) * height // ny + margin)])
+      clipped = np.stack((
+        np.maximum(boxes[:, 0], tile[0]), np.maximum(boxes[:, 1], tile[1]),
+        np.minimum(boxes[:, 2], tile[2]), np.minimum(boxes[:, 3], tile[3])), axis = -1)
+      clipped = clipped[box_areas(clipped) > 0] - [tile[0], tile[1], tile[0], tile[1]]
+      peak = max(peak, blend_peak(clipped, tile[2] - tile[0], tile[3] - tile[1], bytes_per_channel)[0])
+      tile_w = max(tile_w, int(tile[2] - tile[0]))
+      tile_h = max(tile_h, int(tile[3] - tile[1]))
+  return peak, tile_w, tile_h
+
+def plan(pto, memory, bytes_per_channel = 1, workdir = '.', max_rows = 8, max_tiles = 64, tile_margin = 256):
+  '''
+  Stitch plan of a parsed PTO for a memory budget (bytes); JSON serializable dict with the estimates,
+  recommendations, warnings and a status (0 single blend fits, 1 needs split / has warnings, 2 does not fit)
+  '''
+  pano = pto.pano
+  width = pano['crop_x2'] - pano['crop_x1']
+  height = pano['crop_y2'] - pano['crop_y1']
+  boxes, used = layer_boxes(pto)
+
+  nona_bytes = int(box_areas(boxes).sum()) * channels * bytes_per_channel
+  peak, canvas, pyramid = blend_peak(boxes, width, height, bytes_per_channel)
+
+  ret = {
+    'output' : { 'width' : int(width), 'height' : int(height), 'megapixels' : width * height / 1e6 },
+    'layers' : int(len(boxes)),
+    'images_outside_crop' : [int(i) for i in np.setdiff1d(np.arange(len(pto.images)), used)],
+    'nona_bytes' : nona_bytes,
+    'largest_layer' : { 'image' : int(used[np.argmax(box_areas(boxes))]), 'bytes' : int(box_areas(boxes).max()) * channels * bytes_per_channel } if len(boxes) else None,
+    'enblend_peak_bytes' : peak,
+    'enblend_canvas_bytes' : canvas,
+    'enblend_pyramid_bytes' : pyramid,
+    'output_tiff_bytes' : width * height * channels * bytes_per_channel,
+    'memory_budget_bytes' : memory,
+    'recommendation' : None,
+    'warnings' : [],
+    'status' : 0
+  }
+
+  if max(width, height) > jpeg_max_px:
+    scale = jpeg_max_px / max(width, height)
+    ret['warnings'].append(f'Output {width}px x {height}px exceeds the {jpeg_max_px}px JPEG limit; '
+      f'keep TIFF or resize to at most {100 * scale:.1f}% ({int(width * scale)}px x {int(height * scale)}px) for JPG')
+
+  free = shutil.disk_usage(workdir).free
+  if nona_bytes + ret['output_tiff_bytes'] > free:
+    ret['warnings'].append(f'Intermediate + output TIFFs ({mb(nona_bytes + ret["output_tiff_bytes"]):.0f} MB uncompressed) '
+      f'may not fit the {mb(free):.0f} MB free in {os.path.abspath(workdir)}')
+
+  if peak <= memory:
+    ret['recommendation'] = { 'kind' : 'single', 'peak_bytes' : peak }
+  else:
+    # enblend image cache: keep about half of the budget for the cache, spill the rest to TMPDIR
+    cache_mb = int(mb(memory) / 2)
+    cache = {}
+    if cache_mb >= enblend_min_cache_mb:
+      cache['cache'] = { 'enblend_options' : f'-m {cache_mb} -b {enblend_block_kb}', 'spill_bytes' : peak - memory }
+    else:
+      ret['warnings'].append(f'Memory budget {mb(memory):.0f} MB is too small for an enblend image cache of at least {enblend_min_cache_mb} MB')
+    pitches = pto.images['p'][used]
+
+    for rows in range(2, min(max_rows, len(boxes)) + 1):
+      rows_peak, row_boxes = plan_rows(boxes, pitches, rows, width, height, bytes_per_channel)
+      if rows_peak <= memory:
+        groups = row_groups(pitches, rows)
+        ret['recommendation'] = {
+          'kind' : 'rows',
+          'rows' : [[int(used[i]) for i in np.sort(g)] for g in groups],
+          'peak_bytes' : rows_peak,
+          **cache
+        }
+        break
+
+    if not ret['recommendation']:
+      tilings = sorted(((nx, ny) for nx in range(1, max_tiles + 1) for ny in range(1, max_tiles // nx + 1) if nx * ny > 1),
+        key = lambda t: (t[0] * t[1], abs(width / t[0] - height / t[1])))
+      for nx, ny in tilings:
+        tiles_peak, tile_w, tile_h = plan_tiles(boxes, nx, ny, width, height, bytes_per_channel, tile_margin)
+        if tiles_peak <= memory:
+          ret['recommendation'] = {
+            'kind' : 'tiles',
+            'tiles' : [nx, ny],
+            'tile_size' : [tile_w, tile_h],
+            'margin' : tile_margin,
+            'peak_bytes' : tiles_peak,
+            **cache
+          }
+          break
+
+    if not ret['recommendation']:
+      ret['recommendation'] = { 'kind' : 'cache' if cache else 'none', 'peak_bytes' : peak, **cache }
+      ret['status'] = 2
+    else:
+      ret['status'] = 1
+
+  if ret['warnings']:
+    ret['status'] = max(ret['status'], 1)
+  return ret
+
+def print_plan(ret, names):
+  print(f'Output:                {ret["output"]["width"]}px x {ret["output"]["height"]}px ({ret["output"]["megapixels"]:.1f} Mpx), '
+    f'{mb(ret["output_tiff_bytes"]):.0f} MB uncompressed TIFF')
+  print(f'Layers:                {ret["layers"]}' + (f' ({len(ret["images_outside_crop"])} images outside of the crop area)' if ret['images_outside_crop'] else ''))
+  print(f'nona intermediates:    {mb(ret["nona_bytes"]):.0f} MB uncompressed')
+  if ret['largest_layer']:
+    print(f'Largest layer:         {mb(ret["largest_layer"]["bytes"]):.0f} MB (#{ret["largest_layer"]["image"]} {names[ret["largest_layer"]["image"]]})')
+  print(f'enblend peak estimate: {mb(ret["enblend_peak_bytes"]):.0f} MB '
+    f'(canvas {mb(ret["enblend_canvas_bytes"]):.0f} MB, largest pyramids {mb(ret["enblend_pyramid_bytes"]):.0f} MB)')
+  print(f'Memory budget:         {mb(ret["memory_budget_bytes"]):.0f} MB')
+  print()
+
+  r = ret['recommendation']
+  if r['kind'] == 'single':
+    print('Plan: single nona + enblend run fits the budget')
+  elif r['kind'] == 'rows':
+    print(f'Plan: blend {len(r["rows"])} rows separately (row*/ directories, see multi-row-blend-here.sh), '
+      f'peak {mb(r["peak_bytes"]):.0f} MB')
+    for i, row in enumerate(r['rows']):
+      print(f'  row{i + 1}: images {" ".join(str(j) for j in row)}')
+  elif r['kind'] == 'tiles':
+    print(f'Plan: blend {r["tiles"][0]} x {r["tiles"][1]} output tiles (up to {r["tile_size"][0]}px x {r["tile_size"][1]}px '
+      f'with {r["margin"]}px margins, e.g. by crop S areas), peak {mb(r["peak_bytes"]):.0f} MB')
+  else:
+    print('Plan: no row split or tiling fits the budget')
+  if 'cache' in r:
+    print(f'  Alternatively a single enblend run with image cache: enblend {r["cache"]["enblend_options"]} '
+      f'(about {mb(r["cache"]["spill_bytes"]):.0f} MB spilled to TMPDIR)')
+
+  for warning in ret['warnings']:
+    print(f'WARNING: {warning}')
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Estimate nona / enblend disk and memory needs of a PTO and plan row splits or tiling."
+  )
+
+  parser.add_argument('-i', '--input',  type=str, required=True, help='Input PTO file (required).')
+  parser.add_argument('-m', '--memory', type=float, help='Memory budget in MB (default: available memory)')
+  parser.add_argument('--bytes-per-channel', type=int, default=1, choices=[1, 2], help='Sample size of the layers, 2 for 16 bit sources (default: 1)')
+  parser.add_argument('--workdir', type=str, default='.', help='Directory of the intermediate TIFFs, for the free space check (default: .)')
+  parser.add_argument('--max-rows', type=int, default=8, help='Largest row split to try (default: 8)')
+  parser.add_argument('--max-tiles', type=int, default=64, help='Largest number of output tiles to try (default: 64)')
+  parser.add_argument('--tile-margin', type=int, default=256, help='Tile overlap margin in pixels (default: 256)')
+  parser.add_argument('--json', type=str, help='Write the plan as JSON to this file')
+
+  args = parser.parse_args()
+
+  pto = ptofile.load(args.input)
+  if pto.pano is None:
+    print(f'ERROR: No p line in {args.input}')
+    sys.exit(2)
+
+  memory = int(args.memory * 1024 * 1024) if args.memory else available_memory()
+  ret = plan(pto, memory, args.bytes_per_channel, args.workdir, args.max_rows, args.max_tiles, args.tile_margin)
+  ret['pto'] = os.path.abspath(args.input)
+
+  print(f'Stitch plan of {args.input}')
+  print()
+  print_plan(ret, pto.names)
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(ret, f, indent = 2)
+
+  sys.exit(ret['status'])
+
+if __name__ == '__main__':
+  main()
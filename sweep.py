@@ -2,10 +2,14 @@
 #
 # Correlate two audio tracks to find best match.
 #
-#  - Use 'to-pcm.sh' to convert to 16 bit signed big endian or
+#  - Input files are read as 16 bit signed big endian PCM (any or no extension); use 'to-pcm.sh'
+#    to convert or
 #
 #    ffmpeg -y -i "<IN_VIDEO_OR_AUDIO>" -acodec pcm_s16be -f s16be -ac 1 -ar 16000 "<PCM_FILE>"
 #
+#    Files with a known audio / video container extension (see ffmpegExtensions, e.g. .mp4, .MTS,
+#    .wav) are decoded on the fly by an ffmpeg process instead
+#
 #  - Create a settins JSON and pass it as a CLI argument; contents:
 #
 #      "osr" :    Output sample rate, try 100
@@ -13,13 +17,38 @@
 #      "dtmin" :  Smallest offset to probe
 #      "dtmax" :  Largest offset to probe
 #      "dtstep" : Probe steps; ideally matches osr, so try 0.01
+#      "method" : "fft" (default) scores all delays at once with sub-step peak interpolation,
+#                 "loop" probes each dtstep one by one,
+#                 "pyramid" searches decimated envelopes first and refines the best candidates;
+#                 use for wide dtmin .. dtmax windows
+#      "pyramidLevels" : Number of 2x decimation levels for "pyramid", default 4
+#      "candidates" :    Number of coarse level peaks refined by "pyramid", default 5
 #
-#      "pcm1file" : First input file
+#      "pcm1file" : First input file (PCM, video or audio)
 #      "ss1" :      Start second in first input; it will be set to 0
 #      "es1" :      End second of first input, no more samples will be processed
 #
 #      "pcm2file", "ss2", "es2" : Same for second input
 #
+#      "cacheDir" :   Envelope cache directory, default ~/.cache/panos-sweep; "" disables caching
+#      "cacheMaxMb" : Envelope cache size limit in MB, least recently used entries are evicted; default 1024
+#
+#  - Drift mode (--drift): the overlap is split into windows correlated separately around the
+#    global offset; a robust linear fit of the local offsets gives the offset and the drift (ppm)
+#    of the second input with the matching -itsoffset / atempo options. Settings:
+#
+#      "driftWindow" : Window length in seconds, default 60
+#      "driftHop" :    Window step in seconds, default 30
+#      "driftSearch" : Local search radius around the global offset in seconds, default 1
+#      "driftMinConfidence" : Windows with lower peak confidence are not fitted, default 3
+#
+#  - Batch mode: instead of "pcm2file" list the clips to sync to the first input (reference) in
+#
+#      "targets" : [ "<FILE>", { "file" : "<FILE>", "ss" : <SS>, "es" : <ES> }, ... ]
+#
+#    Targets are correlated in parallel with no plots; use -o to write the offsets, peak scores
+#    and confidences as JSON (or CSV) and --ffmpeg-out to print the matching ffmpeg command line.
+#
 #  - Typical ffmpeg command line to produce synced video based on identified delay:
 #
 #    ffmpeg -ss <DELAY_S> -i "<IN_VIDEO>" -itsoffset 0 -i "<IN_AUDIO>" -c:v copy -map 0:v:0 -map 1:a:0 -t <TOTAL_LENGTH_S> "<OUT_VIDEO>"
@@ -44,11 +73,14 @@
 #
 
 
-import array
-import sys
-import matplotlib.pyplot as plt
+import math
+import os
+import subprocess
 import numpy as np
 import argparse
+import concurrent.futures
+import csv
+import hashlib
 import json
 
 # Input sample rate
@@ -60,124 +92,762 @@ csr=100
 
 of=0.5
 
+# Number of PCM samples squared and summed in one go
+chunkSamples=1 << 22
+
+# Extensions of audio / video containers decoded with ffmpeg; anything else is read as raw 16 bit
+# signed big endian PCM (to-pcm.sh output can have any name)
+ffmpegExtensions=['.mts', '.m2ts', '.mov', '.mp4', '.m4v', '.avi', '.mkv', '.webm', '.wmv', '.mpg', '.mpeg', '.flv',
+  '.wav', '.mp3', '.aac', '.m4a', '.flac', '.ogg', '.opus', '.wma', '.aif', '.aiff']
+
+class EnvelopeAccumulator:
+  '''
+  Incremental windowed, subsampled average energy calculation, see readPcm for arguments.
+
+  Consecutive PCM chunks starting at sample position start are fed in; window energies are
+  differences of prefix sums of squared samples. Only the prefix sums of the not yet finished
+  windows are kept, so memory is bounded by the chunk size regardless of the clip length.
+  '''
+
+  def __init__(self, ss = 0, es = 9999999, isr=16000, osr=100, of=0.5):
+    self.es = es
+    self.isr = isr
+    self.osr = osr
+    self.of = of
+
+    # energy is 0 for windows starting before ss
+    self.k = max(0, math.ceil(ss * osr))
+    while self.k > 0 and (self.k - 1) / osr >= ss:
+      self.k = self.k - 1
+    while self.k / osr < ss:
+      self.k = self.k + 1
+
+    self.out = [np.zeros(self.k)]
+    self.done = self.k / osr > es
+
+    # samples before the first window are never used
+    self.start = int(self.windowBounds(np.array([self.k]))[0][0])
+
+    # prefix sums of squared samples; prefix[j] is the sum of samples from start up to base + j
+    self.base = self.start
+    self.prefix = np.zeros(1, dtype = np.int64)
+
+  def windowBounds(self, k):
+    si = np.maximum(0, np.round((k - self.of) * self.isr / self.osr)).astype(np.int64)
+    ei = np.round((k + 1 + self.of) * self.isr / self.osr).astype(np.int64)
+    return si, ei
+
+  def endSample(self):
+    '''
+    Number of samples (from the beginning of the clip) needed to calculate all windows until es
+    '''
+    if self.es >= 1e12:
+      return None
+    return int(self.windowBounds(np.array([math.floor(self.es * self.osr)]))[1][0]) + 1
+
+  def feed(self, samples):
+    if self.done or len(samples) == 0:
+      return
+
+    sq = samples.astype(np.int64)
+    cs = np.cumsum(sq * sq)
+    cs += self.prefix[-1]
+    self.prefix = np.concatenate((self.prefix, cs))
+    total = self.base + len(self.prefix) - 1
+
+    # windows that end before the last sample seen so far
+    k = np.arange(self.k, math.floor(total * self.osr / self.isr) + 2)
+    si, ei = self.windowBounds(k)
+    stops = np.flatnonzero((k / self.osr > self.es) | (ei >= total))
+    ct = stops[0] if len(stops) > 0 else len(k)
+    if ct < len(k) and k[ct] / self.osr > self.es:
+      self.done = True
+
+    si = si[:ct]
+    ei = ei[:ct]
+    self.out.append((self.prefix[ei - self.base] - self.prefix[si - self.base]) / (ei - si))
+    self.k = self.k + ct
+
+    # drop prefix sums no longer needed by upcoming windows
+    si, _ = self.windowBounds(np.array([self.k]))
+    drop = min(int(si[0]) - self.base, len(self.prefix) - 1)
+    if drop > 0:
+      self.prefix = self.prefix[drop:]
+      self.base = self.base + drop
+
+  def result(self):
+    return np.concatenate(self.out)
+
+def streamAudio(filename, start = 0, end = None, isr = 16000):
+  '''
+  Decode any ffmpeg readable audio / video into mono 16 bit signed big endian sample chunks.
+
+  Decoding is started at sample position start by input seeking and stopped at sample position end.
+  '''
+  cmd = ['ffmpeg', '-nostdin', '-v', 'error']
+  if start > 0:
+    cmd = cmd + ['-ss', f'{start / isr:.6f}']
+  cmd = cmd + ['-i', filename]
+  if end is not None:
+    cmd = cmd + ['-t', f'{(end - start) / isr:.6f}']
+  cmd = cmd + ['-vn', '-acodec', 'pcm_s16be', '-f', 's16be', '-ac', '1', '-ar', str(isr), 'pipe:1']
+
+  print(f'  Launch {" ".join(cmd)}')
+  proc = subprocess.Popen(cmd, stdout = subprocess.PIPE)
+  try:
+    rest = b''
+    while True:
+      data = proc.stdout.read(2 * chunkSamples)
+      if not data:
+        break
+      data = rest + data
+      usable = len(data) - len(data) % 2
+      rest = data[usable:]
+      yield np.frombuffer(data[:usable], dtype = '>i2')
+  finally:
+    proc.stdout.close()
+    if proc.poll() is None:
+      proc.terminate()
+    proc.wait()
+
 def readPcm(filename, ss = 0, es = 9999999, isr=16000, osr=100, of=0.5):
   '''
   Read PCM file and calculate windowed, subsampled average energy.
 
   Arguments:
-    filename: Mono 16 bitsigned big endian PCM file to read
+    filename: Mono 16 bitsigned big endian PCM file to read; audio / video files (see
+              ffmpegExtensions) are streamed through ffmpeg
     ss: Initial silence in seconds; set energy to 0 in the beginning of the clip
     es: End point in seconds; cut clip after this point
     isr: Input (PCM file) sample rate
     osr: Output array sample rate
     of:  Overlay factor for subsampling; 0 for no overlapl,  0.5 for 50% overtlap on both sides
 
+  Raw PCM files are memory mapped; neither input is read before ss or after es.
   '''
 
-  # See https://stackoverflow.com/questions/5030919/how-to-read-write-binary-16-bit-data-in-python-2-x
-  pcm = array.array('h')
   print(f'Start reading {filename}')
+  acc = EnvelopeAccumulator(ss = ss, es = es, isr = isr, osr = osr, of = of)
+  end = acc.endSample()
+
+  if os.path.splitext(filename)[1].lower() not in ffmpegExtensions:
+    samples = os.path.getsize(filename) // 2
+    if samples > 0:
+      pcm = np.memmap(filename, dtype = '>i2', mode = 'r', shape = (samples,))
+    else:
+      pcm = np.zeros(0, dtype = '>i2')
+    last = samples if end is None else min(samples, end)
+    for c0 in range(acc.start, last, chunkSamples):
+      acc.feed(pcm[c0:min(c0 + chunkSamples, last)])
+      if acc.done:
+        break
+    print(f'  Read {max(0, last - acc.start)} of {samples} samples from {filename}; resample energies from {isr} to {osr}; ss: {ss}, es: {es}')
+  else:
+    read = 0
+    for chunk in streamAudio(filename, start = acc.start, end = end, isr = isr):
+      acc.feed(chunk)
+      read = read + len(chunk)
+      if acc.done:
+        break
+    print(f'  Decoded {read} samples from {filename}; resample energies from {isr} to {osr}; ss: {ss}, es: {es}')
+
+  ret = acc.result()
+  print(f'  Calculated {len(ret)} windowed average energy samples')
+  print()
+  return ret
+
+def correlateLoop(i1, i2, dtmin, dtmax, dtstep, osr=100):
+  '''
+  Probe delays one by one, score is the overlapping dot product divided by the overlap count.
+
+  Returns (da, ca, bestd, bestv): probed delays, scores, best delay and its score
+  '''
+  da = []
+  ca = []
+  bestd = 0
+  bestv = 0
+
+  for d in np.arange(dtmin, dtmax, dtstep):
+    # d: current delay (of i2) in seconds
+
+    i1s = round(d * osr) if d >= 0 else 0
+    i2s = 0 if d >= 0 else round(-d * osr)
+
+    ct = min(len(i1) - i1s, len(i2) - i2s)
+    val = 0;
+    for i in range(0, ct):
+      val = val + i1[ i1s + i ] * i2[ i2s + i ]
+    val = val / ct
+
+    da.append(d)
+    ca.append(val)
+    if val > bestv:
+      bestv = val
+      bestd = d
+    print(f'Delay: {d} Corr: {val}')
+
+  return da, ca, bestd, bestv
+
+def correlationScores(i1, i2):
+  '''
+  Normalized correlation for every lag at once using FFT.
+
+  Lag l (in samples) pairs i1[l + i] with i2[i]; negative lags shift i2 instead.
+  Each dot product is divided by the number of overlapping samples, as in correlateLoop.
+
+  Returns (lags, scores); scores are NaN where the clips do not overlap
+  '''
+  n1 = len(i1)
+  n2 = len(i2)
+  nfft = 1 << max(0, (n1 + n2 - 1) - 1).bit_length()
+  cc = np.fft.irfft(np.fft.rfft(i1, nfft) * np.conj(np.fft.rfft(i2, nfft)), nfft)
+
+  lags = np.arange(-(n2 - 1), n1)
+  ct = np.minimum(np.minimum(n1, n2), np.minimum(n1 - lags, n2 + lags))
+  scores = np.full(len(lags), np.nan)
+  valid = ct > 0
+  scores[valid] = cc[lags[valid] % nfft] / ct[valid]
+  return lags, scores
+
+def correlateFft(i1, i2, dtmin, dtmax, dtstep, osr=100):
+  '''
+  Same scores as correlateLoop but calculated for all lags with a single FFT correlation.
+
+  The best delay is searched among all lags (of 1 / osr resolution) in the dtmin .. dtmax
+  window and refined by fitting a parabola on the peak and its neighbors.
+
+  Returns (da, ca, bestd, bestv); da, ca are sampled at the dtstep grid for plotting
+  '''
+  lags, scores = correlationScores(np.asarray(i1, dtype = float), np.asarray(i2, dtype = float))
+
+  def score(l):
+    # score for integer lag(s), NaN outside of the overlapping range
+    l = np.asarray(l)
+    inside = (l >= lags[0]) & (l <= lags[-1])
+    ret = np.full(l.shape, np.nan)
+    ret[inside] = scores[l[inside] - lags[0]]
+    return ret
+
+  da = np.arange(dtmin, dtmax, dtstep)
+  ca = score(np.round(da * osr).astype(np.int64))
+
+  # all integer lags in the probed window
+  lmin = math.ceil(dtmin * osr)
+  lmax = math.ceil(dtmax * osr) - 1
+  window = np.arange(lmin, lmax + 1)
+  wscores = score(window)
+  if len(window) == 0 or np.all(np.isnan(wscores)):
+    print('No overlap in probed delay window')
+    return da, ca, 0, 0
+
+  best = int(np.nanargmax(wscores))
+  bestl = window[best]
+  bestv = wscores[best]
+
+  # sub-step parabolic peak interpolation
+  offset = 0
+  ym1, yp1 = score([bestl - 1, bestl + 1])
+  denom = ym1 - 2 * bestv + yp1
+  if not np.isnan(denom) and denom < 0:
+    offset = 0.5 * (ym1 - yp1) / denom
+
+  bestd = (bestl + offset) / osr
+  print(f'Best lag: {bestl} samples, parabolic offset: {offset:.3f} samples, corr: {bestv}')
+  return da, ca, bestd, bestv
+
+def decimate(x):
+  '''
+  Halve the sample rate of an energy envelope by averaging sample pairs
+  '''
+  n = len(x) // 2
+  return (x[0:2 * n:2] + x[1:2 * n:2]) / 2
+
+def lagScore(i1, i2, l):
+  '''
+  Normalized correlation of a single integer lag, see correlationScores
+  '''
+  i1s = l if l >= 0 else 0
+  i2s = 0 if l >= 0 else -l
+  ct = min(len(i1) - i1s, len(i2) - i2s)
+  if ct <= 0:
+    return np.nan
+  return np.dot(i1[i1s:i1s + ct], i2[i2s:i2s + ct]) / ct
+
+def correlatePyramid(i1, i2, dtmin, dtmax, dtstep, osr=100, levels=4, candidates=5):
+  '''
+  Coarse to fine delay search.
+
+  Envelopes are decimated levels times by 2. All lags of the dtmin .. dtmax window are scored
+  only on the coarsest level, then the best candidates local maxima are refined level by level,
+  probing just the neighborhood of each candidate, and finally interpolated like in correlateFft.
+  The result resolution is 1 / osr refined by interpolation; dtstep is kept for a uniform signature.
+
+  Returns (da, ca, bestd, bestv); da, ca is the coarse level curve for plotting
+  '''
+  pyramid = [(np.asarray(i1, dtype = float), np.asarray(i2, dtype = float))]
+  for level in range(levels):
+    p1, p2 = pyramid[-1]
+    if min(len(p1), len(p2)) < 4:
+      break
+    pyramid.append((decimate(p1), decimate(p2)))
+
+  top = len(pyramid) - 1
+  factor = 1 << top
+  print(f'Pyramid levels: {top}, candidates: {candidates}')
+
+  # coarse level: all lags of the window
+  lags, scores = correlationScores(*pyramid[top])
+  inside = (lags >= math.floor(dtmin * osr / factor)) & (lags <= math.ceil(dtmax * osr / factor))
+  lags = lags[inside]
+  scores = scores[inside]
+  da = lags * factor / osr
+  ca = scores
+
+  if np.all(np.isnan(scores)):
+    print('No overlap in probed delay window')
+    return da, ca, 0, 0
+
+  padded = np.concatenate(([-np.inf], np.nan_to_num(scores, nan = -np.inf), [-np.inf]))
+  peaks = np.flatnonzero((padded[1:-1] >= padded[:-2]) & (padded[1:-1] >= padded[2:]) & ~np.isnan(scores))
+  peaks = peaks[np.argsort(-scores[peaks], kind = 'stable')][:candidates]
+  cands = [int(l) for l in lags[peaks]]
+  print(f'  Coarse candidates: {[c * factor / osr for c in cands]}')
+
+  # refine candidates down to the input resolution
+  lmin = math.ceil(dtmin * osr)
+  lmax = math.ceil(dtmax * osr) - 1
+  for level in range(top - 1, -1, -1):
+    p1, p2 = pyramid[level]
+    refined = []
+    for c in cands:
+      probes = range(2 * c - 2, 2 * c + 3)
+      if level == 0:
+        probes = [l for l in probes if lmin <= l <= lmax]
+      probed = [(lagScore(p1, p2, l), l) for l in probes]
+      probed = [pl for pl in probed if not np.isnan(pl[0])]
+      if probed:
+        refined.append(max(probed)[1])
+    cands = sorted(set(refined))
+
+  if not cands:
+    print('No overlap in probed delay window')
+    return da, ca, 0, 0
+
+  p1, p2 = pyramid[0]
+  bestv, bestl = max((lagScore(p1, p2, c), c) for c in cands)
+
+  # sub-step parabolic peak interpolation
+  offset = 0
+  ym1 = lagScore(p1, p2, bestl - 1)
+  yp1 = lagScore(p1, p2, bestl + 1)
+  denom = ym1 - 2 * bestv + yp1
+  if not np.isnan(denom) and denom < 0:
+    offset = 0.5 * (ym1 - yp1) / denom
+
+  bestd = (bestl + offset) / osr
+  print(f'Best lag: {bestl} samples, parabolic offset: {offset:.3f} samples, corr: {bestv}')
+  return da, ca, bestd, bestv
+
+# Default envelope cache directory and size limit, see readEnvelope
+cacheDir=os.path.join(os.path.expanduser('~'), '.cache', 'panos-sweep')
+cacheMaxMb=1024
+
+# Size of the file blocks hashed to identify file contents
+hashBlock=1 << 20
+
+def fileHash(filename):
+  '''
+  Quick content hash from the beginning, middle and end blocks of a file plus its size
+  '''
+  size = os.path.getsize(filename)
+  h = hashlib.sha1(str(size).encode())
   with open(filename, 'rb') as f:
+    for pos in sorted(set([0, max(0, size // 2 - hashBlock // 2), max(0, size - hashBlock)])):
+      f.seek(pos)
+      h.update(f.read(hashBlock))
+  return h.hexdigest()
+
+def cacheKey(filename, **params):
+  st = os.stat(filename)
+  key = {
+    'size' : st.st_size,
+    'mtime' : st.st_mtime_ns,
+    'hash' : fileHash(filename),
+    'params' : params
+  }
+  return hashlib.sha1(json.dumps(key, sort_keys = True).encode()).hexdigest()
+
+def evictCache(cdir, maxMb):
+  '''
+  Remove least recently used envelopes until the cache fits into maxMb
+  '''
+  entries = []
+  for name in os.listdir(cdir):
+    if name.endswith('.npy'):
+      path = os.path.join(cdir, name)
+      try:
+        st = os.stat(path)
+      except FileNotFoundError:
+        continue
+      entries.append((st.st_mtime, st.st_size, path))
+
+  total = sum(e[1] for e in entries)
+  for mtime, size, path in sorted(entries):
+    if total <= maxMb * 1024 * 1024:
+      break
+    print(f'  Evict {path} from envelope cache')
     try:
-      pcm.fromfile(f, 100000000)
-    except EOFError:
+      os.remove(path)
+    except FileNotFoundError:
       pass
+    total = total - size
 
-  if sys.byteorder == "little":
-    pcm.byteswap()
+def readEnvelope(settings, file, ss, es):
+  '''
+  readPcm with the envelope settings (osr, of) of a settings dict.
 
-  print(f'  Read {len(pcm)} samples from {filename}; resample energies from {isr} to {osr}; ss: {ss}, es: {es}')
+  Envelopes are cached as .npy files in the "cacheDir" setting (empty string disables caching),
+  keyed by file size, mtime, content hash and the envelope parameters. Cache hits are touched
+  and the least recently used envelopes are evicted above "cacheMaxMb".
+  '''
+  params = {
+    'ss' : ss,
+    'es' : es,
+    'isr' : sr,
+    'osr' : settings['osr'] if 'osr' in settings else csr,
+    'of' : settings['of'] if 'of' in settings else of
+  }
+
+  cdir = settings['cacheDir'] if 'cacheDir' in settings else cacheDir
+  if not cdir:
+    return readPcm(file, **params)
+
+  path = os.path.join(cdir, f'{os.path.basename(file)}-{cacheKey(file, **params)}.npy')
+  if os.path.exists(path):
+    try:
+      print(f'Load cached envelope of {file} from {path}')
+      os.utime(path)
+      ret = np.load(path)
+      print(f'  Loaded {len(ret)} windowed average energy samples')
+      print()
+      return ret
+    except FileNotFoundError:
+      # evicted by another worker in between; compute again
+      print(f'  Cached envelope was evicted, read {file} again')
+
+  ret = readPcm(file, **params)
+
+  os.makedirs(cdir, exist_ok = True)
+  tmp = f'{path}.{os.getpid()}.tmp'
+  with open(tmp, 'wb') as f:
+    np.save(f, ret)
+  os.replace(tmp, path)
+  print(f'  Cached envelope in {path}')
+  evictCache(cdir, settings['cacheMaxMb'] if 'cacheMaxMb' in settings else cacheMaxMb)
+  return ret
 
-  ret=[]
-  while True:
-    if len(ret) / osr < ss:
-      ret.append(0)
-      #elif len(pcm) / isr - len(ret) / osr < es:
-    elif len(ret) / osr > es:
-      break
+def correlate(i1, i2, settings):
+  '''
+  Run the delay search selected by the "method" setting.
+
+  Returns (da, ca, bestd, bestv), see correlateLoop
+  '''
+  osr = settings['osr'] if 'osr' in settings else csr
+  dtmin = settings['dtmin'] if 'dtmin' in settings else 0
+  dtmax = settings['dtmax'] if 'dtmax' in settings else 10
+  dtstep = settings['dtstep'] if 'dtstep' in settings else 0.01
+  method = settings['method'] if 'method' in settings else 'fft'
+  levels = settings['pyramidLevels'] if 'pyramidLevels' in settings else 4
+  candidates = settings['candidates'] if 'candidates' in settings else 5
+
+  print(f'Sweep dt between {dtmin} s and {dtmax} s with step {dtstep} s, method: {method}')
+
+  if method == 'loop':
+    return correlateLoop(i1, i2, dtmin, dtmax, dtstep, osr = osr)
+  elif method == 'fft':
+    return correlateFft(i1, i2, dtmin, dtmax, dtstep, osr = osr)
+  elif method == 'pyramid':
+    return correlatePyramid(i1, i2, dtmin, dtmax, dtstep, osr = osr, levels = levels, candidates = candidates)
+  else:
+    raise Exception(f'Unknown method "{method}", expected "fft", "pyramid" or "loop"')
+
+def confidence(ca, bestv):
+  '''
+  Peak prominence: distance of the best score from the median score in standard deviations
+  '''
+  ca = np.asarray(ca, dtype = float)
+  ca = ca[~np.isnan(ca)]
+  if len(ca) < 2 or np.std(ca) == 0:
+    return 0
+  return float((bestv - np.median(ca)) / np.std(ca))
+
+# Reference envelope and settings of batch worker processes, see batchInit
+batchReference = None
+batchSettings = None
+
+def batchInit(reference, settings):
+  global batchReference, batchSettings
+  batchReference = reference
+  batchSettings = settings
+
+def batchTarget(target):
+  '''
+  Correlate a single batch target against the reference; runs in a worker process
+  '''
+  i2 = readEnvelope(batchSettings, target['file'], target['ss'], target['es'])
+  da, ca, bestd, bestv = correlate(batchReference, i2, batchSettings)
+  return {
+    'file' : target['file'],
+    'offset' : float(bestd),
+    'score' : float(bestv),
+    'confidence' : confidence(ca, bestv)
+  }
+
+def batchTargets(settings):
+  '''
+  Normalize the "targets" setting: plain file names or {"file", "ss", "es"} objects
+  '''
+  ret = []
+  for t in settings['targets']:
+    if isinstance(t, str):
+      t = { 'file' : t }
+    ret.append({
+      'file' : t['file'],
+      'ss' : t['ss'] if 'ss' in t else 0,
+      'es' : t['es'] if 'es' in t else 9999999
+    })
+  return ret
+
+def ffmpegCommand(reference, results, outfile, w = 960, h = 540):
+  '''
+  ffmpeg command line muxing the reference audio with the offset target videos.
+
+  A single target is stream copied; multiple targets are scaled to w x h and tiled in a grid.
+  '''
+  def q(s):
+    return "'" + s.replace("'", "'\\''") + "'"
+
+  lines = ['ffmpeg', f'  -i {q(reference)}']
+  for r in results:
+    lines.append(f'  -itsoffset {r["offset"]:.3f} -i {q(r["file"])}')
+
+  if len(results) == 1:
+    lines.append('  -map 1:v:0 -map 0:a:0 -c:v copy')
+  else:
+    cols = math.ceil(math.sqrt(len(results)))
+    scales = ''.join(f'[{i + 1}:v] scale={w}:{h} [v{i}]; ' for i in range(len(results)))
+    inputs = ''.join(f'[v{i}]' for i in range(len(results)))
+    layout = '|'.join(f'{w * (i % cols)}_{h * (i // cols)}' for i in range(len(results)))
+    lines.append(f'  -filter_complex "{scales}{inputs} xstack=inputs={len(results)}:layout={layout}:fill=black [out]"')
+    lines.append('  -map "[out]" -map 0:a:0 -shortest')
+
+  lines.append(f'  {q(outfile)}')
+  return ' \\\n'.join(lines)
+
+def runBatch(settings, output, jobs, ffmpegOut):
+  '''
+  Correlate every target against the reference (pcm1file) on a process pool
+  '''
+  reference = readEnvelope(
+    settings,
+    settings['pcm1file'],
+    settings['ss1'] if 'ss1' in settings else 0,
+    settings['es1'] if 'es1' in settings else 9999999)
+
+  targets = batchTargets(settings)
+  print(f'Correlate {len(targets)} targets against {settings["pcm1file"]} with {jobs or os.cpu_count()} workers')
+  print()
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers = jobs, initializer = batchInit, initargs = (reference, settings)) as executor:
+    results = list(executor.map(batchTarget, targets))
+
+  print()
+  print('Best delays (offsets) of targets to match reference:')
+  for r in results:
+    print(f'  {r["offset"]:10.3f} s  score: {r["score"]:.6g}  confidence: {r["confidence"]:6.2f}  {r["file"]}')
+  print()
+
+  if output:
+    print(f'Write results to {output}')
+    if output.lower().endswith('.csv'):
+      with open(output, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = ['file', 'offset', 'score', 'confidence'])
+        writer.writeheader()
+        writer.writerows(results)
     else:
-      si = max(0, round((len(ret) - of) * isr / osr))
-      ei = round((len(ret) + 1 + of) * isr / osr)
-      if ei >= len(pcm):
-        break
-      sum = 0
-      for sample in pcm[si:ei]:
-        sum = sum + sample * sample;
-      ret.append(sum / (ei - si))
+      with open(output, 'w') as f:
+        json.dump({ 'reference' : settings['pcm1file'], 'results' : results }, f, indent = 2)
 
-  print(f'  Calculated {len(ret)} windowed average energy samples')
+  if ffmpegOut:
+    print('ffmpeg command line:')
+    print()
+    print(ffmpegCommand(settings['pcm1file'], results, ffmpegOut))
+    print()
+
+# Envelopes of drift worker processes, see driftInit
+driftEnvelopes = None
+
+def driftInit(i1, i2, osr):
+  global driftEnvelopes
+  driftEnvelopes = (np.asarray(i1, dtype = float), np.asarray(i2, dtype = float), osr)
+
+def driftWindow(window):
+  '''
+  Local offset of a second input window; runs in a worker process.
+
+  window is (start, length, expected offset, search radius), all in seconds. Only the slice of the
+  first input around the expected position is correlated.
+
+  Returns (window center time in second input, offset, score, confidence)
+  '''
+  i1, i2, osr = driftEnvelopes
+  t0, w, expected, search = window
+
+  a = round(t0 * osr)
+  b = a + round(w * osr)
+  r0 = max(0, a + math.floor((expected - search) * osr))
+  r1 = min(len(i1), b + math.ceil((expected + search) * osr))
+
+  # delays are relative to the slice starts
+  shift = (r0 - a) / osr
+  da, ca, bestd, bestv = correlateFft(i1[r0:r1], i2[a:b], expected - search - shift, expected + search - shift, 1 / osr, osr = osr)
+  return (t0 + w / 2, bestd + shift, float(bestv), confidence(ca, bestv))
+
+def theilSen(t, d):
+  '''
+  Robust linear fit d = d0 + k * t: median of pairwise slopes, median intercept
+  '''
+  t = np.asarray(t)
+  d = np.asarray(d)
+  i, j = np.triu_indices(len(t), 1)
+  dt = t[j] - t[i]
+  valid = dt != 0
+  k = float(np.median((d[j] - d[i])[valid] / dt[valid])) if np.any(valid) else 0.0
+  d0 = float(np.median(d - k * t))
+  return d0, k
+
+def runDrift(settings, i1, i2, output, jobs):
+  '''
+  Estimate clock drift of the second input: correlate sliding windows around the global offset
+  in parallel and fit offset vs. time
+  '''
+  osr = settings['osr'] if 'osr' in settings else csr
+  w = settings['driftWindow'] if 'driftWindow' in settings else 60
+  hop = settings['driftHop'] if 'driftHop' in settings else 30
+  search = settings['driftSearch'] if 'driftSearch' in settings else 1
+  minConfidence = settings['driftMinConfidence'] if 'driftMinConfidence' in settings else 3
+
+  da, ca, expected, bestv = correlate(i1, i2, settings)
   print()
-  return ret
+  print(f'Global offset: {expected} s')
 
-parser = argparse.ArgumentParser(description = 'Downsampled energy based audio correlation')
+  # windows of the second input that overlap with the first one
+  tmin = max(0, -expected)
+  tmax = min(len(i2) / osr, len(i1) / osr - expected) - w
+  windows = [(t0, w, expected, search) for t0 in np.arange(tmin, tmax + 1e-9, hop)]
+  print(f'Correlate {len(windows)} windows of {w} s (hop {hop} s, search +-{search} s) with {jobs or os.cpu_count()} workers')
+  print()
 
-parser.add_argument('settingsJson', help = 'Setting JSON file')
-args = parser.parse_args()
+  with concurrent.futures.ProcessPoolExecutor(max_workers = jobs, initializer = driftInit, initargs = (i1, i2, osr)) as executor:
+    measured = list(executor.map(driftWindow, windows))
 
-print(f'Read settings from {args.settingsJson}')
-with open(args.settingsJson, 'r') as f:
-  settings = json.load(f)
+  used = [m for m in measured if m[3] >= minConfidence]
+  print()
+  print(f'Windows (time in second input, offset, confidence), {len(used)} of {len(measured)} used:')
+  for m in measured:
+    print(f'  {m[0]:10.2f} s  {m[1]:10.4f} s  {m[3]:6.2f}{"" if m[3] >= minConfidence else "  (dropped)"}')
+  print()
 
-print(f'  Done: {settings}')
-print()
+  if len(used) < 2:
+    print(f'Not enough windows above confidence {minConfidence} to fit drift')
+    return
 
-i1 = readPcm(
-  settings['pcm1file'],
-  ss = settings['ss1'] if 'ss1' in settings else 0,
-  es = settings['es1'] if 'es1' in settings else 9999999,
-  osr = settings['osr'] if 'osr' in settings else csr,
-  of = settings['of'] if 'of' in settings else of)
+  d0, k = theilSen([m[0] for m in used], [m[1] for m in used])
+  ppm = k * 1e6
+  tempo = 1 / (1 + k)
 
-i2 = readPcm(
-  settings['pcm2file'],
-  ss = settings['ss2'] if 'ss2' in settings else 0,
-  es = settings['es2'] if 'es2' in settings else 9999999,
-  osr = settings['osr'] if 'osr' in settings else csr,
-  of = settings['of'] if 'of' in settings else of)
+  print(f'Offset at second input start: {d0:.4f} s')
+  print(f'Drift: {ppm:.2f} ppm ({k * 3600:.4f} s per hour)')
+  print()
+  print('Suggested ffmpeg options for the second input:')
+  print(f'  -itsoffset {d0:.4f} -i "<SECOND_INPUT>" -filter:a "atempo={tempo:.8f}" -filter:v "setpts={1 + k:.8f}*PTS"')
+  print()
 
-da = []
-ca = []
-bestd = 0
-bestv = 0
+  if output:
+    print(f'Write drift report to {output}')
+    with open(output, 'w') as f:
+      json.dump({
+        'pcm1file' : settings['pcm1file'],
+        'pcm2file' : settings['pcm2file'],
+        'globalOffset' : float(expected),
+        'offset' : d0,
+        'drift' : k,
+        'ppm' : ppm,
+        'atempo' : tempo,
+        'windows' : [
+          { 'time' : float(m[0]), 'offset' : float(m[1]), 'score' : m[2], 'confidence' : m[3], 'used' : m[3] >= minConfidence }
+          for m in measured]
+      }, f, indent = 2)
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Downsampled energy based audio correlation')
+
+  parser.add_argument('settingsJson', help = 'Setting JSON file')
+  parser.add_argument('-o', '--output', type=str, help='Batch mode: write offsets to this JSON (or .csv) file; drift mode: write drift report JSON')
+  parser.add_argument('-j', '--jobs', type=int, help='Batch / drift mode: number of worker processes (default: CPU count)')
+  parser.add_argument('--drift', action='store_true', help='Estimate clock drift of the second input with windowed correlation')
+  parser.add_argument('--ffmpeg-out', type=str, help='Batch mode: print an ffmpeg command line producing this synced video')
+  parser.add_argument('--no-plot', action='store_true', help='Do not show plots')
+  args = parser.parse_args()
+
+  print(f'Read settings from {args.settingsJson}')
+  with open(args.settingsJson, 'r') as f:
+    settings = json.load(f)
+
+  print(f'  Done: {settings}')
+  print()
 
-dtmin = settings['dtmin'] if 'dtmin' in settings else 0
-dtmax = settings['dtmax'] if 'dtmax' in settings else 10
-dtstep = settings['dtstep'] if 'dtstep' in settings else 0.01
+  if 'targets' in settings:
+    runBatch(settings, args.output, args.jobs, args.ffmpeg_out)
+    return
 
-fig, axs = plt.subplots(2, sharex = True)
-fig.suptitle('Time series')
-axs[0].plot(i1)
-axs[0].set_title(settings['pcm1file'])
-axs[1].plot(i2)
-axs[1].set_title(settings['pcm2file'])
-plt.show()
+  i1 = readEnvelope(
+    settings,
+    settings['pcm1file'],
+    settings['ss1'] if 'ss1' in settings else 0,
+    settings['es1'] if 'es1' in settings else 9999999)
 
+  i2 = readEnvelope(
+    settings,
+    settings['pcm2file'],
+    settings['ss2'] if 'ss2' in settings else 0,
+    settings['es2'] if 'es2' in settings else 9999999)
 
-print(f'Sweep dt between {dtmin} s and {dtmax} s with step {dtstep} s')
+  if args.drift:
+    runDrift(settings, i1, i2, args.output, args.jobs)
+    return
 
-for d in np.arange(dtmin, dtmax, dtstep):
-  # d: current delay (of i2) in seconds
+  if not args.no_plot:
+    import matplotlib.pyplot as plt
+    fig, axs = plt.subplots(2, sharex = True)
+    fig.suptitle('Time series')
+    axs[0].plot(i1)
+    axs[0].set_title(settings['pcm1file'])
+    axs[1].plot(i2)
+    axs[1].set_title(settings['pcm2file'])
+    plt.show()
 
-  i1s = round(d * csr) if d >= 0 else 0
-  i2s = 0 if d >= 0 else round(-d * csr)
 
-  ct = min(len(i1) - i1s, len(i2) - i2s)
-  val = 0;
-  for i in range(0, ct):
-    val = val + i1[ i1s + i ] * i2[ i2s + i ]
-  val = val / ct
+  da, ca, bestd, bestv = correlate(i1, i2, settings)
 
-  da.append(d)
-  ca.append(val)
-  if val > bestv:
-    bestv = val
-    bestd = d
-  print(f'Delay: {d} Corr: {val}')
+  print()
+  print(f'Best delay (offset) of second PCM to match first: {bestd} s')
 
-print()
-print(f'Best delay (offset) of second PCM to match first: {bestd} s')
 
+  if not args.no_plot:
+    plt.plot(da, ca)
+    #plt.plot(i1)
+    plt.show()
 
-plt.plot(da, ca)
-#plt.plot(i1)
-plt.show()
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import datetime
+import importlib.util
+import os
+import sys
+
+'''
+Bracket grouping test of fuse-expo-series.py on synthetic frames
+
+Brackets of exposure biases 0, -2, +2 are shot 0.5 s apart, frames within a bracket 0.3 s apart, so
+the capture time gap never splits them. Checks that a dropped first, middle or last frame of a
+bracket gives one short bracket and does not shift the later ones, also early in long series where
+the shifted brackets would outnumber the others, and with brackets shot without a pause.
+'''
+
+base_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, base_dir)
+spec = importlib.util.spec_from_file_location('fuse_expo_series', os.path.join(base_dir, 'fuse-expo-series.py'))
+fuse_expo_series = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fuse_expo_series)
+
+order = [0, -2, 2]
+
+def series(brackets, dropped, pause):
+  '''
+  Frames of the given number of brackets without the dropped (bracket, index in order) frame; frames
+  are 0.3 s apart, plus pause seconds between brackets
+  '''
+  t = datetime.datetime(2024, 5, 1, 12)
+  frames = []
+  n = 0
+  for b in range(brackets):
+    for k, e in enumerate(order):
+      if (b, k) != dropped:
+        frames.append({ 'path' : f'expo-series/IMG_{n:04d}.JPG', 'time' : t, 'exposure' : e })
+      n += 1
+      t += datetime.timedelta(seconds = 0.3)
+    t += datetime.timedelta(seconds = pause)
+  return frames
+
+def check(name, brackets, dropped, pause = 0.2):
+  got = [[f['exposure'] for f in b] for b in fuse_expo_series.group_brackets(series(brackets, dropped, pause), 2.0)]
+  expected = [[e for k, e in enumerate(order) if (b, k) != dropped] for b in range(brackets)]
+  ok = got == expected
+  print(f'  {name}: ' + ('ok' if ok else f'FAILED, {got}'))
+  return ok
+
+def main():
+  print('Run bracket grouping test')
+  ok = True
+  ok = check('complete', 5, None) and ok
+  ok = check('dropped first frame', 5, (2, 0)) and ok
+  ok = check('dropped middle frame', 5, (2, 1)) and ok
+  ok = check('dropped last frame', 5, (2, 2)) and ok
+  ok = check('dropped first frame of bracket 1 of 20', 20, (1, 0)) and ok
+  ok = check('dropped first frame of bracket 3 of 100', 100, (3, 0)) and ok
+  ok = check('dropped first frame of bracket 0 of 20', 20, (0, 0)) and ok
+  ok = check('dropped first frame of bracket 1 of 20, no pause between brackets', 20, (1, 0), 0) and ok
+  if not ok:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import glob
+import importlib.util
+import json
+import math
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+'''
+Scalability benchmark of the show-pano-layout.py pipeline on synthetic PTOs
+
+ - Multi-row spherical grids (10 .. 5000 images by default) with zenith / nadir images, several
+   lenses with a, b, c distortion shared through back references (a=0), random rolls and
+   portrait images
+ - Parsing, outline projection, drawing and PNG encoding are timed separately
+ - Projected outlines are checked against an independent scalar reference implementation in both
+   directions: dense reference outline samples must lie within the tolerance of the drawn polylines,
+   and the drawn polylines, sampled as drawn on the chart every --drawn-step degrees, within the
+   tolerance of the reference outline (so extra drawn geometry fails too) (chart degrees)
+
+Results are appended to a JSON history (default test-output/layout-benchmark.json) so runs
+can be compared over time.
+
+The PTOs of the test directory are checked as well: no drawn chart segment may span half the chart
+width (a seam endpoint wrapped to the wrong chart edge draws a full width line).
+
+Launch with -h to print CLI help
+'''
+
+base_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, base_dir)
+import ptofile
+from panogeometry import outline_seam_polylines, wrap_angles
+
+spec = importlib.util.spec_from_file_location('show_pano_layout', os.path.join(base_dir, 'show-pano-layout.py'))
+show_pano_layout = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(show_pano_layout)
+
+# Lenses of the synthetic projects: (a, b, c)
+lenses = [
+  (0, 0, 0),
+  (0, -0.01, 0),
+  (0.002, -0.015, 0.004),
+  (-0.01, 0.02, -0.02)
+]
+
+# Default image counts
+sizes = [10, 50, 200, 1000, 5000]
+
+def synthetic_pto(n, rng):
+  '''
+  PTO text of about n images on a multi-row spherical grid; rows overlap by about 30%
+  '''
+  hfov = math.degrees(math.sqrt(4 * math.pi / n * 3.6))
+  vfov = hfov * 2 / 3
+  rows = max(1, round(180 / (vfov * 0.7)) - 1)
+
+  lines = ['# hugin project file', '#hugin_ptoversion 2', 'p f2 w8000 h4000 v360  k0 E0 R0 n"TIFF_m c:LZW r:CROP"', 'm i0', '', '# image lines']
+  first_of_lens = {}
+  positions = [(90, 0)] + [(-90 + (r + 0.5) * 180 / rows, None) for r in range(rows)] + [(-90, 0)]
+  k = 0
+  for pitch, yaw in positions:
+    band = abs(pitch) + 90 / rows
+    cols = 1 if yaw is not None else max(1, math.ceil(360 * math.cos(math.radians(min(90, max(0, band - 180 / rows)))) / (hfov * 0.7)))
+    for c in range(cols):
+      lens = k % len(lenses)
+      portrait = k % 7 == 3
+      w, h = (2000, 3000) if portrait else (3000, 2000)
+      y = (yaw if yaw is not None else -180 + (c + 0.5) * 360 / cols) + rng.normal(0, 0.5)
+      r = (90 if portrait else 0) + rng.normal(0, 3)
+      if lens in first_of_lens:
+        ref = first_of_lens[lens]
+        optics = f'v={ref} a={ref} b={ref} c={ref}'
+      else:
+        first_of_lens[lens] = k
+        a, b, cc = lenses[lens]
+        optics = f'v{hfov:.4f} a{a} b{b} c{cc}'
+      lines.append('#-hugin  cropFactor=1')
+      lines.append(f'i w{w} h{h} f0 {optics} Ra0 Rb0 Rc0 Rd0 Re0 Eev0 Er1 Eb1 r{r:.4f} p{pitch + rng.normal(0, 0.3):.4f} '
+        f'y{y:.4f} TrX0 TrY0 TrZ0 Tpy0 Tpp0 j0 d0 e0 g0 t0 Va1 Vb0 Vc0 Vd0 Vx0 Vy0  Vm5 n"img{k:05d}.jpg"')
+      k = k + 1
+  return '\n'.join(lines) + '\n', k
+
+def reference_outline(image, points):
+  '''
+  Independent scalar projection of points per edge of an image outline; list of (yaw, pitch) degrees
+  '''
+  w = float(image['w'])
+  h = float(image['h'])
+  a, b, c = float(image['a']), float(image['b']), float(image['c'])
+  d = 1 - (a + b + c)
+  unit = min(w, h) / 2
+  focal = w / (2 * math.tan(math.radians(float(image['v'])) / 2))
+  ry, rp, rr = (math.radians(float(image[k])) for k in ('y', 'p', 'r'))
+
+  corners = [(-w / 2, -h / 2), (w / 2, -h / 2), (w / 2, h / 2), (-w / 2, h / 2)]
+  ret = []
+  for e in range(4):
+    (x1, y1), (x2, y2) = corners[e], corners[(e + 1) % 4]
+    for i in range(points):
+      x = x1 + (x2 - x1) * i / points
+      y = y1 + (y2 - y1) * i / points
+
+      # smallest corrected radius reaching the image radius, by bisection
+      img_r = math.hypot(x, y) / unit
+      lo, hi = 0.0, img_r
+      while hi * (((a * hi + b) * hi + c) * hi + d) < img_r and hi < 10:
+        lo, hi = hi, hi * 1.5 + 0.01
+      for _ in range(60):
+        mid = (lo + hi) / 2
+        if mid * (((a * mid + b) * mid + c) * mid + d) < img_r:
+          lo = mid
+        else:
+          hi = mid
+      scale = (lo + hi) / 2 / img_r if img_r > 0 else 1
+
+      # camera: x to the image center, y up, z to the image x axis; then roll, pitch, yaw
+      vx, vy, vz = focal, y * scale, x * scale
+      vy, vz = vy * math.cos(rr) - vz * math.sin(rr), vy * math.sin(rr) + vz * math.cos(rr)
+      vx, vy = vx * math.cos(rp) - vy * math.sin(rp), vx * math.sin(rp) + vy * math.cos(rp)
+      vx, vz = vx * math.cos(ry) - vz * math.sin(ry), vx * math.sin(ry) + vz * math.cos(ry)
+      n = math.sqrt(vx * vx + vy * vy + vz * vz)
+      ret.append((math.degrees(math.atan2(vz, vx)), math.degrees(math.asin(max(-1, min(1, vy / n))))))
+  return ret
+
+def polyline_distance(points, polylines):
+  '''
+  Chart distance (degrees) of each (yaw, pitch) point to the nearest polyline segment; yaw differences wrap
+  '''
+  best = np.full(len(points), np.inf)
+  for polyline in polylines:
+    s1 = polyline[:-1][None, :, :]
+    s2 = polyline[1:][None, :, :]
+    p = points[:, None, :]
+    # wrap segment ends next to the point
+    a = np.stack((p[..., 0] + (s1[..., 0] - p[..., 0] + 180) % 360 - 180, np.broadcast_to(s1[..., 1], (len(points), s1.shape[1]))), axis = -1)
+    b = a + np.stack(((s2[..., 0] - s1[..., 0] + 180) % 360 - 180, s2[..., 1] - s1[..., 1]), axis = -1)
+    ab = b - a
+    t = np.clip(np.sum((p - a) * ab, axis = -1) / np.maximum(np.sum(ab * ab, axis = -1), 1e-12), 0, 1)
+    closest = a + t[..., None] * ab
+    best = np.minimum(best, np.sqrt(np.sum((p - closest) ** 2, axis = -1)).min(axis = 1))
+  return best
+
+def drawn_samples(polylines, step):
+  '''
+  (yaw, pitch) samples at most step degrees apart along polylines as drawn on the chart: each point
+  wrapped into -180 .. 180, straight chart lines in between
+  '''
+  ret = []
+  for polyline in polylines:
+    p = np.stack((wrap_angles(polyline[:, 0], 180), polyline[:, 1]), axis = -1)
+    for a, b in zip(p[:-1], p[1:]):
+      n = max(1, int(np.ceil(np.max(np.abs(b - a)) / step)))
+      ret.append(a + (b - a) * (np.arange(n)[:, None] / n))
+    ret.append(p[-1:])
+  return np.concatenate(ret) if ret else np.zeros((0, 2))
+
+def check_outlines(images, polylines, points, pole_margin, drawn_step, density):
+  '''
+  Largest and 99th percentile distance of reference outline samples from the drawn polylines and of
+  drawn samples from the reference outline (density times more samples: straight chart lines between
+  reference samples cut the stretched yaw near the poles short); samples within pole_margin degrees of
+  a pole are skipped (yaw is degenerate there)
+  '''
+  errors = []
+  for image, image_polylines in zip(images, polylines):
+    ref = np.array(reference_outline(image, points * density))
+    checked = ref[::density]
+    checked = checked[np.abs(checked[:, 1]) < 90 - pole_margin]
+    if len(checked):
+      errors.append(polyline_distance(checked, image_polylines))
+    drawn = drawn_samples(image_polylines, drawn_step)
+    drawn = drawn[np.abs(drawn[:, 1]) < 90 - pole_margin]
+    if len(drawn):
+      errors.append(polyline_distance(drawn, [np.concatenate((ref, ref[:1]))]))
+  errors = np.concatenate(errors) if errors else np.zeros(1)
+  return float(errors.max()), float(np.percentile(errors, 99))
+
+def check_test_ptos():
+  '''
+  Names of the test PTOs whose chart outlines have a segment wider than half the chart
+  '''
+  failed = []
+  for path in sorted(glob.glob(os.path.join(base_dir, 'test', '*.pto'))):
+    pto = ptofile.load(path)
+    widest = max((abs(b[0] - a[0]) for polylines in show_pano_layout.chart_outlines(pto.images)
+      for polyline in polylines for a, b in zip(polyline[:-1], polyline[1:])), default = 0)
+    ok = widest < show_pano_layout.chart_cw / 2
+    print(f'  {os.path.basename(path):40s} widest segment {widest:7.1f} px' + ('' if ok else '  FAILED'))
+    if not ok:
+      failed.append(os.path.basename(path))
+  return failed
+
+def timed(fn):
+  t = time.perf_counter()
+  ret = fn()
+  return ret, time.perf_counter() - t
+
+def run_case(workdir, n, args, fonts, rng):
+  text, count = synthetic_pto(n, rng)
+  path = os.path.join(workdir, f'synthetic-{n}.pto')
+  with open(path, 'w') as f:
+    f.write(text)
+
+  pto, parse_s = timed(lambda: ptofile.load(path))
+  polylines, project_s = timed(lambda: outline_seam_polylines(pto.images, show_pano_layout.outline_tolerance))
+
+  # drawing only: outlines come from a warm cache
+  cache = show_pano_layout.LayoutCache()
+  cache.get_outlines(pto.images)
+  img, draw_s = timed(lambda: show_pano_layout.render_layout(pto, path, fonts, cache = cache))
+  png = os.path.join(workdir, f'synthetic-{n}.png')
+  _, encode_s = timed(lambda: img.save(png))
+
+  check_s = 0
+  max_error = p99_error = None
+  if count <= args.check_max_images:
+    (max_error, p99_error), check_s = timed(lambda: check_outlines(pto.images, polylines, args.check_points, args.pole_margin, args.drawn_step, args.reference_density))
+
+  points = sum(len(p) for image_polylines in polylines for p in image_polylines)
+  r = {
+    'images' : count,
+    'parse_s' : parse_s,
+    'project_s' : project_s,
+    'draw_s' : draw_s,
+    'encode_s' : encode_s,
+    'outline_points' : points,
+    'png_bytes' : os.path.getsize(png),
+    'max_error_deg' : max_error,
+    'p99_error_deg' : p99_error,
+    'check_s' : check_s,
+    'ok' : max_error is None or max_error <= args.tolerance
+  }
+  print(f'  {count:5d} images  parse {parse_s:7.3f} s  project {project_s:7.3f} s  draw {draw_s:7.3f} s  encode {encode_s:6.3f} s'
+    f'  {points:7d} points' + (f'  error max {max_error:.4f}° p99 {p99_error:.4f}°' if max_error is not None else '  (not checked)')
+    + ('' if r['ok'] else '  FAILED'))
+  return r
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Benchmark show-pano-layout.py parsing, projection and drawing on synthetic PTOs.')
+
+  parser.add_argument('--sizes', type=str, default=','.join(str(s) for s in sizes), help=f'Comma separated approximate image counts (default: {",".join(str(s) for s in sizes)})')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='Largest accepted outline error in chart degrees (default: 0.25)')
+  parser.add_argument('--check-points', type=int, default=32, help='Reference samples per image edge (default: 32)')
+  parser.add_argument('--drawn-step', type=float, default=0.5, help='Sample step along the drawn polylines for the reverse check, degrees (default: 0.5)')
+  parser.add_argument('--reference-density', type=int, default=4, help='Reference samples per edge of the reverse check, multiple of --check-points (default: 4)')
+  parser.add_argument('--check-max-images', type=int, default=1000, help='Skip the reference check of larger projects (default: 1000)')
+  parser.add_argument('--pole-margin', type=float, default=0.5, help='Reference samples closer to a pole are not checked, degrees (default: 0.5)')
+  parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+  parser.add_argument('--history', type=str, default=os.path.join(base_dir, 'test-output', 'layout-benchmark.json'), help='JSON history file to append results to')
+
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(args.seed)
+  fonts = show_pano_layout.load_fonts()
+
+  print(f'Run layout benchmark, sizes: {args.sizes}, tolerance: {args.tolerance}°')
+  results = []
+  with tempfile.TemporaryDirectory() as workdir:
+    for n in args.sizes.split(','):
+      results.append(run_case(workdir, int(n), args, fonts, rng))
+
+  print('Check test PTOs')
+  failed_ptos = check_test_ptos()
+
+  run = {
+    'time' : datetime.datetime.now().isoformat(timespec = 'seconds'),
+    'host' : platform.node(),
+    'python' : platform.python_version(),
+    'numpy' : np.__version__,
+    'max_rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'results' : results,
+    'failed_test_ptos' : failed_ptos
+  }
+
+  history = []
+  if os.path.exists(args.history):
+    with open(args.history, 'r') as f:
+      history = json.load(f)
+  history.append(run)
+
+  os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok = True)
+  with open(args.history, 'w') as f:
+    json.dump(history, f, indent = 2)
+
+  print(f'Max RSS: {run["max_rss_mb"]:.1f} MB')
+  print(f'Results appended to {args.history} ({len(history)} runs)')
+  if failed_ptos or not all(r['ok'] for r in results):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+
+'''
+Stage cache test of pano-pipeline.py with stub Hugin tools
+
+The stubs (written to a temporary directory and put first in the PATH) copy their input PTO, so
+PTO contents never change. Checks:
+ - a second run has every stage cached
+ - after rewriting the pixels of one source image, cpfind and celeste (which read pixels) run again
+   although pto_gen writes a byte identical PTO; stages after them are cached by the PTO contents
+'''
+
+base_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+
+stub = '''#!/usr/bin/env python3
+import os, sys
+tool = os.path.basename(sys.argv[0])
+a = sys.argv[1:]
+o = a[a.index('-o') + 1]
+if tool == 'pto_gen':
+  with open(o, 'w') as f:
+    f.write('p f2 w4000 h2000 v360  k0 E0 R0 n"TIFF_m c:LZW r:CROP"\\nm i0\\n')
+    for k, i in enumerate(a[2:]):
+      f.write(f'i w640 h480 f0 v60 a0 b0 c0 r0 p0 y{k * 40 - 40} n"{os.path.basename(i)}"\\n')
+else:
+  src = [x for x in a if x.endswith('.pto') and x != o][-1]
+  with open(src) as f:
+    text = f.read()
+  with open(o, 'w') as f:
+    f.write(text)
+'''
+
+tools = ['pto_gen', 'pano_modify', 'cpfind', 'celeste_standalone', 'cpclean', 'pto_var', 'autooptimiser']
+
+def run_pipeline(workdir, env):
+  p = subprocess.run([sys.executable, os.path.join(base_dir, 'pano-pipeline.py'), '-nb', '-nl', '-np'],
+    cwd = workdir, env = env, capture_output = True, text = True)
+  if p.returncode != 0:
+    print(p.stdout + p.stderr)
+    raise Exception(f'pano-pipeline.py exited with code {p.returncode}')
+  with open(os.path.join(workdir, 'pano-pipeline-timings.json'), 'r') as f:
+    return { r['name'] : r['status'] for r in json.load(f)[-1]['stages'] }
+
+def check(name, statuses, expected):
+  wrong = { s : statuses.get(s) for s, e in expected.items() if statuses.get(s) != e }
+  print(f'  {name}: ' + ('ok' if not wrong else f'FAILED, {wrong}'))
+  return not wrong
+
+def main():
+  ok = True
+  with tempfile.TemporaryDirectory() as tmp:
+    bindir = os.path.join(tmp, 'bin')
+    workdir = os.path.join(tmp, 'pano')
+    os.makedirs(bindir)
+    os.makedirs(os.path.join(workdir, 'sources'))
+    for tool in tools:
+      path = os.path.join(bindir, tool)
+      with open(path, 'w') as f:
+        f.write(stub)
+      os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    for k in range(3):
+      with open(os.path.join(workdir, 'sources', f'a{k}.jpg'), 'wb') as f:
+        f.write(b'pixels %d' % k)
+    env = dict(os.environ, PATH = bindir + os.pathsep + os.environ['PATH'])
+
+    print('Run pipeline cache test')
+    statuses = run_pipeline(workdir, env)
+    ok = check('first run', statuses, { s : 'ran' for s in statuses }) and ok
+
+    statuses = run_pipeline(workdir, env)
+    ok = check('second run', statuses, { s : 'cached' for s in statuses }) and ok
+
+    with open(os.path.join(workdir, 'sources', 'a1.jpg'), 'wb') as f:
+      f.write(b'edited pixels')
+    statuses = run_pipeline(workdir, env)
+    ok = check('edited source image', statuses, { 'initial' : 'ran', 'initial-c' : 'cached', 'cpfind' : 'ran',
+      'celeste' : 'ran', 'cpclean' : 'cached', 'final' : 'cached' }) and ok
+
+  if not ok:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+'''
+Speed and accuracy benchmark of sweep.py on synthetic PCM pairs
+
+ - Reference: noise modulated by a random loudness envelope
+ - Target: the same envelope from a known offset, with gain mismatch, clock drift,
+   independent carrier noise and a noise floor
+ - Envelope building and each correlation method are timed separately; peak traced
+   memory, max RSS and the offset error are reported
+
+Results are appended to a JSON history (default test-output/sweep-benchmark.json) so runs
+can be compared over time.
+
+Launch with -h to print CLI help
+'''
+
+base_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, base_dir)
+import sweep
+
+isr = 16000
+
+# Loudness envelope knot distance in seconds
+knot = 0.05
+
+# Default cases: (target length s, offset s, noise, gain, drift ppm)
+cases = [
+  (60,    12.34, 0.1, 1.0,   0),
+  (60,    -7.89, 0.5, 0.3,   0),
+  (600,   37.21, 0.3, 0.5,   0),
+  (600,   37.21, 0.3, 0.5,  50),
+  (3600,  91.07, 0.3, 0.7,   0),
+  (3600,  91.07, 0.3, 0.7, 100),
+  (10800, 55.55, 0.3, 0.7,   0)
+]
+
+def envelope(knots, t):
+  '''
+  Loudness at times t (seconds), linear interpolation of the knot values
+  '''
+  return np.interp(t / knot, np.arange(len(knots)), knots)
+
+def write_pcm(path, knots, start, length, noise, gain, drift, rng):
+  '''
+  Write length seconds of big endian s16 PCM following the loudness envelope from start seconds on
+  '''
+  chunk = 1 << 20
+  n = round(length * isr)
+  with open(path, 'wb') as f:
+    for c0 in range(0, n, chunk):
+      i = np.arange(c0, min(n, c0 + chunk))
+      t = start + (1 + drift * 1e-6) * i / isr
+      loud = gain * envelope(knots, t)
+      s = 8000 * (loud * rng.standard_normal(len(i)) + noise * 0.05 * rng.standard_normal(len(i)))
+      f.write(np.clip(s, -32768, 32767).astype('>i2').tobytes())
+
+def measure(fn):
+  '''
+  Run fn with its output captured; returns (result, seconds, peak traced MB)
+  '''
+  tracemalloc.start()
+  t = time.perf_counter()
+  with contextlib.redirect_stdout(io.StringIO()):
+    ret = fn()
+  dt = time.perf_counter() - t
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return ret, dt, peak / (1024 * 1024)
+
+def run_case(workdir, case, methods, osr, of, rng):
+  length, offset, noise, gain, drift = case
+  reflength = length + 2 * abs(offset) + 60
+
+  knots = rng.random(math.ceil((reflength + 1) / knot) + 2) ** 3
+  ref = os.path.join(workdir, 'ref.pcm')
+  tgt = os.path.join(workdir, 'tgt.pcm')
+  refstart = max(0, -offset) + 30
+
+  write_pcm(ref, knots, 0, reflength, 0.1, 1.0, 0, rng)
+  write_pcm(tgt, knots, refstart + offset, length, noise, gain, drift, rng)
+
+  # delay of target in reference, at the middle of the target
+  expected = refstart + offset + drift * 1e-6 * length / 2
+
+  (i1, i2), envelope_s, envelope_mb = measure(lambda: (
+    sweep.readPcm(ref, isr = isr, osr = osr, of = of),
+    sweep.readPcm(tgt, isr = isr, osr = osr, of = of)))
+
+  # search window; lags with short overlap have noisy normalized scores
+  search = min(120, length / 2)
+
+  ret = []
+  for method in methods:
+    dtmin = expected - search
+    dtmax = expected + search
+    if method == 'loop':
+      if length > 60:
+        continue
+      dtmin = expected - 2
+      dtmax = expected + 2
+
+    settings = { 'osr' : osr, 'dtmin' : dtmin, 'dtmax' : dtmax, 'dtstep' : 1 / osr, 'method' : method }
+    (da, ca, bestd, bestv), correlate_s, correlate_mb = measure(lambda: sweep.correlate(i1, i2, settings))
+
+    r = {
+      'length' : length,
+      'offset' : offset,
+      'noise' : noise,
+      'gain' : gain,
+      'drift' : drift,
+      'method' : method,
+      'osr' : osr,
+      'of' : of,
+      'envelope_s' : envelope_s,
+      'envelope_mb' : envelope_mb,
+      'correlate_s' : correlate_s,
+      'correlate_mb' : correlate_mb,
+      'expected' : expected,
+      'found' : float(bestd),
+      'error' : float(bestd) - expected,
+      'confidence' : sweep.confidence(ca, bestv)
+    }
+    print(f'  {length:6d} s  noise {noise:4.2f}  gain {gain:4.2f}  drift {drift:4d} ppm  {method:8s}'
+      f'  envelope {envelope_s:7.3f} s {envelope_mb:7.1f} MB  correlate {correlate_s:7.3f} s {correlate_mb:7.1f} MB'
+      f'  error {r["error"] * 1000:8.2f} ms  confidence {r["confidence"]:6.2f}')
+    ret.append(r)
+
+  return ret
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Benchmark sweep.py envelope building and correlation on synthetic signals.')
+
+  parser.add_argument('--max-length', type=float, default=3600, help='Skip cases with longer target (seconds, default: 3600; 10800 runs every case)')
+  parser.add_argument('--methods', type=str, default='fft,pyramid,loop', help='Comma separated correlation methods (default: fft,pyramid,loop)')
+  parser.add_argument('--osr', type=int, default=100, help='Envelope sample rate (default: 100)')
+  parser.add_argument('--of', type=float, default=0.5, help='Envelope overlap factor (default: 0.5)')
+  parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+  parser.add_argument('--history', type=str, default=os.path.join(base_dir, 'test-output', 'sweep-benchmark.json'), help='JSON history file to append results to')
+
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(args.seed)
+  methods = args.methods.split(',')
+
+  print(f'Run sweep.py benchmark, methods: {methods}, osr: {args.osr}, of: {args.of}')
+  results = []
+  with tempfile.TemporaryDirectory() as workdir:
+    for case in cases:
+      if case[0] <= args.max_length:
+        results.extend(run_case(workdir, case, methods, args.osr, args.of, rng))
+
+  run = {
+    'time' : datetime.datetime.now().isoformat(timespec = 'seconds'),
+    'host' : platform.node(),
+    'python' : platform.python_version(),
+    'numpy' : np.__version__,
+    'max_rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'results' : results
+  }
+
+  history = []
+  if os.path.exists(args.history):
+    with open(args.history, 'r') as f:
+      history = json.load(f)
+  history.append(run)
+
+  os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok = True)
+  with open(args.history, 'w') as f:
+    json.dump(history, f, indent = 2)
+
+  print(f'Max RSS: {run["max_rss_mb"]:.1f} MB')
+  print(f'Results appended to {args.history} ({len(history)} runs)')
+
+if __name__ == '__main__':
+  main()